@@ -4,18 +4,26 @@
 # https://github.com/actorpus/SCPUAS
 # http://simplecpudesign.com/
 
+import hashlib
+import importlib.util
 import logging
+import marshal
 import pathlib
 import pprint
 import random
+import re
 import time
 import sys
 import getopt
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from types import CodeType
 from typing import *
-from types import ModuleType
 
+import build_cache
+import timing
+
+from cycles import CycleTable
 from scp_instruction import (
     Instruction,
     REQUIRED,
@@ -41,18 +49,20 @@ assembler.py -i <file>                scp file
              -f <filename>            generate mif file
              -o <filename>            output file (similar to the old assembler this will output ALL types)
              -D <filename>            generate .asm file (disassembly for original format)
+             -P <filename>            generate .debug listing (with best and worst case cycles per root)
+             -C <filename>            cycle table (json) used for the cycle estimates
+             -c <folder>              cache builds and compiled CIC code in this folder between runs
+             -w <watch>               reassemble every time the input or a file it uses changes
              -v <verbose>
              -V <very verbose>
 """
 
-Instructions: dict[str, Instruction] = {}
-
 # sets up the default aliases
-aliases = {".randomname": '__import__("random").randbytes(16).hex()'}
+default_aliases = {".randomname": '__import__("random").randbytes(16).hex()'}
 
 
 class RegisterRef:
-    def __init__(self, argument: str, _instruction=None):
+    def __init__(self, argument: str, _instruction=None, _definition=None):
         _log = logging.getLogger("RegisterRefInit")
 
         argument = argument.upper()
@@ -63,7 +73,7 @@ class RegisterRef:
             )
 
             if _instruction is not None:
-                print_debug(_instruction)
+                print_debug(_instruction, _definition)
 
             raise SystemExit
 
@@ -73,7 +83,7 @@ class RegisterRef:
             )
 
             if _instruction is not None:
-                print_debug(_instruction)
+                print_debug(_instruction, _definition)
 
             raise SystemExit
 
@@ -83,7 +93,7 @@ class RegisterRef:
             )
 
             if _instruction is not None:
-                print_debug(_instruction)
+                print_debug(_instruction, _definition)
 
             raise SystemExit
 
@@ -102,52 +112,43 @@ class RegisterRef:
 InstructionStrut = dict[str, Union[str, int, list[Union[str, int, RegisterRef]]]]
 
 
-def create_char_stream(frm) -> iter:
-    return iter(str(frm))
+# anything the tokenizer does not take, tabs are expanded and the rest dropped
+_non_ascii = re.compile(r"[^\x20-\x7e\n]")
 
 
-def char_stream_ascii_only(stream: iter, _log_name="AsciiOnly") -> iter:
+def source_ascii_only(source: str, _log_name="AsciiOnly") -> str:
     _log = logging.getLogger(_log_name)
 
-    while True:
-        try:
-            char = next(stream)
-        except StopIteration:
-            _log.debug("End of stream")
-            break
+    found = set(_non_ascii.findall(source))
 
-        if char == "\t":
-            _log.warning("Found tab character, replacing with 4 spaces.")
-
-            for _ in range(4):
-                yield " "
+    if not found:
+        return source
 
-        if ord(char) not in range(32, 127) and char not in ["\n"]:
-            _log.warning(f"Found non-ascii character '{char}', ignoring.")
-            continue
+    for char in sorted(found):
+        count = source.count(char)
 
-        yield char
+        # the first few lines it is on
+        lines = []
+        at = source.find(char)
+        while at != -1 and len(lines) <= 5:
+            lines.append(source.count("\n", 0, at) + 1)
 
+            next_line = source.find("\n", at)
+            if next_line == -1:
+                break
 
-def token_stream_alias_replacer(stream: iter, _log_name="AliasReplace") -> iter:
-    _log = logging.getLogger(_log_name)
-
-    while True:
-        try:
-            token, line = next(stream)
-        except StopIteration:
-            _log.debug("End of stream")
-            break
-
-        for alias in aliases:
-            nt = token.replace(f"${alias}$", aliases[alias])
+            at = source.find(char, next_line)
 
-            if nt != token:
-                _log.debug(f"Found and replaced alias {alias} in {token}")
+        where = ", ".join(map(str, lines[:5])) + (", ..." if len(lines) > 5 else "")
+        where = f"line{'s' if len(lines) > 1 else ''} {where}"
+        plural = "s" if count > 1 else ""
 
-            token = nt
+        if char == "\t":
+            _log.warning(f"Found {count} tab character{plural} ({where}), replacing with 4 spaces.")
+        else:
+            _log.warning(f"Found {count} non-ascii character{plural} {char!r} ({where}), ignoring.")
 
-        yield (token, line)
+    return _non_ascii.sub("", source.replace("\t", "    "))
 
 
 class TokenizeError(Exception):
@@ -181,13 +182,17 @@ class TokenizeError(Exception):
 """
 
 
-def print_debug(instruction):
+def print_debug(instruction, definition: Union[None, Instruction] = None):
+    # 'definition' is the Instruction it was read as, for its documentation
     # incase logging is going to console ensures the debug is visible
     time.sleep(0.2)
 
     file = "Unknown"
     line = "Unknown"
 
+    # arguments are only kept as "original" once the argument parser saw them
+    original = instruction.get("original", instruction["arguments"])
+
     if "line" in instruction:
         line = instruction["line"]
 
@@ -200,7 +205,8 @@ def print_debug(instruction):
 
     if file != "Unknown":
         with open(file) as f:
-            lines = f.readlines()[line - 1: line + 2]
+            # the line before, the line (1-based) and the line after
+            lines = ["", *f.readlines(), "", ""][line - 1: line + 2]
 
         a = f"{line - 1!s:>4} | {lines[0].strip()}\n"
         b = f"{line!s:>4} | {lines[1].strip()}\n"
@@ -216,14 +222,14 @@ def print_debug(instruction):
                             * (
                                     len(instruction["name"])
                                     + 1
-                                    + len(" ".join(map(str, instruction["original"])))
+                                    + len(" ".join(map(str, original)))
                             )
                     )
                     + "\n"
             )
 
-    if Instructions[instruction["name"]].__doc__ is not None:
-        doc = Instructions[instruction["name"]].__doc__
+    if definition is not None and definition.__doc__ is not None:
+        doc = definition.__doc__
 
     else:
         doc = "No documentation found"
@@ -234,21 +240,42 @@ Error in instruction '{instruction["name"]}', at line {line}, in file {file}
 
 {a}{b}{c}
 
-Was interpreted as {instruction["name"]}( {', '.join(map(str, instruction["original"]))} )
+Was interpreted as {instruction["name"]}( {', '.join(map(str, original))} )
 
 Documentation for instruction:
 {doc}\033[0;0m"""
     )
 
 
-def char_stream_tokenize(stream: iter, _log_name="Tokenizer") -> iter:
+# characters that can change the tokenizer's state or end a token, anything
+# between them is copied into the token a run at a time
+_tokenizer_special = re.compile(r'[\\{!}"#/\n ]')
+# spaces are only delimiters outside of comments, code and strings
+_tokenizer_special_no_space = re.compile(r'[\\{!}"#/\n]')
+_tokenizer_whitespace = re.compile(r"[ \n]*")
+# between tokens, the next plain token (ended by a delimiter) or a line
+# comment holding nothing that could change the state, most of any source
+_tokenizer_simple = re.compile(
+    r'[ \n]*(?:([^\\{!}"#/\n ]+)(?=[ \n]|\Z)|#(?!/)[^\\{"#\n]*(?:\n|\Z))'
+)
+
+
+def char_stream_tokenize(stream: Union[str, iter], _log_name="Tokenizer") -> iter:
     _log = logging.getLogger(_log_name)
 
-    memory = ["\x00" for _ in range(10)]
+    # scanned as one buffer (see source_ascii_only), a char stream is joined first
+    source = stream if isinstance(stream, str) else "".join(stream)
+    end = len(source)
+    pos = 0
+
     token = ""
-    delimiters = [" ", "\n"]
+    # the previous character, the two character markers ({! !} {{ }} #/ /#)
+    # and escapes look back at it
+    prev = "\x00"
 
-    line = 0
+    # 1-based, tokens carry the line they start on
+    line = 1
+    token_line = line
 
     inside_block_code = False
     inside_line_code = False
@@ -256,557 +283,801 @@ def char_stream_tokenize(stream: iter, _log_name="Tokenizer") -> iter:
     inside_block_comment = False
     inside_line_comment = False
 
-    while True:
-        try:
-            char = next(stream)
-        except StopIteration:
-            _log.debug("End of stream")
-            break
+    while pos < end:
+        delimiting = not (
+                inside_block_comment
+                or inside_line_comment
+                or inside_block_code
+                or inside_line_code
+                or inside_string
+        )
 
-        if not char or char is None:
-            break
+        if delimiting and not token and prev != "\\":
+            simple = _tokenizer_simple.match(source, pos)
+
+            if simple is not None and simple.end() > pos:
+                line += source.count("\n", pos, simple.end())
+                token_line = line
+                prev = source[simple.end() - 1]
+                pos = simple.end()
+
+                if simple[1] is not None:
+                    _log.debug("Token: %s", simple[1])
+                    yield (simple[1], token_line)
+
+                continue
+
+        if prev != "\\":
+            special = (
+                _tokenizer_special if delimiting else _tokenizer_special_no_space
+            ).search(source, pos)
+            stop = end if special is None else special.start()
+
+            if stop > pos:
+                if not token:
+                    token_line = line
+
+                if not (inside_block_comment or inside_line_comment):
+                    token += source[pos:stop]
+
+                prev = source[stop - 1]
+                pos = stop
+                continue
+
+        char = source[pos]
+        pos += 1
 
         if char == "\n":
             line += 1
 
-        if memory[-1:] == ["\\"]:
+        if not token:
+            token_line = line
+
+        if prev == "\\":
             token += char
-            memory = memory[1:] + [char]
+            prev = char
             continue
 
-        memory = memory[1:] + [char]
+        pair = prev + char
+        prev = char
 
         # Block code
-        if memory[-2:] == ["{", "!"] and not any(
-                [
-                    inside_block_code,
-                ]
-        ):
+        if pair == "{!" and not inside_block_code:
             if inside_line_code:
                 _log.critical("Block code start symbol found inside line code")
                 # passes out everything for nice error messages later
                 raise TokenizeError(
                     "Block code start symbol found inside line code",
                     token,
-                    memory,
+                    list(("\x00" * 10 + source[:pos])[-10:]),
                     char,
-                    stream,
+                    iter(source[pos:]),
                 )
 
             inside_block_code = True
 
-        elif memory[-2:] == ["!", "}"] and inside_block_code:
+        elif pair == "!}" and inside_block_code:
             inside_block_code = False
             token += "}"
             continue
 
         # Line code
-        elif memory[-2:] == ["{", "{"] and not any(
-                [inside_block_code, inside_line_code]
-        ):
-            if inside_block_code:
-                _log.critical("Line code start symbol found inside block code")
-                raise TokenizeError(
-                    "Line code start symbol found inside block code",
-                    token,
-                    memory,
-                    char,
-                    stream,
-                )
-
+        elif pair == "{{" and not (inside_block_code or inside_line_code):
             inside_line_code = True
 
-        elif memory[-2:] == ["}", "}"] and inside_line_code:
+        elif pair == "}}" and inside_line_code:
             inside_line_code = False
             token += "}"
             continue
 
         # Strings
-        elif memory[-1:] == ['"'] and not any(
-                [inside_block_code, inside_line_code, inside_string]
+        elif char == '"' and not (
+                inside_block_code or inside_line_code or inside_string
         ):
             inside_string = True
 
-        elif memory[-1:] == ['"'] and inside_string:
+        elif char == '"' and inside_string:
             inside_string = False
 
         # Block comments
-        elif memory[-2:] == ["#", "/"] and not any(
-                [
-                    inside_block_code,
-                    inside_line_code,
-                    inside_string,
-                    inside_block_comment,
-                ]
+        elif pair == "#/" and not (
+                inside_block_code
+                or inside_line_code
+                or inside_string
+                or inside_block_comment
         ):
             inside_block_comment = True
 
-        elif memory[-2:] == ["/", "#"] and inside_block_comment:
+        elif pair == "/#" and inside_block_comment:
             inside_block_comment = False
             continue
 
         # Line comments
-        elif memory[-1:] == ["#"] and not any(
-                [
-                    inside_block_code,
-                    inside_line_code,
-                    inside_string,
-                    inside_block_comment,
-                    inside_line_comment,
-                ]
+        elif char == "#" and not (
+                inside_block_code
+                or inside_line_code
+                or inside_string
+                or inside_block_comment
+                or inside_line_comment
         ):
             inside_line_comment = True
 
-        elif memory[-1:] == ["\n"] and inside_line_comment:
+        elif char == "\n" and inside_line_comment:
             inside_line_comment = False
             continue
 
-        if char in delimiters and not any(
-                [
-                    inside_block_comment,
-                    inside_line_comment,
-                    inside_block_code,
-                    inside_line_code,
-                    inside_string,
-                ]
-        ):
+        if (char == " " or char == "\n") and delimiting:
             if token:
                 _log.debug("Token: %s", token)
-                yield (token, line)
+                yield (token, token_line)
 
             token = ""
+
+            # the rest of the gap between tokens
+            gap = _tokenizer_whitespace.match(source, pos).end()
+            if gap > pos:
+                line += source.count("\n", pos, gap)
+                token_line = line
+                prev = source[gap - 1]
+                pos = gap
+
             continue
 
         if not (inside_block_comment or inside_line_comment):
             token += char
 
     if token:
-        yield (token, line)
+        yield (token, token_line)
 
 
-# store different scope for each file loaded and executed
-# when loading multiple files other scopes can be accessed by
-# like {name}.variable where name is relative to the root file
-python_in_scp_scopes: dict[pathlib.Path, dict] = {}
+# compiled CIC code kept by every Assembler. the same inline expressions
+# and precompute template blocks are run over and over
+CIC_CODE_CACHE_SIZE = 1024
 
 
-def execute_cic_in_scope(
-        code: str, scopes: dict, project_root, executing_from, _log_name, use_exec=False
-):
-    _log = logging.getLogger(_log_name)
-    _log.debug("Generating scopes, executing from " + executing_from.__repr__())
+def _cic_code_cache_path(folder: pathlib.Path, source: str, mode: str) -> pathlib.Path:
+    # marshal is only readable by the python version that wrote it
+    digest = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+    digest.update(f"{mode}\0{source}".encode())
 
-    to_resolve = [
-        (k.relative_to(project_root).parts, v)
-        for k, v in scopes.items()
-        if k.relative_to(project_root) != executing_from.relative_to(project_root)
-    ]
-    to_resolve.sort(key=lambda x: len(x[0]))
+    return folder / f"{digest.hexdigest()}.cic"
 
-    args: dict = {}
 
-    if not executing_from in scopes:
-        scopes[executing_from] = {}
+class CICScopeProxy:
+    """
+    A folder or file of the project as seen from CIC code, e.g. `folder.file`
+    for ./folder/file.scp. Attributes are read from and written to the
+    file's scope itself, nothing is copied.
+    """
 
-    args.update(scopes[executing_from])
+    def __init__(self, scopes: dict, project_root, parts: tuple[str, ...]):
+        object.__setattr__(self, "_scopes", scopes)
+        object.__setattr__(self, "_project_root", project_root)
+        object.__setattr__(self, "_parts", parts)
 
-    for parts, scope in to_resolve:
-        current = args
-        for part in parts:
-            current = current.setdefault(part, {})
-        current.update(scope)
+    def _files(self) -> dict[tuple[str, ...], dict]:
+        return {
+            k.relative_to(self._project_root).parts: v for k, v in self._scopes.items()
+        }
 
-    def compile_r(scope: dict):
-        localse = {}
+    def __getattr__(self, name):
+        files = self._files()
+        parts = self._parts + (name,)
 
-        for k, v in scope.items():
-            if isinstance(v, dict):
-                localse[k] = compile_r(v)
-                continue
+        if any(_[: len(parts)] == parts for _ in files):
+            return CICScopeProxy(self._scopes, self._project_root, parts)
 
-            localse[k] = v.__repr__()
+        if name in files.get(self._parts, {}):
+            return files[self._parts][name]
 
-        r_code = "type('CICScopeLoaderClass', (), {"
+        raise AttributeError(f"CIC scope '{'.'.join(self._parts)}' has no '{name}'")
 
-        for k, v in localse.items():
-            r_code += f'"{k}": {v}, '
+    def __setattr__(self, name, value):
+        files = self._files()
 
-        r_code = r_code[:-2] + "})"
+        if self._parts not in files:
+            raise AttributeError(f"'{'.'.join(self._parts)}' is a folder, not a CIC scope")
 
-        return r_code
+        files[self._parts][name] = value
 
-    init_setup = ""
+    def __repr__(self):
+        return f"<CIC scope {'.'.join(self._parts)}>"
 
-    for k, v in args.items():
-        if isinstance(v, dict):
-            init_setup += f"{k} = {compile_r(v)}\n"
-            continue
 
-        init_setup += f"{k} = {v.__repr__()}\n"
+RootedInstructionsStruct = OrderedDict[str, list[InstructionStrut]]
 
-    __log_name__ = _log_name
+# included files kept by every Assembler, see Assembler.load_include
+INCLUDE_CACHE_SIZE = 256
 
-    def run_and_extract_scope(
-            __code__: str, __initial__: str, __args__: dict, __use__exec__
-    ):
-        # Start strict names
-        __log__ = logging.getLogger(f"{__log_name__}.Run")
-        exec(__initial__)
 
-        if __use__exec__:
-            __log__.debug("created scope, overwriting print and using exec")
+def _copy_roots(roots: RootedInstructionsStruct) -> RootedInstructionsStruct:
+    # later stages add to the instructions and their arguments in place
+    return OrderedDict(
+        (root, [_ | {"arguments": list(_["arguments"])} for _ in instructions])
+        for root, instructions in roots.items()
+    )
 
-            __output__ = ""
 
-            def print(*args, end="\n", sep=" "):
-                nonlocal __output__
-                __output__ += sep.join(map(str, args)) + end
+def _source_digest(path) -> Union[None, bytes]:
+    try:
+        with open(path) as file:
+            return hashlib.sha256(file.read().encode()).digest()
+    except OSError:
+        return None
 
-            exec(__code__)
 
-        else:
-            __log__.debug("created scope, using eval")
+class Assembler:
+    """
+    The assembler's pipeline with everything a build changes, the
+    instructions and aliases loaded and the CIC scopes, kept on the object.
+    Builds on different objects never see each other's state, so any number
+    can run at the same time in threads. One object runs one build at a
+    time, every build starts by forgetting the last one (see reset()) but
+    keeps the caches (compiled CIC, included and language files).
+    """
 
-            __output__ = eval(__code__)
+    def __init__(self, cic_code_cache_folder: Union[None, pathlib.Path] = None):
+        """
+        Compiled CIC code is also marshalled to 'cic_code_cache_folder' and
+        shared between runs (None to only cache in memory)
+        """
+        self.instructions: dict[str, Instruction] = {}
+        self.aliases = default_aliases.copy()
 
-        __log__.debug("output = " + __output__.__repr__())
+        # matches $name$ for every alias, rebuilt once -alias adds a name (see
+        # _alias_matcher), names are only ever added until reset
+        self._alias_pattern: Union[None, re.Pattern] = None
+        self._alias_pattern_size = -1
 
-        locale = locals()
+        # store different scope for each file loaded and executed
+        # when loading multiple files other scopes can be accessed by
+        # like {name}.variable where name is relative to the root file
+        self.python_in_scp_scopes: dict[pathlib.Path, dict] = {}
 
-        # End strict names
-        locale = {
-            k: v
-            for k, v in locale.items()
-            if not k.startswith("__") and not k.endswith("__")
-        }
+        # (number of scopes, project root) and the first part of every
+        # scope's path for them, see execute_cic_in_scope
+        self._cic_scope_names: tuple[tuple, set[str]] = ((), set())
 
-        if "print" in locale:
-            del locale["print"]
+        # compiled CIC code by (source, mode), least recently used first
+        self._cic_code_cache: OrderedDict[tuple[str, str], CodeType] = OrderedDict()
+        self.cic_code_cache_folder = cic_code_cache_folder
 
-        if "_log" in locale:
-            _log.warning("Found _log in locale, removing")
-            del locale["_log"]
+        # every file included by (path, project root, content hash, aliases,
+        # instructions), see load_include. kept between builds, entries check
+        # the files they include are unchanged before being used
+        self._include_cache: dict[tuple, dict] = {}
 
-        locale = {
-            k: v
-            for k, v in locale.items()
-            if type(v) != ModuleType
-               and not (type(v) == type and v.__name__ != "CICScopeLoaderClass")
-        }
+        # instructions loaded from -language files by (path, content hash), so
+        # later builds get the same instructions back
+        self._language_cache: dict[tuple[str, bytes], dict[str, Instruction]] = {}
 
-        def decompose(value):
-            if isinstance(value, type):
-                locale = value.__dict__
-                locale = {
-                    k: v
-                    for k, v in locale.items()
-                    if not k.startswith("__") and not k.endswith("__")
-                }
+        # the files (and their hashes) read by every include being processed,
+        # innermost last
+        self._include_files: list[dict[pathlib.Path, bytes]] = []
 
-                return {k: decompose(v) for k, v in locale.items()}
+        # every CIC execution this build as (executing_from, code, use_exec, output)
+        self._cic_log: list[tuple] = []
 
-            return value
+        # CIC executions already done, handed out by execute_cic_in_scope
+        # instead of running them again
+        self._cic_replay: deque[tuple] = deque()
 
-        for k, v in locale.items():
-            locale[k] = decompose(v)
+    def reset(self):
+        """
+        Forgets the instructions, aliases and CIC scopes left over from the
+        last build, full_stack_load_compile does this before every build.
+        """
+        self.instructions.clear()
 
-        __log__.debug("locale = " + locale.__repr__())
+        self.aliases.clear()
+        self.aliases.update(default_aliases)
+        self._alias_pattern_size = -1
 
-        return __output__, locale
+        self.python_in_scp_scopes.clear()
+        self._cic_scope_names = ((), set())
 
-    _log.debug("Built local objects, Running")
+    def _alias_matcher(self) -> re.Pattern:
+        if self._alias_pattern_size != len(self.aliases):
+            # longest first, so a name that is part of another never wins
+            names = sorted(self.aliases, key=len, reverse=True)
 
-    output, locale = run_and_extract_scope(code, init_setup, args, use_exec)
+            self._alias_pattern = re.compile("|".join(re.escape(f"${name}$") for name in names))
+            self._alias_pattern_size = len(self.aliases)
 
-    _log.debug("Code executed, reversing output locale into scopes")
+        return self._alias_pattern
 
-    current_scope = {
-        k: v for k, v in locale.items() if k not in {_[0][0] for _ in to_resolve}
-    }
-    extra_scopes = {
-        k: v for k, v in locale.items() if k in {_[0][0] for _ in to_resolve}
-    }
+    def _alias_value(self, match: re.Match) -> str:
+        return self.aliases[match[0][1:-1]]
 
-    scopes[executing_from] = current_scope
+    def token_stream_alias_replacer(self, stream: iter, _log_name="AliasReplace") -> iter:
+        _log = logging.getLogger(_log_name)
 
-    for scope in scopes:
-        if scope == executing_from:
-            continue
+        while True:
+            try:
+                token, line = next(stream)
+            except StopIteration:
+                _log.debug("End of stream")
+                break
 
-        scope_t = scope.relative_to(project_root).parts
-        looking = extra_scopes.copy()
+            # every alias in the token is replaced in one scan, values are not
+            # scanned again (they were replaced when the alias was defined)
+            if "$" in token:
+                nt = self._alias_matcher().sub(self._alias_value, token)
 
-        for part in scope_t:
-            looking = looking[part]
+                if nt != token:
+                    _log.debug(f"Found and replaced aliases in {token}")
 
-        scopes[scope] = looking
+                token = nt
 
-    _log.debug("Reversed scopes")
+            yield (token, line)
 
-    return output, scopes
+    def compile_cic(self, source: str, mode: str) -> CodeType:
+        """
+        The code object for a CIC snippet, compiled once and reused from the
+        cache, mode is "exec" for blocks and "eval" for inline code.
+        """
+        if mode == "eval":
+            # eval() ignores leading whitespace, compile() does not
+            source = source.lstrip(" \t")
 
+        key = (source, mode)
 
-def token_stream_cic_executor(
-        stream: iter, project_root, executing_from, _log_name="CICExecutor"
-) -> iter:
-    _log = logging.getLogger(_log_name)
-    global python_in_scp_scopes
+        if key in self._cic_code_cache:
+            self._cic_code_cache.move_to_end(key)
+            return self._cic_code_cache[key]
 
-    while True:
-        try:
-            token, line = next(stream)
-        except StopIteration:
-            _log.debug("End of stream")
-            break
+        code = None
 
-        opp = "{{" in token or "{!" in token
+        if self.cic_code_cache_folder is not None:
+            path = _cic_code_cache_path(self.cic_code_cache_folder, source, mode)
 
-        while "{!" in token:
-            start = token.index("{!")
-            end = token.index("!}")
+            try:
+                code = marshal.loads(path.read_bytes())
+            except (OSError, EOFError, ValueError, TypeError):
+                code = None
 
-            code = token[start + 2: end]
+        if code is None:
+            code = compile(source, "<CIC>", mode)
 
-            scope_name = executing_from.__str__().replace(".scp", "")
+            if self.cic_code_cache_folder is not None:
+                build_cache.write_atomic(path, marshal.dumps(code))
 
-            if "." in scope_name:
-                _log.critical(f"Scope name '{scope_name}' contains '.'. Exiting.")
-                raise SystemExit
+        self._cic_code_cache[key] = code
 
-            log_name = f"{_log_name}.ScopeExecutor"
+        if len(self._cic_code_cache) > CIC_CODE_CACHE_SIZE:
+            self._cic_code_cache.popitem(last=False)
+
+        return code
+
+    def execute_cic_in_scope(
+            self, code: str, project_root, executing_from, _log_name, use_exec=False
+    ) -> Any:
+        """
+        Runs CIC code in the file's scope, a namespace kept for the whole build
+        (so variables, functions and imports carry over between blocks). Every
+        other file is reachable through a CICScopeProxy named after the first
+        part of its path.
+        """
+        _log = logging.getLogger(_log_name)
+        _log.debug("Executing in scope " + executing_from.__repr__())
+
+        event = (executing_from, code, use_exec)
 
-            result, python_in_scp_scopes = execute_cic_in_scope(
-                code,
-                python_in_scp_scopes,
-                project_root,
-                pathlib.Path(scope_name),
-                _log_name=log_name,
-                use_exec=True,
+        if self._cic_replay and self._cic_replay[0][:3] == event:
+            # already run while checking a cached include, see load_include
+            output = self._cic_replay.popleft()[3]
+            _log.debug("output (replayed) = " + output.__repr__())
+
+            self._cic_log.append((*event, output))
+
+            return output
+
+        scopes = self.python_in_scp_scopes
+        namespace = scopes.setdefault(executing_from, {})
+
+        # scopes are only ever added to, so the names only change with the count
+        if self._cic_scope_names[0] != (len(scopes), project_root):
+            self._cic_scope_names = (
+                (len(scopes), project_root),
+                {k.relative_to(project_root).parts[0] for k in scopes},
             )
 
-            token = token[:start] + result + token[end + 2:]
+        for name in self._cic_scope_names[1]:
+            # the file's own variables win over other files
+            if name not in namespace or isinstance(namespace[name], CICScopeProxy):
+                namespace[name] = CICScopeProxy(scopes, project_root, (name,))
+
+        if not use_exec:
+            _log.debug("using eval")
+            output = eval(self.compile_cic(code, "eval"), namespace)
 
-        while "{{" in token:
-            start = token.index("{{")
-            end = token.index("}}")
+        else:
+            _log.debug("overwriting print and using exec")
 
-            code = token[start + 2: end]
+            printed = []
 
-            scope_name = executing_from.__str__().strip(".scp")
+            def capture(*args, end="\n", sep=" "):
+                printed.append(sep.join(map(str, args)) + end)
 
-            if "." in scope_name:
-                _log.critical(f"Scope name '{scope_name}' contains '.'. Exiting.")
-                raise SystemExit
+            namespace["print"] = capture
+
+            try:
+                exec(self.compile_cic(code, "exec"), namespace)
+            finally:
+                # print only goes into the code while the block runs
+                if namespace.get("print") is capture:
+                    del namespace["print"]
+
+            output = "".join(printed)
+
+        _log.debug("output = " + output.__repr__())
+
+        self._cic_log.append((*event, output))
+
+        return output
+
+    def token_stream_cic_executor(
+            self, stream: iter, project_root, executing_from, _log_name="CICExecutor"
+    ) -> iter:
+        _log = logging.getLogger(_log_name)
+
+        while True:
+            try:
+                token, line = next(stream)
+            except StopIteration:
+                _log.debug("End of stream")
+                break
+
+            opp = "{{" in token or "{!" in token
+
+            while "{!" in token:
+                start = token.index("{!")
+                end = token.index("!}")
+
+                code = token[start + 2: end]
+
+                scope_name = executing_from.__str__().replace(".scp", "")
+
+                if "." in scope_name:
+                    _log.critical(f"Scope name '{scope_name}' contains '.'. Exiting.")
+                    raise SystemExit
+
+                log_name = f"{_log_name}.ScopeExecutor"
+
+                result = self.execute_cic_in_scope(
+                    code,
+                    project_root,
+                    pathlib.Path(scope_name),
+                    _log_name=log_name,
+                    use_exec=True,
+                )
+
+                token = token[:start] + result + token[end + 2:]
+
+            while "{{" in token:
+                start = token.index("{{")
+                end = token.index("}}")
+
+                code = token[start + 2: end]
+
+                scope_name = executing_from.__str__().replace(".scp", "")
+
+                if "." in scope_name:
+                    _log.critical(f"Scope name '{scope_name}' contains '.'. Exiting.")
+                    raise SystemExit
+
+                log_name = f"{_log_name}.ScopeExecutor"
+
+                result = self.execute_cic_in_scope(
+                    code,
+                    project_root,
+                    pathlib.Path(scope_name),
+                    _log_name=log_name,
+                    use_exec=False,
+                )
+
+                token = token[:start] + str(result) + token[end + 2:]
+
+            if not opp:
+                yield (token, line)
+                continue
 
+            # catch up result to where we are now
             log_name = f"{_log_name}.ScopeExecutor"
 
-            result, python_in_scp_scopes = execute_cic_in_scope(
-                code,
-                python_in_scp_scopes,
-                project_root,
-                pathlib.Path(scope_name),
-                _log_name=log_name,
-                use_exec=False,
+            temp_source = source_ascii_only(
+                str(token), _log_name=f"{log_name}.AsciiOnly"
+            )
+            temp_token_stream = char_stream_tokenize(
+                temp_source, _log_name=f"{log_name}.Tokenizer"
+            )
+            temp_token_stream = self.token_stream_alias_replacer(
+                temp_token_stream, _log_name=f"{log_name}.AliasReplace"
             )
 
-            token = token[:start] + str(result) + token[end + 2:]
+            for t, _ in temp_token_stream:
+                yield (t, _)
 
-        if not opp:
-            yield (token, line)
-            continue
+    def _press_include(
+            self, code: str, path: pathlib.Path, project_path, imported: set, _log_name
+    ) -> RootedInstructionsStruct:
+        _log = logging.getLogger(_log_name)
 
-        # catch up result to where we are now
-        log_name = f"{_log_name}.ScopeExecutor"
+        temp_rel_name = f"{_log_name}.IncludeLoader({path})"
 
-        temp_char_stream = create_char_stream(token)
-        temp_char_stream = char_stream_ascii_only(
-            temp_char_stream, _log_name=f"{log_name}.AsciiOnly"
+        temp_source = source_ascii_only(
+            str(code), _log_name=f"{temp_rel_name}.AsciiOnly"
         )
         temp_token_stream = char_stream_tokenize(
-            temp_char_stream, _log_name=f"{log_name}.Tokenizer"
+            temp_source, _log_name=f"{temp_rel_name}.Tokenizer"
         )
-        temp_token_stream = token_stream_alias_replacer(
-            temp_token_stream, _log_name=f"{log_name}.AliasReplace"
+        temp_token_stream = self.token_stream_alias_replacer(
+            temp_token_stream, _log_name=f"{temp_rel_name}.AliasReplace"
+        )
+        temp_token_stream = self.token_stream_cic_executor(
+            temp_token_stream,
+            project_path,
+            path,
+            _log_name=f"{temp_rel_name}.CICExecutor",
         )
 
-        for t, _ in temp_token_stream:
-            yield (t, _)
+        _log.debug(f"Executing from {path}")
+        temp_roots, temp_imported = self.token_stream_instruction_press(
+            temp_token_stream,
+            project_path,
+            code_location=path,
+            enforce_start=False,
+            imported=imported,
+            _log_name=f"{temp_rel_name}.InstructionPress",
+        )
+        temp_roots, temp_imported = self.rooted_instructions_pre_computer(
+            temp_roots, temp_imported, project_path, path
+        )
+        _log.debug(f"Returned from {path}")
 
+        imported.update(temp_imported)
 
-RootedInstructionsStruct = OrderedDict[str, list[InstructionStrut]]
+        return temp_roots
 
+    def load_include(
+            self, path: pathlib.Path, project_path, imported: set, _log_name="IncludeLoader"
+    ) -> RootedInstructionsStruct:
+        """
+        The pressed and precomputed roots of an included file, only worked out
+        once for the same file content, aliases, instructions and files it
+        includes in turn.
 
-def token_stream_instruction_press(
-        stream: iter,
-        project_path: pathlib.Path,
-        code_location: pathlib.Path,
-        enforce_start=True,
-        imported: set = None,
-        _log_name="InstructionPress",
-) -> tuple[RootedInstructionsStruct, set[pathlib.Path]]:
-    _log = logging.getLogger(_log_name)
+        Including a cached file again still runs its CIC (and the CIC of the
+        files it includes) in order, so the scopes change exactly as before. If
+        the CIC printed the same as last time the roots are reused, otherwise
+        the file is processed again with the CIC already run handed back
+        instead of running it twice.
+        """
 
-    roots: RootedInstructionsStruct = OrderedDict()
+        _log = logging.getLogger(_log_name)
 
-    if imported is None:
-        imported = set()
+        with open(path.resolve()) as file:
+            code = file.read()
 
-    current_root: Union[None, str] = None
+        digest = hashlib.sha256(code.encode()).digest()
 
-    # flag to return to the current root after one instruction (at start of next)
-    in_subroot: Union[None, str] = None
+        key = (
+            path.resolve(),
+            project_path,
+            digest,
+            frozenset(self.aliases.items()),
+            frozenset(self.instructions.items()),
+        )
+
+        start = len(self._cic_log)
+        cached = self._include_cache.get(key)
+
+        if cached is not None and any(
+                _source_digest(file) != file_digest for file, file_digest in cached["files"].items()
+        ):
+            _log.debug(f"A file included by {path} changed, processing again")
+            cached = None
+
+        if cached is not None:
+            for executing_from, cic, use_exec, output in cached["cic"]:
+                result = self.execute_cic_in_scope(
+                    cic,
+                    project_path,
+                    executing_from,
+                    _log_name=f"{_log_name}.CICExecutor",
+                    use_exec=use_exec,
+                )
+
+                if result != output:
+                    _log.debug(f"CIC in {path} printed something new, processing again")
+                    break
+
+            else:
+                _log.debug(f"Using cached roots for {path}")
+
+                # what processing the file again would have left behind
+                self.aliases.update(cached["aliases"])
+                self.instructions.update(cached["instructions"])
+                imported.update(cached["imported"])
+
+                if self._include_files:
+                    self._include_files[-1].update(cached["files"])
+                    self._include_files[-1][path.resolve()] = digest
+
+                return _copy_roots(cached["roots"])
+
+            self._cic_replay = deque(self._cic_log[start:])
+            del self._cic_log[start:]
+
+        aliases_before = self.aliases.copy()
+        instructions_before = self.instructions.copy()
+        imported_before = imported.copy()
+
+        self._include_files.append({})
 
-    while True:
         try:
-            token, line = next(stream)
-        except StopIteration:
-            _log.debug("End of stream")
-            break
+            roots = self._press_include(code, path, project_path, imported, _log_name)
+        finally:
+            files = self._include_files.pop()
+
+        if self._cic_replay:
+            _log.warning(f"Processing {path} again did not run the same CIC.")
+            self._cic_replay.clear()
+
+        if self._include_files:
+            self._include_files[-1].update(files)
+            self._include_files[-1][path.resolve()] = digest
+
+        if len(self._include_cache) >= INCLUDE_CACHE_SIZE:
+            del self._include_cache[next(iter(self._include_cache))]
+
+        self._include_cache[key] = {
+            "roots": _copy_roots(roots),
+            "files": files,
+            "cic": self._cic_log[start:],
+            "aliases": {k: v for k, v in self.aliases.items() if aliases_before.get(k) != v},
+            "instructions": {
+                k: v for k, v in self.instructions.items() if instructions_before.get(k) is not v
+            },
+            "imported": imported - imported_before,
+        }
 
-        if token is None:
-            break
+        return roots
 
-        # system commands must continue at end
-        if token == "-alias":
-            alias, _ = next(stream, None)
-            value, _ = next(stream, None)
+    def token_stream_instruction_press(
+            self,
+            stream: iter,
+            project_path: pathlib.Path,
+            code_location: pathlib.Path,
+            enforce_start=True,
+            imported: set = None,
+            _log_name="InstructionPress",
+    ) -> tuple[RootedInstructionsStruct, set[pathlib.Path]]:
+        _log = logging.getLogger(_log_name)
 
-            _log.info(f"Found alias '{alias}' with value '{value}'.")
-            aliases[alias] = value
+        roots: RootedInstructionsStruct = OrderedDict()
 
-            continue
+        if imported is None:
+            imported = set()
 
-        if token == "-language":
-            location, _ = next(stream, None)
+        current_root: Union[None, str] = None
 
-            _log.debug(f"Requesting language file at '{location}'.")
+        # flag to return to the current root after one instruction (at start of next)
+        in_subroot: Union[None, str] = None
 
-            if (
-                    location == "standard"
-                    and pathlib.Path("standard_instructions.py") in imported
-            ):
-                _log.warning("Standard language file allready loaded. Ignoring.")
+        while True:
+            try:
+                token, line = next(stream)
+            except StopIteration:
+                _log.debug("End of stream")
+                break
 
-            elif location == "standard":
-                _log.info("Loading standard language file.")
+            if token is None:
+                break
 
-                from standard_instructions import instructions as default_instructions
+            # system commands must continue at end
+            if token == "-alias":
+                alias, _ = next(stream, None)
+                value, _ = next(stream, None)
 
-                Instructions.update(default_instructions)
-                imported.add(pathlib.Path("standard_instructions.py"))
+                _log.info(f"Found alias '{alias}' with value '{value}'.")
+                self.aliases[alias] = value
 
-            elif pathlib.Path(location) in imported:
-                _log.warning(
-                    f"Language file at '{location}' allready loaded. Ignoring."
-                )
+                continue
 
-            else:
-                _log.info(f"Loading language file at {location}.")
+            if token == "-language":
+                location, _ = next(stream, None)
 
-                path = pathlib.Path(location)
-                if not path.is_absolute():
-                    path = project_path / path
+                _log.debug(f"Requesting language file at '{location}'.")
 
-                if not path.exists():
-                    _log.critical(f"Could not find language file at {path}. Exiting.")
-                    raise SystemExit
+                if (
+                        location == "standard"
+                        and pathlib.Path("standard_instructions.py") in imported
+                ):
+                    _log.warning("Standard language file allready loaded. Ignoring.")
 
-                path = path.resolve().__str__()
-
-                # Hacky way to load specific file as we only need one variable from it
-                def _():
-                    with open(path, "r") as f:
-                        code = f.read()
-                    __name__ = "instructions"
-                    exec(code)
-                    local = locals()
-                    if "instructions" not in local:
-                        logging.getLogger(f"{_log_name}.InstructionLoader").critical(
-                            "Instruction file did not include local dictionary 'instructions'. Exiting"
-                        )
-                        raise SystemExit
+                elif location == "standard":
+                    _log.info("Loading standard language file.")
 
-                    return local["instructions"]
+                    from standard_instructions import instructions as default_instructions
 
-                extra_instructions = _()
+                    self.instructions.update(default_instructions)
+                    imported.add(pathlib.Path("standard_instructions.py"))
 
-                Instructions.update(extra_instructions)
-                imported.add(pathlib.Path(path))
+                elif pathlib.Path(location) in imported:
+                    _log.warning(
+                        f"Language file at '{location}' allready loaded. Ignoring."
+                    )
 
-            continue
+                else:
+                    _log.info(f"Loading language file at {location}.")
+
+                    path = pathlib.Path(location)
+                    if not path.is_absolute():
+                        path = project_path / path
 
-        if token == "-include":
-            location, _ = next(stream, None)
+                    if not path.exists():
+                        _log.critical(f"Could not find language file at {path}. Exiting.")
+                        raise SystemExit
 
-            _log.info(f"Including file from '{location}'")
-            path = pathlib.Path(location)
+                    path = path.resolve().__str__()
+
+                    # Hacky way to load specific file as we only need one variable from it
+                    def _():
+                        with open(path, "r") as f:
+                            code = f.read()
+                        __name__ = "instructions"
+                        exec(code)
+                        local = locals()
+                        if "instructions" not in local:
+                            logging.getLogger(f"{_log_name}.InstructionLoader").critical(
+                                "Instruction file did not include local dictionary 'instructions'. Exiting"
+                            )
+                            raise SystemExit
 
-            if not path.is_absolute():
-                path = project_path / path
+                        return local["instructions"]
 
-            _log.debug(path.resolve())
+                    digest = _source_digest(path)
+                    extra_instructions = self._language_cache.get((path, digest))
 
-            if not path.exists():
-                _log.critical(
-                    f"Unable to include '{path}', Unable to find file. Exiting."
-                )
-                raise SystemExit
+                    if extra_instructions is None:
+                        extra_instructions = _()
+                        self._language_cache[(path, digest)] = extra_instructions
 
-            _log.debug(path)
+                    self.instructions.update(extra_instructions)
+                    imported.add(pathlib.Path(path))
 
-            with open(path.resolve()) as file:
-                temp_code = file.read()
+                    # includes loading instructions depend on the file
+                    if self._include_files:
+                        self._include_files[-1][pathlib.Path(path)] = digest
 
-            temp_rel_name = f"{_log_name}.IncludeLoader({path})"
+                continue
 
-            temp_char_stream = create_char_stream(temp_code)
-            temp_char_stream = char_stream_ascii_only(
-                temp_char_stream, _log_name=f"{temp_rel_name}.AsciiOnly"
-            )
-            temp_token_stream = char_stream_tokenize(
-                temp_char_stream, _log_name=f"{temp_rel_name}.Tokenizer"
-            )
-            temp_token_stream = token_stream_alias_replacer(
-                temp_token_stream, _log_name=f"{temp_rel_name}.AliasReplace"
-            )
-            temp_token_stream = token_stream_cic_executor(
-                temp_token_stream,
-                project_path,
-                path,
-                _log_name=f"{temp_rel_name}.CICExecutor",
-            )
+            if token == "-include":
+                location, _ = next(stream, None)
 
-            _log.debug(f"Executing from {path}")
-            temp_roots, temp_imported = token_stream_instruction_press(
-                temp_token_stream,
-                project_path,
-                code_location=path,
-                enforce_start=False,
-                imported=imported,
-                _log_name=f"{temp_rel_name}.InstructionPress",
-            )
-            temp_roots, temp_imported = rooted_instructions_pre_computer(
-                temp_roots, temp_imported, project_path, path
-            )
-            _log.debug(f"Returned from {path}")
+                _log.info(f"Including file from '{location}'")
+                path = pathlib.Path(location)
 
-            _log.debug(
-                f"Imported root[s] {', '.join(list(temp_roots.keys()))} from {path}"
-            )
+                if not path.is_absolute():
+                    path = project_path / path
 
-            for root in temp_roots:
-                if root in roots:
-                    _log.critical(
-                        f"Found root '{root}' from included file that allready exists. Exiting."
-                    )
-                    raise SystemExit
+                _log.debug(path.resolve())
 
-                if not root.startswith("."):
+                if not path.exists():
                     _log.critical(
-                        f"Found static root '{root}' from included file. Exiting."
+                        f"Unable to include '{path}', Unable to find file. Exiting."
                     )
                     raise SystemExit
 
+                _log.debug(path)
+
+                temp_roots = self.load_include(path, project_path, imported, _log_name)
+
+                _log.debug(
+                    f"Imported root[s] {', '.join(list(temp_roots.keys()))} from {path}"
+                )
+
                 root_path = (
                     path.relative_to(project_path)
                     .__str__()
@@ -814,243 +1085,483 @@ def token_stream_instruction_press(
                     .replace("\\", ".")
                 )
 
-                # . between root_path and root is already there as root has to be dynamic
-                roots[f".{root_path}{root}"] = temp_roots[root]
+                for root in temp_roots:
+                    if root in roots:
+                        _log.critical(
+                            f"Found root '{root}' from included file that allready exists. Exiting."
+                        )
+                        raise SystemExit
+
+                    if not root.startswith("."):
+                        _log.critical(
+                            f"Found static root '{root}' from included file. Exiting."
+                        )
+                        raise SystemExit
 
-            imported.update(temp_imported)
-            imported.add(path)
+                    # . between root_path and root is already there as root has to be dynamic
+                    roots[f".{root_path}{root}"] = temp_roots[root]
 
-            continue
+                imported.add(path)
 
-        # starts with - and is the first argument
-        # done in one if so else can raise errors
-        if (
-                current_root is not None
-                and roots[current_root]
-                and not roots[current_root][-1]["arguments"]
-                and token.startswith("-")
-        ):
-            _log.debug(f"Read subroot name: {token}")
+                continue
 
-            subroot = token[1:]
-            in_subroot = current_root
-            current_root = f"{current_root}.{subroot}"
+            # starts with - and is the first argument
+            # done in one if so else can raise errors
+            if (
+                    current_root is not None
+                    and roots[current_root]
+                    and not roots[current_root][-1]["arguments"]
+                    and token.startswith("-")
+            ):
+                _log.debug(f"Read subroot name: {token}")
 
-            if current_root in roots:
-                _log.critical(
-                    f"Found attempted subroot '{current_root}' that allready exists. Exiting."
-                )
+                subroot = token[1:]
+                in_subroot = current_root
+                current_root = f"{current_root}.{subroot}"
+
+                if current_root in roots:
+                    _log.critical(
+                        f"Found attempted subroot '{current_root}' that allready exists. Exiting."
+                    )
+                    raise SystemExit
+
+                # move current instruction to new root
+                last = roots[in_subroot].pop(-1)
+                roots[current_root] = [last]
+
+                continue
+
+            if token.startswith("-"):
+                _log.critical(f"Unknown system command {token}. Exiting.")
                 raise SystemExit
 
-            # move current instruction to new root
-            last = roots[in_subroot].pop(-1)
-            roots[current_root] = [last]
+            _log.debug(f"Read non system token: {token}")
 
-            continue
+            # Handle .*: as roots
+            if token.endswith(":"):
+                _log.debug(f"creating root with name {token[:-1]}")
 
-        if token.startswith("-"):
-            _log.critical(f"Unknown system command {token}. Exiting.")
-            raise SystemExit
+                # roots cannot be named the same as instructions
+                if token[:-1] in self.instructions:
+                    _log.critical(f"Found instruction '{token[:-1]}' as root. Exiting.")
+                    raise SystemExit
+
+                # if root already exists in table jump back to it
+                if token[:-1] in roots:
+                    _log.error(
+                        f"Root '{token[:-1]}' already exists. Instructions will be amended "
+                        f"to previous instance of root."
+                    )
+                    current_root = token[:-1]
+                    continue
+
+                # If the last instruction does not have at-least the required number of arguments
+                if current_root is not None and (
+                        roots[current_root]
+                        and len(roots[current_root][-1]["arguments"])
+                        < self.instructions[roots[current_root][-1]["name"]].required_arguments
+                ):
+                    _log.critical(
+                        f"Found root '{token[:-1]}' before the required arguments of the previous instruction were filled. Exiting."
+                    )
+
+                    print_debug(
+                        roots[current_root][-1],
+                        self.instructions[roots[current_root][-1]["name"]],
+                    )
+
+                    raise SystemExit
 
-        _log.debug(f"Read non system token: {token}")
+                # Root
+                roots[token[:-1]] = []
+                current_root = token[:-1]
+                in_subroot = None
+                continue
 
-        # Handle .*: as roots
-        if token.endswith(":"):
-            _log.debug(f"creating root with name {token[:-1]}")
+            # Insert 'start' root if no roots are defined yet
+            if current_root is None and enforce_start:
+                _log.warning("Instruction found without a root. inserting 'start' root.")
+                roots["start"] = []
+                current_root = "start"
 
-            # roots cannot be named the same as instructions
-            if token[:-1] in Instructions:
-                _log.critical(f"Found instruction '{token[:-1]}' as root. Exiting.")
+            elif current_root is None:
+                _log.critical(
+                    f"No roots found, included files cannot have unrooted instructions. Exiting."
+                )
                 raise SystemExit
 
-            # if root already exists in table jump back to it
-            if token[:-1] in roots:
+            # Handle instructions
+            if token in self.instructions:
+                # break out of subroot
+                if in_subroot is not None:
+                    _log.debug(f"leaving subroot '{current_root}' for root '{in_subroot}'")
+                    current_root = in_subroot + "~"
+                    roots[current_root] = []
+                    in_subroot = None
+
+                _log.debug(f"Read as instruction: {token}")
+                # If the last instruction does not have at-least the required number of arguments
+                if (
+                        roots[current_root]
+                        and len(roots[current_root][-1]["arguments"])
+                        < self.instructions[roots[current_root][-1]["name"]].required_arguments
+                ):
+                    _log.critical(
+                        f"Found instruction '{token}' before the required arguments of the previous instruction were filled. Exiting."
+                    )
+
+                    print_debug(
+                        roots[current_root][-1],
+                        self.instructions[roots[current_root][-1]["name"]],
+                    )
+
+                    raise SystemExit
+
+                roots[current_root].append(
+                    {
+                        "type": "instruction",
+                        "name": token,
+                        "arguments": [],
+                        "line": line,
+                        "originates_from": code_location,
+                    }
+                )
+                continue
+
+            # Everything else will be a generic token, treat all as arguments
+            elif not roots[current_root]:
                 _log.error(
-                    f"Root '{token[:-1]}' already exists. Instructions will be amended "
-                    f"to previous instance of root."
+                    f"Found token '{token}' before any applicable instruction. Ignoring."
                 )
-                current_root = token[:-1]
                 continue
 
-            # If the last instruction does not have at-least the required number of arguments
-            if current_root is not None and (
-                    roots[current_root]
-                    and len(roots[current_root][-1]["arguments"])
-                    < Instructions[roots[current_root][-1]["name"]].required_arguments
+            # if the last instruction is full
+            if (
+                    len(roots[current_root][-1]["arguments"])
+                    == self.instructions[roots[current_root][-1]["name"]].total_arguments
             ):
-                _log.critical(
-                    f"Found root '{token[:-1]}' before the required arguments of the previous instruction were filled. Exiting."
+                _log.error(
+                    f"Found token '{token}' before new applicable instruction. Ignoring."
                 )
+                continue
 
-                print_debug(roots[current_root][-1])
+            roots[current_root][-1]["arguments"].append(token)
 
-                raise SystemExit
+        return roots, imported
 
-            # Root
-            roots[token[:-1]] = []
-            current_root = token[:-1]
-            in_subroot = None
-            continue
+    def rooted_instructions_pre_computer(
+            self, roots: RootedInstructionsStruct, imported, project_path, path
+    ) -> tuple[RootedInstructionsStruct, set[pathlib.Path]]:
+        _log = logging.getLogger("PreComputer")
+        _log.debug("Starting precomputer")
+
+        new_roots = OrderedDict()
+
+        for root in roots:
+            new_roots[root] = []
+
+            for i, instruction in enumerate(roots[root]):
+                if "precompute_compile" in self.instructions[instruction["name"]].__dict__:
+                    _log.debug(f"Found precompute for instruction '{instruction}'")
+
+                    temp_rel_name = f"PC|{root}[{instruction['line']}]{instruction['name']}"
+                    indentation = len(
+                        max(
+                            [_ for _ in roots if _.startswith(root)],
+                            key=lambda x: x.count("~"),
+                        )
+                    )
+                    new_root_name = f"{root}{'~' * indentation}"
+
+                    temp_precomputed: str = self.instructions[
+                        instruction["name"]
+                    ].precompute_compile(
+                        *instruction["arguments"],
+                        _root=new_root_name.replace("~", "").replace(".", ""),
+                    )
+
+                    temp_precomputed = temp_precomputed.replace("~insert", new_root_name)
+
+                    _log.debug(temp_precomputed)
+
+                    temp_source = source_ascii_only(
+                        str(temp_precomputed), _log_name=f"{temp_rel_name}.AsciiOnly"
+                    )
+                    temp_token_stream = char_stream_tokenize(
+                        temp_source, _log_name=f"{temp_rel_name}.Tokenizer"
+                    )
+                    temp_token_stream = self.token_stream_alias_replacer(
+                        temp_token_stream, _log_name=f"{temp_rel_name}.AliasReplace"
+                    )
+                    temp_token_stream = self.token_stream_cic_executor(
+                        temp_token_stream,
+                        project_path,
+                        path,
+                        _log_name=f"{temp_rel_name}.CICExecutor",
+                    )
+
+                    _log.debug(f"Executing from {path}.{temp_rel_name}")
+                    temp_roots, temp_imported = self.token_stream_instruction_press(
+                        temp_token_stream,
+                        project_path,
+                        code_location=path,
+                        enforce_start=False,
+                        imported=imported,
+                        _log_name=f"{temp_rel_name}.InstructionPress",
+                    )
+                    temp_roots, temp_imported = self.rooted_instructions_pre_computer(
+                        temp_roots, temp_imported, project_path, path
+                    )
+                    _log.debug(f"Returned from {path}.{temp_rel_name}")
+
+                    imported.update(temp_imported)
+
+                    # generated instructions come from the precomputed instruction's
+                    # line, not their line in the generated code
+                    for temp_instructions in temp_roots.values():
+                        for temp_instruction in temp_instructions:
+                            temp_instruction["line"] = instruction["line"]
+
+                    for temp_root in temp_roots:
+                        if temp_root in roots:
+                            _log.critical(
+                                f"Found precomputed root '{temp_root}' that already exists. Exiting."
+                            )
+                            raise SystemExit
+
+                        if temp_root.split(".")[0] == "~insert":
+                            _log.debug(
+                                f"Inserting precomputed instructions into root '{root}'"
+                            )
+                            new_roots[root].extend(temp_roots[temp_root])
+
+                            continue
+
+                        _log.debug(f"Adding precomputed instructions as root '{temp_root}'")
+                        new_roots[temp_root] = temp_roots[temp_root]
+
+                else:
+                    new_roots[root].append(instruction)
+
+        return new_roots, imported
+
+    def rooted_instructions_argument_parser(
+            self,
+            roots: RootedInstructionsStruct,
+    ) -> RootedInstructionsStruct:
+        """
+        Verify that all references are valid.
+        Verify all arguments are correct types (converting where necessary).
+        """
+        _log = logging.getLogger("ArgumentParser")
+
+        pressed_roots = {_.replace("~", "") for _ in roots.keys()}
+
+        for root in roots:
+            for instruction in roots[root]:
+                # leave original arguments for decompiling
+                instruction["original"] = instruction["arguments"].copy()
+
+                if instruction["type"] == "instruction":
+                    name = instruction["name"]
+                    arguments = instruction["arguments"]
+                    org = instruction.copy()
+                    instruction = self.instructions[name]
+
+                    for i in range(instruction.total_arguments):
+                        instruction_flags = list(instruction.arguments.values())[i]
+
+                        if instruction_flags & REQUIRED and i >= len(arguments):
+                            _log.critical(
+                                f"Instruction '{name}' requires at least {instruction.required_arguments} arguments. Exiting."
+                            )
+
+                            print_debug(org, instruction)
+                            raise SystemExit
+
+                        if i >= len(arguments):
+                            continue
+
+                        dynam = parse_dynamic_token(arguments[i])
+
+                        arguments[i] = parse_argument(
+                            dynam, instruction_flags, pressed_roots
+                        )
+
+        return roots
+
+    def rooted_instructions_compiler(
+            self,
+            roots: RootedInstructionsStruct,
+    ) -> tuple[list[str], RootedInstructionsStruct]:
+        _log = logging.getLogger("Compiler")
+
+        # pformat of every root is slow even when it is not logged
+        debug = _log.isEnabledFor(logging.DEBUG)
+
+        if debug:
+            _log.debug(f"Compiling instructions, {pprint.pformat(roots)}")
+
+        # 0. Press ~ out of roots
+        pressed_roots = {_.replace("~", "") for _ in roots}
+        _log.debug(f"Pressed roots: {pressed_roots}")
+
+        # 1. compile all instructions with dummy references
+        for root in roots:
+            for instruction in roots[root]:
+                dummy_args = []
+                Inst = self.instructions[instruction["name"]]
+
+                for i in range(len(instruction["arguments"])):
+                    flags = list(Inst.arguments.values())[i]
+                    arg = instruction["arguments"][i]
+
+                    if flags & UNCHECKED:
+                        _log.debug(f"Dummy: Skipping unchecked argument '{arg}'.")
+                        dummy_args.append(arg)
+                        continue
+
+                    if arg in pressed_roots:
+                        _log.debug(f"Dummy: Replacing {arg} with 0")
+                        dummy_args.append(0)
+                        continue
+
+                    if isinstance(arg, int):
+                        _log.debug(f"Dummy: parsed integer argument '{arg}'.")
+                        dummy_args.append(arg)
+                        continue
+
+                    if isinstance(arg, RegisterRef):
+                        _log.debug(f"Dummy: parsed register reference argument '{arg}'.")
+                        dummy_args.append(arg.value)
+                        continue
+
+                    if arg is None:
+                        _log.warning("Dummy: Found None argument.")
+
+                instruction["length"] = len(Inst.compile(*dummy_args))
+
+        if debug:
+            _log.debug(f"Roots after dummy compile: {pprint.pformat(roots)}")
+
+        # 2. Figure out final location of all roots
+        indexed_roots = {}
+        pointer = 0
+
+        for root in roots:
+            if root.replace("~", "") in indexed_roots:
+                _log.debug(
+                    f"Skipping root {root} as it is already indexed under {root.replace('~', '')}."
+                )
+            else:
+                indexed_roots[root.replace("~", "")] = pointer
 
-        # Insert 'start' root if no roots are defined yet
-        if current_root is None and enforce_start:
-            _log.warning("Instruction found without a root. inserting 'start' root.")
-            roots["start"] = []
-            current_root = "start"
+            pointer += sum(instruction["length"] for instruction in roots[root])
 
-        elif current_root is None:
-            _log.critical(
-                f"No roots found, included files cannot have unrooted instructions. Exiting."
-            )
-            raise SystemExit
+        if debug:
+            _log.debug(f"Indexed roots: {pprint.pformat(indexed_roots)}")
 
-        # Handle instructions
-        if token in Instructions:
-            # break out of subroot
-            if in_subroot is not None:
-                _log.debug(f"leaving subroot '{current_root}' for root '{in_subroot}'")
-                current_root = in_subroot + "~"
-                roots[current_root] = []
-                in_subroot = None
+        # 3. Compile all instructions with final references
+        output = []
 
-            _log.debug(f"Read as instruction: {token}")
-            # If the last instruction does not have at-least the required number of arguments
-            if (
-                    roots[current_root]
-                    and len(roots[current_root][-1]["arguments"])
-                    < Instructions[roots[current_root][-1]["name"]].required_arguments
-            ):
-                _log.critical(
-                    f"Found instruction '{token}' before the required arguments of the previous instruction were filled. Exiting."
-                )
+        for root in roots:
+            for instruction in roots[root]:
+                Inst = self.instructions[instruction["name"]]
+                args = instruction["arguments"]
 
-                print_debug(roots[current_root][-1])
+                for i in range(len(args)):
+                    _log.debug(
+                        f"Checking argument {i} ({args[i]}) of instruction '{root}: {instruction['name']}'."
+                    )
 
-                raise SystemExit
+                    if isinstance(args[i], RegisterRef):
+                        args[i] = args[i].value
+                        continue
 
-            roots[current_root].append(
-                {
-                    "type": "instruction",
-                    "name": token,
-                    "arguments": [],
-                    "line": line,
-                    "originates_from": code_location,
-                }
-            )
-            continue
+                    if args[i] in pressed_roots:
+                        _log.debug(f"Replacing {args[i]} with {indexed_roots[args[i]]}")
+                        args[i] = indexed_roots[args[i]]
+                        continue
 
-        # Everything else will be a generic token, treat all as arguments
-        elif not roots[current_root]:
-            _log.error(
-                f"Found token '{token}' before any applicable instruction. Ignoring."
-            )
-            continue
+                    if isinstance(args[i], int):
+                        continue
 
-        # if the last instruction is full
-        if (
-                len(roots[current_root][-1]["arguments"])
-                == Instructions[roots[current_root][-1]["name"]].total_arguments
-        ):
-            _log.error(
-                f"Found token '{token}' before new applicable instruction. Ignoring."
-            )
-            continue
+                    if list(Inst.arguments.values())[i] & UNCHECKED:
+                        continue
 
-        roots[current_root][-1]["arguments"].append(token)
+                    _log.critical(
+                        f"Unknown argument type '{args[i]}', Something is very wrong... Exiting."
+                    )
+                    raise SystemExit
 
-    return roots, imported
+                _log.debug(
+                    f"Compiling {root}: {instruction['name']} with arguments {args}."
+                )
 
+                output += Inst.compile(*args)
+                instruction["compiled"] = output[-instruction["length"]:]
 
-def rooted_instructions_pre_computer(
-        roots: RootedInstructionsStruct, imported, project_path, path
-) -> tuple[RootedInstructionsStruct, set[pathlib.Path]]:
-    _log = logging.getLogger("PreComputer")
-    _log.debug("Starting precomputer")
+        return output, roots
 
-    new_roots = OrderedDict()
+    def full_stack_load_compile(
+            self,
+            project_root: pathlib.Path,
+            code_location: pathlib.Path,
+    ) -> tuple[list[str], RootedInstructionsStruct, set[pathlib.Path]]:
+        with open(code_location) as file:
+            code = file.read()
 
-    for root in roots:
-        new_roots[root] = []
+        # nothing from the last build (e.g. its -alias lines) leaks into this one
+        self.reset()
 
-        for i, instruction in enumerate(roots[root]):
-            if "precompute_compile" in Instructions[instruction["name"]].__dict__:
-                _log.debug(f"Found precompute for instruction '{instruction}'")
+        self._cic_log.clear()
+        self._cic_replay.clear()
+        self._include_files.clear()
 
-                temp_rel_name = f"PC|{root}[{instruction['line']}]{instruction['name']}"
-                indentation = len(
-                    max(
-                        [_ for _ in roots if _.startswith(root)],
-                        key=lambda x: x.count("~"),
-                    )
-                )
-                new_root_name = f"{root}{'~' * indentation}"
+        source = source_ascii_only(code)
 
-                temp_precomputed: str = Instructions[
-                    instruction["name"]
-                ].precompute_compile(
-                    *instruction["arguments"],
-                    _root=new_root_name.replace("~", "").replace(".", ""),
-                )
+        token_stream = char_stream_tokenize(source)
+        token_stream = self.token_stream_alias_replacer(token_stream)
+        token_stream = self.token_stream_cic_executor(token_stream, project_root, code_location)
 
-                temp_precomputed = temp_precomputed.replace("~insert", new_root_name)
+        rooted_instructions, imports = self.token_stream_instruction_press(
+            token_stream, project_root, code_location
+        )
+        rooted_instructions, imports = self.rooted_instructions_pre_computer(
+            rooted_instructions, imports, project_root, code_location
+        )
 
-                _log.debug(temp_precomputed)
+        rooted_instructions = rooted_instructions_rearranger(rooted_instructions)
+        rooted_instructions = self.rooted_instructions_argument_parser(rooted_instructions)
 
-                temp_char_stream = create_char_stream(temp_precomputed)
-                temp_char_stream = char_stream_ascii_only(
-                    temp_char_stream, _log_name=f"{temp_rel_name}.AsciiOnly"
-                )
-                temp_token_stream = char_stream_tokenize(
-                    temp_char_stream, _log_name=f"{temp_rel_name}.Tokenizer"
-                )
-                temp_token_stream = token_stream_alias_replacer(
-                    temp_token_stream, _log_name=f"{temp_rel_name}.AliasReplace"
-                )
-                temp_token_stream = token_stream_cic_executor(
-                    temp_token_stream,
-                    project_path,
-                    path,
-                    _log_name=f"{temp_rel_name}.CICExecutor",
-                )
+        compiled, roots = self.rooted_instructions_compiler(rooted_instructions)
 
-                _log.debug(f"Executing from {path}.{temp_rel_name}")
-                temp_roots, temp_imported = token_stream_instruction_press(
-                    temp_token_stream,
-                    project_path,
-                    code_location=path,
-                    enforce_start=False,
-                    imported=imported,
-                    _log_name=f"{temp_rel_name}.InstructionPress",
-                )
-                temp_roots, temp_imported = rooted_instructions_pre_computer(
-                    temp_roots, temp_imported, project_path, path
-                )
-                _log.debug(f"Returned from {path}.{temp_rel_name}")
+        return compiled, roots, imports
 
-                imported.update(temp_imported)
 
-                for temp_root in temp_roots:
-                    if temp_root in roots:
-                        _log.critical(
-                            f"Found precomputed root '{temp_root}' that already exists. Exiting."
-                        )
-                        raise SystemExit
+# the assembler behind the module level names below, kept for scripts
+# written before Assembler (e.g. tester.py). they all share its state, use
+# an Assembler of your own for builds that should not
+_default_assembler = Assembler()
 
-                    if temp_root.split(".")[0] == "~insert":
-                        _log.debug(
-                            f"Inserting precomputed instructions into root '{root}'"
-                        )
-                        new_roots[root].extend(temp_roots[temp_root])
+Instructions = _default_assembler.instructions
+aliases = _default_assembler.aliases
+python_in_scp_scopes = _default_assembler.python_in_scp_scopes
 
-                        continue
 
-                    _log.debug(f"Adding precomputed instructions as root '{temp_root}'")
-                    new_roots[temp_root] = temp_roots[temp_root]
+def reset_state():
+    """
+    Forgets the instructions, aliases and CIC scopes left over from previous
+    builds, full_stack_load_compile does this before every build.
+    """
+    _default_assembler.reset()
 
-            else:
-                new_roots[root].append(instruction)
 
-    return new_roots, imported
+def full_stack_load_compile(
+        project_root: pathlib.Path,
+        code_location: pathlib.Path,
+) -> tuple[list[str], RootedInstructionsStruct, set[pathlib.Path]]:
+    return _default_assembler.full_stack_load_compile(project_root, code_location)
 
 
 def rooted_instructions_rearranger(
@@ -1143,185 +1654,18 @@ def parse_argument(argument, flags, roots):
     raise SystemExit
 
 
-def rooted_instructions_argument_parser(
-        roots: RootedInstructionsStruct,
-) -> RootedInstructionsStruct:
+def root_addresses(roots: RootedInstructionsStruct, memory_offset: int = 0) -> dict[str, int]:
     """
-    Verify that all references are valid.
-    Verify all arguments are correct types (converting where necessary).
+    Address of every root (by its pressed name) in the compiled output.
     """
-    _log = logging.getLogger("ArgumentParser")
-
-    pressed_roots = {_.replace("~", "") for _ in roots.keys()}
-
-    for root in roots:
-        for instruction in roots[root]:
-            # leave original arguments for decompiling
-            instruction["original"] = instruction["arguments"].copy()
-
-            if instruction["type"] == "instruction":
-                name = instruction["name"]
-                arguments = instruction["arguments"]
-                org = instruction.copy()
-                instruction = Instructions[name]
-
-                for i in range(instruction.total_arguments):
-                    instruction_flags = list(instruction.arguments.values())[i]
-
-                    if instruction_flags & REQUIRED and i >= len(arguments):
-                        _log.critical(
-                            f"Instruction '{name}' requires at least {instruction.required_arguments} arguments. Exiting."
-                        )
-
-                        print_debug(org)
-                        raise SystemExit
-
-                    if i >= len(arguments):
-                        continue
-
-                    dynam = parse_dynamic_token(arguments[i])
-
-                    arguments[i] = parse_argument(
-                        dynam, instruction_flags, pressed_roots
-                    )
-
-    return roots
-
-
-def rooted_instructions_compiler(
-        roots: RootedInstructionsStruct,
-) -> tuple[list[str], RootedInstructionsStruct]:
-    _log = logging.getLogger("Compiler")
-
-    _log.debug(f"Compiling instructions, {pprint.pformat(roots)}")
-
-    # 0. Press ~ out of roots
-    pressed_roots = {_.replace("~", "") for _ in roots}
-    _log.debug(f"Pressed roots: {pressed_roots}")
-
-    # 1. compile all instructions with dummy references
-    for root in roots:
-        for instruction in roots[root]:
-            dummy_args = []
-            Inst = Instructions[instruction["name"]]
-
-            for i in range(len(instruction["arguments"])):
-                flags = list(Inst.arguments.values())[i]
-                arg = instruction["arguments"][i]
-
-                if flags & UNCHECKED:
-                    _log.debug(f"Dummy: Skipping unchecked argument '{arg}'.")
-                    dummy_args.append(arg)
-                    continue
-
-                if arg in pressed_roots:
-                    _log.debug(f"Dummy: Replacing {arg} with 0")
-                    dummy_args.append(0)
-                    continue
-
-                if isinstance(arg, int):
-                    _log.debug(f"Dummy: parsed integer argument '{arg}'.")
-                    dummy_args.append(arg)
-                    continue
-
-                if isinstance(arg, RegisterRef):
-                    _log.debug(f"Dummy: parsed register reference argument '{arg}'.")
-                    dummy_args.append(arg.value)
-                    continue
-
-                if arg is None:
-                    _log.warning("Dummy: Found None argument.")
-
-            instruction["length"] = len(Inst.compile(*dummy_args))
-
-    _log.debug(f"Roots after dummy compile: {pprint.pformat(roots)}")
-
-    # 2. Figure out final location of all roots
-    indexed_roots = {}
-    pointer = 0
-
-    for root in roots:
-        if root.replace("~", "") in indexed_roots:
-            _log.debug(
-                f"Skipping root {root} as it is already indexed under {root.replace('~', '')}."
-            )
-        else:
-            indexed_roots[root.replace("~", "")] = pointer
-
-        pointer += sum(instruction["length"] for instruction in roots[root])
-
-    _log.debug(f"Indexed roots: {pprint.pformat(indexed_roots)}")
-
-    # 3. Compile all instructions with final references
-    output = []
+    addresses = {}
+    pointer = memory_offset
 
     for root in roots:
-        for instruction in roots[root]:
-            Inst = Instructions[instruction["name"]]
-            args = instruction["arguments"]
-
-            for i in range(len(args)):
-                _log.debug(
-                    f"Checking argument {i} ({args[i]}) of instruction '{root}: {instruction['name']}'."
-                )
-
-                if isinstance(args[i], RegisterRef):
-                    args[i] = args[i].value
-                    continue
-
-                if args[i] in pressed_roots:
-                    _log.debug(f"Replacing {args[i]} with {indexed_roots[args[i]]}")
-                    args[i] = indexed_roots[args[i]]
-                    continue
-
-                if isinstance(args[i], int):
-                    continue
-
-                if list(Inst.arguments.values())[i] & UNCHECKED:
-                    continue
-
-                _log.critical(
-                    f"Unknown argument type '{args[i]}', Something is very wrong... Exiting."
-                )
-                raise SystemExit
-
-            _log.debug(
-                f"Compiling {root}: {instruction['name']} with arguments {args}."
-            )
-
-            output += Inst.compile(*args)
-            instruction["compiled"] = output[-instruction["length"]:]
-
-    return output, roots
-
-
-def full_stack_load_compile(
-        project_root: pathlib.Path,
-        code_location: pathlib.Path,
-) -> tuple[list[str], RootedInstructionsStruct, set[pathlib.Path]]:
-    with open(code_location) as file:
-        code = file.read()
-
-    char_stream = create_char_stream(code)
-    char_stream = char_stream_ascii_only(char_stream)
+        addresses.setdefault(root.replace("~", ""), pointer)
+        pointer += sum(len(instruction["compiled"]) for instruction in roots[root])
 
-    token_stream = char_stream_tokenize(char_stream)
-    token_stream = token_stream_alias_replacer(token_stream)
-    token_stream = token_stream_cic_executor(token_stream, project_root, code_location)
-
-    rooted_instructions, imports = token_stream_instruction_press(
-        token_stream, project_root, code_location
-    )
-    rooted_instructions, imports = rooted_instructions_pre_computer(
-        rooted_instructions, imports, project_root, code_location
-    )
-
-    rooted_instructions = rooted_instructions_rearranger(rooted_instructions)
-    rooted_instructions = rooted_instructions_argument_parser(rooted_instructions)
-
-    compiled, roots = rooted_instructions_compiler(rooted_instructions)
-
-    return compiled, roots, imports
+    return addresses
 
 
 def assemble_asc(stream: list[str], memory_offset: int) -> str:
@@ -1546,9 +1890,10 @@ def generate_dec(
         # This could cause bugs later but 99% you would never not want to jump to the first instance
         _log.debug(f"Found pressed root '{k}' in root mappings.")
 
-    _log.debug(pprint.pformat(pressed_root_mappings))
-    _log.debug(pprint.pformat(root_mappings))
-    _log.debug(pprint.pformat(roots))
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug(pprint.pformat(pressed_root_mappings))
+        _log.debug(pprint.pformat(root_mappings))
+        _log.debug(pprint.pformat(roots))
 
     iroot = iter(roots.keys())
 
@@ -1586,8 +1931,9 @@ def generate_dec(
 
         pressed_root_mappings[root.replace("~", "")] = root_mappings[root]
 
-    _log.debug(pprint.pformat(root_mappings))
-    _log.debug(pprint.pformat(pressed_root_mappings))
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug(pprint.pformat(root_mappings))
+        _log.debug(pprint.pformat(pressed_root_mappings))
 
     output = ""
     for root in roots:
@@ -1706,9 +2052,11 @@ def genderate_debug(
         imports: set[pathlib.Path],
         project_root: pathlib.Path,
         project_path: pathlib.Path,
+        cycle_table: Union[None, CycleTable] = None,
 ) -> str:
     """
-    Will output similar to the dec but with Line numbers and compiled version
+    Will output similar to the dec but with Line numbers and compiled version,
+    plus the cycles of every instruction and best/worst case cycles per root
     """
 
     def int_hex(i: any) -> str:
@@ -1720,150 +2068,294 @@ def genderate_debug(
 
     time.sleep(0.3)
 
-    output = ""
+    compiled = [word for root in roots for instruction in roots[root] for word in instruction["compiled"]]
+    estimates, analysis = timing.analyse(compiled, roots, cycle_table)
+    names = {}
+    for name, address in root_addresses(roots).items():
+        names.setdefault(address, name)
+
+    def cycles(address: int) -> str:
+        if address in analysis.data:
+            return ""
+        return str(analysis.table.instruction(int(compiled[address], 16)))
+
+    output = f"     |      | {'':29} | {'':25} | cycles |    best |   worst\n"
     pointer = 0
+    shown = set()
 
     for root in roots:
         inst = f"{root.replace('~', '')}:"
-        output += f"     |      | {inst:29} | \n"
+        best, worst = "", ""
+
+        if inst[:-1] in estimates and inst[:-1] not in shown:
+            shown.add(inst[:-1])
+            best = timing.format_cycles(estimates[inst[:-1]].best)
+            worst = timing.format_cycles(estimates[inst[:-1]].worst)
+
+        output += f"     |      | {inst:29} | {'':25} | {'':6} | {best:>7} | {worst:>7}\n"
 
         for instruction in roots[root]:
             inst = f"{instruction['name']:6} {' '.join(map(int_hex, instruction['arguments']))}"
             orig_inst = (
                 f"{instruction['name']:6} {' '.join(map(str, instruction['original']))}"
             )
-            output += f"{pointer:04x} | {instruction['compiled'][0]} |     {orig_inst:25} | {inst}\n"
+            output += f"{pointer:04x} | {instruction['compiled'][0]} |     {orig_inst:25} | {inst:25} | {cycles(pointer):>6} |\n"
             pointer += 1
 
             for out in instruction["compiled"][1:]:
-                output += f"{pointer:04x} | {out} | {'':29} | \n"
+                output += f"{pointer:04x} | {out} | {'':29} | {'':25} | {cycles(pointer):>6} |\n"
                 pointer += 1
 
+    output += f"\nCycles at {analysis.table.clock_hz / 1e6:g} MHz, best and worst case from each root until it returns or halts\n"
+
+    if analysis.loops:
+        output += "\nLoops:\n"
+
+    for header, loop in sorted(analysis.loops.items()):
+        bound = "unbounded"
+        if loop.bound is not None:
+            times = loop.bound[0] if loop.bound[0] == loop.bound[1] else f"{loop.bound[0]}-{loop.bound[1]}"
+            bound = f"{times} times ({loop.source})"
+
+        output += (
+            f"{header:04x} {names.get(header, ''):20} {bound:24}"
+            f" {timing.format_cycles(loop.iteration[0])}-{timing.format_cycles(loop.iteration[1])} cycles per iteration,"
+            f" {timing.format_cycles(loop.total[0])}-{timing.format_cycles(loop.total[1])} total\n"
+        )
+
+    if analysis.calls:
+        output += "\nCall targets:\n"
+
+    for target, estimate in sorted(analysis.calls.items()):
+        output += (
+            f"{target:04x} {names.get(target, ''):20}"
+            f" {timing.format_cycles(estimate.best)}-{timing.format_cycles(estimate.worst)} cycles\n"
+        )
+
+    if any(estimate.notes for estimate in estimates.values()):
+        output += "\nNotes:\n"
+
+    for name, estimate in estimates.items():
+        for note in estimate.notes:
+            output += f"{name}: {note}\n"
+
     return output
 
 
-def generate_cli(
+# file suffix for every output kind
+OUTPUT_SUFFIXES = {
+    "asc": ".asc",
+    "dat": ".dat",
+    "mem": ".mem",
+    "mif": ".mif",
+    "dec": ".dec.asm",
+    "deb": ".debug",
+}
+
+
+def generate_outputs(
+        wanted: Iterable[str],
+        compiled: list[str],
+        roots: RootedInstructionsStruct,
+        imports: set[pathlib.Path],
+        project_path: pathlib.Path,
         file_path: pathlib.Path,
-        asc: Union[None, str],
-        dat: Union[None, str],
-        mem: Union[None, str],
-        mif: Union[None, str],
-        dec: Union[None, str],
-        deb: Union[None, str],
+        address_offset: int = 0,
+        cycle_table: Union[None, CycleTable] = None,
+) -> dict[str, str]:
+    """
+    The text of every wanted output kind (see OUTPUT_SUFFIXES) of a build
+    """
+    assembled = assemble_asc(compiled, address_offset)
+
+    generators = {
+        "asc": lambda: assembled,
+        "dat": lambda: generate_dat(assembled, address_offset),
+        "mem": lambda: generate_mem(assembled, address_offset),
+        "mif": lambda: generate_mif(assembled, address_offset),
+        "dec": lambda: generate_dec(roots, imports, project_path, file_path),
+        "deb": lambda: genderate_debug(roots, imports, project_path, file_path, cycle_table),
+    }
+
+    return {kind: generators[kind]() for kind in wanted}
+
+
+def build_outputs(
+        assembler: Assembler,
+        file_path: pathlib.Path,
+        names: dict[str, str],
         address_offset: int = 0,
         project_path: Union[None, pathlib.Path] = None,
-):
+        cycle_table: Union[None, CycleTable] = None,
+        cache_folder: Union[None, pathlib.Path] = None,
+) -> tuple[dict[str, str], list[pathlib.Path]]:
+    """
+    The text of every wanted output kind and every file the build read,
+    from the build cache if it has them
+    """
     _log = logging.getLogger("CLI")
 
-    if project_path is None:
-        project_path = file_path.parent
+    if cache_folder is not None:
+        key = build_cache.build_key(file_path, project_path, address_offset, cycle_table)
+        cached = build_cache.lookup(cache_folder, key, names)
 
-    compiled, roots, imports = full_stack_load_compile(project_path, file_path)
+        if cached is not None:
+            return cached["outputs"], list(map(pathlib.Path, cached["files"]))
 
-    assembled = assemble_asc(compiled, address_offset)
+    compiled, roots, imports = assembler.full_stack_load_compile(project_path, file_path)
 
     _log.info(f"Total assembly size: {len(compiled)}")
 
-    if asc is not None:
-        path = pathlib.Path(asc + ".asc").resolve()
+    outputs = generate_outputs(
+        names, compiled, roots, imports, project_path, file_path, address_offset, cycle_table
+    )
+    files = build_cache.dependencies(file_path, imports)
 
-        try:
-            with open(path, "w") as f:
-                f.write(assembled)
-        except FileNotFoundError:
-            _log.critical(f"Could not write to {path}. Exiting.")
-            raise SystemExit
+    if cache_folder is not None:
+        build_cache.store(cache_folder, key, files, outputs)
 
-        _log.info(f"Generated .asc file at {path}")
-
-        # gen_high_asc = generate_high_asc(assembled)
-        # path = pathlib.Path(asc + "_high_byte.asc").resolve()
-        #
-        # try:
-        #     with open(path, "w") as f:
-        #         f.write(gen_high_asc)
-        # except FileNotFoundError:
-        #     _log.critical(f"Could not write to {path}. Exiting.")
-        #     raise SystemExit
-        #
-        # _log.info(f"Generated .asc file at {path}")
-        #
-        # gen_low_asc = generate_low_asc(assembled)
-        # path = pathlib.Path(asc + "_low_byte.asc").resolve()
-        #
-        # try:
-        #     with open(path, "w") as f:
-        #         f.write(gen_low_asc)
-        # except FileNotFoundError:
-        #     _log.critical(f"Could not write to {path}. Exiting.")
-        #     raise SystemExit
-        #
-        # _log.info(f"Generated .asc file at {path}")
-
-    if dat is not None:
-        gen_dat = generate_dat(assembled, address_offset)
-        path = pathlib.Path(dat + ".dat").resolve()
+    return outputs, list(map(pathlib.Path, files))
 
-        try:
-            with open(path, "w") as f:
-                f.write(gen_dat)
-        except FileNotFoundError:
-            _log.critical(f"Could not write to {path}. Exiting.")
-            raise SystemExit
 
-        _log.info(f"Generated .dat file at {path}")
+# seconds between checking the watched files for changes
+WATCH_INTERVAL = 0.2
 
-    if mem is not None:
-        gen_mem = generate_mem(assembled, address_offset)
-        path = pathlib.Path(mem + ".mem").resolve()
 
-        try:
-            with open(path, "w") as f:
-                f.write(gen_mem)
-        except FileNotFoundError:
-            _log.critical(f"Could not write to {path}. Exiting.")
-            raise SystemExit
+def _stamp(path: pathlib.Path) -> Union[None, tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def watch_cli(
+        assembler: Assembler,
+        file_path: pathlib.Path,
+        names: dict[str, str],
+        address_offset: int = 0,
+        project_path: Union[None, pathlib.Path] = None,
+        cycle_table: Union[None, CycleTable] = None,
+        cache_folder: Union[None, pathlib.Path] = None,
+        interval: float = WATCH_INTERVAL,
+):
+    """
+    Assembles the program, then again every time the input or a file it
+    includes or loads instructions from changes, until interrupted. Files
+    are only checked by modification time and size, a file saved without
+    changing its content does not reassemble.
+
+    The process stays warm between builds, so compiled CIC and the pressed
+    roots of unchanged included files are reused (see Assembler.load_include).
+    """
+    _log = logging.getLogger("Watch")
 
-        _log.info(f"Generated .mem file at {path}")
+    files = [file_path]
+    changed = []
 
-    if mif is not None:
-        gen_mif = generate_mif(assembled, address_offset)
-        path = pathlib.Path(mif + ".mif").resolve()
+    while True:
+        started = time.time_ns()
+        start = time.perf_counter()
 
         try:
-            with open(path, "w") as f:
-                f.write(gen_mif)
-        except FileNotFoundError:
-            _log.critical(f"Could not write to {path}. Exiting.")
-            raise SystemExit
+            outputs, files = build_outputs(
+                assembler, file_path, names, address_offset, project_path, cycle_table, cache_folder
+            )
+
+        except (SystemExit, Exception) as e:
+            if not isinstance(e, SystemExit):
+                _log.error(f"{type(e).__name__}: {e}")
+
+            # the files read before failing are unknown, keep the last ones
+            files = list({file_path, *files})
+
+            print(f"Assembling {file_path.name} failed, waiting for changes.")
+
+        else:
+            for kind, name in names.items():
+                build_cache.write_atomic(
+                    pathlib.Path(name + OUTPUT_SUFFIXES[kind]).resolve(),
+                    outputs[kind].encode(),
+                )
+
+            because = f" ({', '.join(_.name for _ in changed)} changed)" if changed else ""
+            print(
+                f"Assembled {file_path.name} in {(time.perf_counter() - start) * 1000:.0f} ms{because}."
+            )
+
+        digests = {path: _source_digest(path) for path in files}
+        stamps = {path: _stamp(path) for path in files}
+
+        # saved while assembling
+        changed = [
+            path for path, stamp in stamps.items() if stamp is not None and stamp[0] >= started
+        ]
+
+        while not changed:
+            time.sleep(interval)
+
+            for path in files:
+                stamp = _stamp(path)
+
+                if stamp == stamps[path]:
+                    continue
+
+                stamps[path] = stamp
+
+                if _source_digest(path) != digests[path]:
+                    changed.append(path)
+
+
+def generate_cli(
+        file_path: pathlib.Path,
+        asc: Union[None, str],
+        dat: Union[None, str],
+        mem: Union[None, str],
+        mif: Union[None, str],
+        dec: Union[None, str],
+        deb: Union[None, str],
+        address_offset: int = 0,
+        project_path: Union[None, pathlib.Path] = None,
+        cycle_table: Union[None, CycleTable] = None,
+        cache_folder: Union[None, pathlib.Path] = None,
+        watch: bool = False,
+):
+    _log = logging.getLogger("CLI")
+
+    if project_path is None:
+        project_path = file_path.parent
 
-        _log.info(f"Generated .mif file at {path}")
+    names = {"asc": asc, "dat": dat, "mem": mem, "mif": mif, "dec": dec, "deb": deb}
+    names = {kind: name for kind, name in names.items() if name is not None}
 
-    if dec is not None:
-        dec_gen = generate_dec(roots, imports, project_path, file_path)
-        path = pathlib.Path(dec + ".dec.asm").resolve()
+    assembler = Assembler(None if cache_folder is None else cache_folder / "cic")
 
+    if watch:
         try:
-            with open(path, "w") as f:
-                f.write(dec_gen)
-        except FileNotFoundError:
-            _log.critical(f"Could not write to {path}. Exiting.")
-            raise SystemExit
+            watch_cli(
+                assembler, file_path, names, address_offset, project_path, cycle_table, cache_folder
+            )
+        except KeyboardInterrupt:
+            pass
+
+        return
 
-        _log.info(f"Generated .dec.asm file at {path}")
+    outputs, _ = build_outputs(
+        assembler, file_path, names, address_offset, project_path, cycle_table, cache_folder
+    )
 
-    if deb is not None:
-        gen_deb = genderate_debug(roots, imports, project_path, file_path)
-        path = pathlib.Path(deb + ".debug").resolve()
+    for kind, name in names.items():
+        path = pathlib.Path(name + OUTPUT_SUFFIXES[kind]).resolve()
 
         try:
             with open(path, "w") as f:
-                f.write(gen_deb)
+                f.write(outputs[kind])
         except FileNotFoundError:
             _log.critical(f"Could not write to {path}. Exiting.")
             raise SystemExit
 
-        _log.info(f"Generated .debug file at {path}")
+        _log.info(f"Generated {OUTPUT_SUFFIXES[kind]} file at {path}")
 
 
 def main():
@@ -1874,7 +2366,7 @@ def main():
 
     args = sys.argv[1:]
 
-    options = "hi:A:a:d:m:f:o:D:R:-v-VP:"
+    options = "hi:A:a:d:m:f:o:D:R:-v-VP:C:c:w"
     long_options = [
         "help",
         "input",  # input file
@@ -1889,6 +2381,9 @@ def main():
         "Root",  # project root (if you're initial file is not compiling from the project root)
         "verbose",
         "super_verbose",
+        "Cycle_table",
+        "cache",
+        "watch",
     ]
 
     args, _ = getopt.getopt(args, options, long_options)
@@ -1898,6 +2393,9 @@ def main():
     address_offset = 0
     log_level = logging.WARNING
     file_path = None
+    cycle_table = None
+    cache_folder = None
+    watch = False
 
     for arg, val in args:
         if arg in ("-h", "--help"):
@@ -1954,6 +2452,19 @@ def main():
         if arg in ("-P", "--debug_output"):
             deb = val
 
+        if arg in ("-C", "--Cycle_table"):
+            try:
+                cycle_table = CycleTable.load(val)
+            except (OSError, ValueError, TypeError) as e:
+                _log.critical(f"Could not load cycle table {val}, {e}. Exiting.")
+                raise SystemExit
+
+        if arg in ("-c", "--cache"):
+            cache_folder = pathlib.Path(val).resolve()
+
+        if arg in ("-w", "--watch"):
+            watch = True
+
     if not file_path:
         _log.critical("No input file found. Exiting.")
         raise SystemExit
@@ -1965,7 +2476,18 @@ def main():
         raise SystemExit
 
     return generate_cli(
-        file_path, asc, dat, mem, mif, dec, deb, address_offset, project_path
+        file_path,
+        asc,
+        dat,
+        mem,
+        mif,
+        dec,
+        deb,
+        address_offset,
+        project_path,
+        cycle_table,
+        cache_folder,
+        watch,
     )
 
 
@@ -0,0 +1,306 @@
+# Keeps the assembler warm for other programs.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+import getopt
+import json
+import logging
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+
+from typing import *
+
+import assembler
+import source_coverage
+from cycles import CycleTable
+
+__doc__ = """
+Runs one assembler process that assembles programs for editors, the
+emulator (see assembler_server in the emulator settings) and scripts over a
+local socket, so they don't pay for starting python and a cold assembler
+every build. Loaded instruction sets, included files and compiled CIC are
+kept between requests, and requests from different clients are assembled at
+the same time.
+
+Usage:
+
+assembler_server.py -p <port>         localhost port to listen on (default: 7467)
+                    -u <path>         listen on a unix socket at 'path' instead
+                    -v <verbose>
+
+Requests and responses are one line of JSON each, a connection can send any
+number of requests one after the other:
+
+{"file": "examples/pong.scp",         file to assemble
+ "root": "examples",                  project root (default: the file's folder)
+ "offset": 0,                         address offset (assembler.py -A)
+ "outputs": ["asc", "deb"],           output files to make, any of asc dat mem mif dec deb
+ "cycle_table": "cycles.json"}        cycle table for the deb output (assembler.py -C)
+
+{"ok": true,
+ "seconds": 0.012,
+ "words": ["0001", ...],              the compiled program, from the offset
+ "roots": {"start": 0, ...},          address of every root
+ "lines": [{"address": 0, "length": 1, "file": "...", "line": 4, "root": "start", "data": false}, ...],
+ "imports": ["/.../lib.scp", ...],    files included or loaded with -language
+ "outputs": {"asc": "...", ...},      text of every wanted output
+ "log": [{"level": "WARNING", "logger": "InstructionPress", "message": "..."}, ...]}
+
+A failed build answers {"ok": false, "error": "...", "log": [...]}. Paths
+are relative to the server's working folder.
+"""
+
+DEFAULT_PORT = 7467
+
+
+class _LogCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+        # other requests are logging at the same time
+        self.thread = threading.get_ident()
+
+    def emit(self, record):
+        if record.thread != self.thread:
+            return
+
+        self.records.append(
+            {"level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        )
+
+
+def assemble(request: dict, assembler_: Union[None, assembler.Assembler] = None) -> dict:
+    """
+    Runs one assemble request (see __doc__) with 'assembler_', or a new
+    Assembler if None. An Assembler only runs one request at a time.
+    """
+    if assembler_ is None:
+        assembler_ = assembler.Assembler()
+
+    collector = _LogCollector()
+    logging.getLogger().addHandler(collector)
+
+    start = time.perf_counter()
+
+    try:
+        file_path = pathlib.Path(request["file"]).resolve()
+        project_path = pathlib.Path(request.get("root", file_path.parent)).resolve()
+        offset = request.get("offset", 0)
+        wanted = request.get("outputs", [])
+
+        unknown = set(wanted) - assembler.OUTPUT_SUFFIXES.keys()
+        if unknown:
+            raise ValueError(f"Unknown output kind '{unknown.pop()}'")
+
+        cycle_table = None
+        if request.get("cycle_table") is not None:
+            cycle_table = CycleTable.load(request["cycle_table"])
+
+        compiled, roots, imports = assembler_.full_stack_load_compile(project_path, file_path)
+
+        outputs = assembler.generate_outputs(
+            wanted, compiled, roots, imports, project_path, file_path, offset, cycle_table
+        )
+
+    except SystemExit:
+        return {
+            "ok": False,
+            "seconds": time.perf_counter() - start,
+            "error": next(
+                (r["message"] for r in reversed(collector.records) if r["level"] == "CRITICAL"),
+                "Assembler exited",
+            ),
+            "log": collector.records,
+        }
+
+    except Exception as e:
+        # CIC errors, bad requests
+        return {
+            "ok": False,
+            "seconds": time.perf_counter() - start,
+            "error": f"{type(e).__name__}: {e}",
+            "log": collector.records,
+        }
+
+    finally:
+        logging.getLogger().removeHandler(collector)
+
+    return {
+        "ok": True,
+        "seconds": time.perf_counter() - start,
+        "words": compiled,
+        "roots": assembler.root_addresses(roots, offset),
+        "lines": [_._asdict() for _ in source_coverage.line_map(roots, offset)],
+        "imports": sorted(str(_) for _ in imports),
+        "outputs": outputs,
+        "log": collector.records,
+    }
+
+
+class AssemblerServer:
+    def __init__(self, address: Union[int, str] = DEFAULT_PORT):
+        """
+        'address' is a localhost port, or the path of a unix socket
+        """
+        self.address = address
+
+        # idle assemblers, each request borrows one so the caches stay warm
+        # without two builds sharing one
+        self._assemblers: list[assembler.Assembler] = []
+        self._lock = threading.Lock()
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(address)
+
+        else:
+            self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._server.bind(("localhost", address))
+
+        self._server.listen(8)
+
+    def assemble(self, request: dict) -> dict:
+        with self._lock:
+            assembler_ = self._assemblers.pop() if self._assemblers else assembler.Assembler()
+
+        try:
+            return assemble(request, assembler_)
+        finally:
+            with self._lock:
+                self._assemblers.append(assembler_)
+
+    def handle(self, client: socket.socket):
+        _log = logging.getLogger("AssemblerServer")
+
+        try:
+            with client, client.makefile("rwb") as stream:
+                for line in stream:
+                    try:
+                        request = json.loads(line)
+
+                        if not isinstance(request, dict):
+                            raise ValueError("expected an object")
+
+                    except ValueError as e:
+                        response = {"ok": False, "error": f"Bad request, {e}", "log": []}
+
+                    else:
+                        response = self.assemble(request)
+
+                        if response["ok"]:
+                            _log.info(f"Assembled {request.get('file')} in {response['seconds'] * 1000:.0f} ms")
+                        else:
+                            _log.info(f"Assembling {request.get('file')} failed, {response['error']}")
+
+                    stream.write(json.dumps(response).encode() + b"\n")
+                    stream.flush()
+
+        except OSError as e:
+            _log.warning(f"Lost a client, {e}.")
+
+    def serve_forever(self):
+        try:
+            while True:
+                client, _ = self._server.accept()
+                threading.Thread(target=self.handle, args=(client,), daemon=True).start()
+
+        finally:
+            self._server.close()
+
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
+
+
+def request(message: dict, address: Union[int, str] = DEFAULT_PORT, timeout: Union[None, float] = None) -> dict:
+    """
+    Sends one request to a running server and returns its response, raises
+    OSError if there is no server
+    """
+    if isinstance(address, str):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = ("localhost", address)
+
+    client.settimeout(timeout)
+
+    with client:
+        client.connect(address)
+
+        with client.makefile("rwb") as stream:
+            stream.write(json.dumps(message).encode() + b"\n")
+            stream.flush()
+
+            line = stream.readline()
+
+    if not line:
+        raise ConnectionError("The assembler server closed the connection")
+
+    return json.loads(line)
+
+
+def parse_address(value: Union[int, str]) -> Union[int, str]:
+    """
+    A port ("7467", "localhost:7467") or a unix socket path
+    """
+    if isinstance(value, int):
+        return value
+
+    port = value.rpartition(":")[2]
+
+    return int(port) if port.isdigit() else value
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, _ = getopt.gnu_getopt(sys.argv[1:], "hp:u:v", ["help"])
+
+    address = DEFAULT_PORT
+    log_level = logging.WARNING
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-p":
+            address = int(val)
+
+        if arg == "-u":
+            if not hasattr(socket, "AF_UNIX"):
+                _log.critical("Unix sockets are not supported here, use -p. Exiting.")
+                raise SystemExit(1)
+
+            address = val
+
+        if arg == "-v":
+            log_level = logging.INFO
+
+    logging.basicConfig(level=log_level)
+
+    try:
+        server = AssemblerServer(address)
+    except OSError as e:
+        _log.critical(f"Could not listen on {address}, {e}. Exiting.")
+        raise SystemExit(1)
+
+    print(f"Assembler server listening on {address if isinstance(address, str) else f'localhost:{address}'}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# Persistent build cache for the assembler.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Keeps the outputs of assembler builds on disk so an unchanged program is
+never assembled twice (like ccache's direct mode).
+
+A build is looked up by a key over everything known before assembling: the
+assembler's own source, the python version, the input file, project root,
+address offset and cycle table. Which other files a build reads is only
+known after it, so every key keeps a list of builds, each with the hash of
+every file it read (the input, every -include and every -language file) and
+the outputs it made. A build is reused when all of its files still hash the
+same.
+
+Files read by CIC code itself (open(), imported python modules) are not
+tracked.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sys
+
+from typing import *
+
+_log = logging.getLogger("BuildCache")
+
+# bump when the stored format changes
+FORMAT = 1
+
+# builds kept per key, oldest are dropped
+KEEP = 8
+
+# the assembler's own files, a change to any of them changes every key
+TOOL_FILES = (
+    "assembler.py",
+    "build_cache.py",
+    "cycles.py",
+    "scp_instruction.py",
+    "standard_instructions.py",
+    "timing.py",
+)
+
+_tool_version: Union[None, str] = None
+
+
+def tool_version() -> str:
+    global _tool_version
+
+    if _tool_version is None:
+        digest = hashlib.sha256(f"{FORMAT}\0{sys.version}".encode())
+
+        for name in TOOL_FILES:
+            digest.update((pathlib.Path(__file__).parent / name).read_bytes())
+
+        _tool_version = digest.hexdigest()
+
+    return _tool_version
+
+
+def file_hash(path: pathlib.Path) -> Union[None, str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def build_key(
+        file_path: pathlib.Path,
+        project_path: pathlib.Path,
+        address_offset: int,
+        cycle_table=None,
+) -> str:
+    cycles = None if cycle_table is None else [cycle_table.cycles, cycle_table.clock_hz]
+
+    return hashlib.sha256(
+        json.dumps(
+            [tool_version(), str(file_path), str(project_path), address_offset, cycles]
+        ).encode()
+    ).hexdigest()
+
+
+def dependencies(file_path: pathlib.Path, imports: Iterable[pathlib.Path]) -> dict[str, str]:
+    """
+    Hash of the input and every file it included or loaded instructions from
+    """
+    # relative imports (the standard language) are part of the tool version
+    paths = {file_path} | {_ for _ in imports if _.is_absolute()}
+
+    return {str(path): file_hash(path) for path in sorted(paths)}
+
+
+def _builds_path(folder: pathlib.Path, key: str) -> pathlib.Path:
+    return folder / "builds" / f"{key}.json"
+
+
+def _load(folder: pathlib.Path, key: str) -> list[dict]:
+    try:
+        with open(_builds_path(folder, key), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def lookup(folder: pathlib.Path, key: str, wanted: Iterable[str]) -> Union[None, dict]:
+    """
+    A cached build whose files are all unchanged and that made every wanted
+    output, None if there is none. {"files": {path: hash}, "outputs": {kind
+    (e.g. "dat"): text}}
+    """
+    wanted = set(wanted)
+
+    for build in _load(folder, key):
+        if not wanted <= build["outputs"].keys():
+            continue
+
+        if all(file_hash(pathlib.Path(path)) == digest for path, digest in build["files"].items()):
+            _log.info(f"Reusing cached build {key[:12]}")
+            return build
+
+    return None
+
+
+def store(folder: pathlib.Path, key: str, files: dict[str, str], outputs: dict[str, str]):
+    builds = _load(folder, key)
+
+    # the same files again (more outputs wanted) adds to the old build
+    for build in builds:
+        if build["files"] == files:
+            outputs = build["outputs"] | outputs
+
+    builds = [_ for _ in builds if _["files"] != files]
+    builds = [{"files": files, "outputs": outputs}, *builds][:KEEP]
+
+    write_atomic(_builds_path(folder, key), json.dumps(builds).encode())
+
+
+def write_atomic(path: pathlib.Path, data: bytes):
+    """
+    Writes aside and moves the file into place, so other runs sharing the
+    folder never read half a file. Failing to write only warns.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        temp = path.with_suffix(f".{os.getpid()}.tmp")
+        temp.write_bytes(data)
+        os.replace(temp, path)
+
+    except OSError as e:
+        _log.warning(f"Could not write {path}, {e}.")
@@ -0,0 +1,121 @@
+# A clock cycle model for the simplecpu.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+How many clock cycles each instruction takes on the real processor.
+
+Instructions are indexed like the emulator's opcode counts, opcodes 0-15 and
+the extended (0b1111) opcodes at 16 + ir03ir00. The defaults follow the v1
+designs' fetch, decode and execute phases, with one more cycle for
+instructions that access data memory and for the stack instructions. Timings
+differ between builds, so a table can be loaded from json:
+
+    {
+      "clock_hz": 50000000,
+      "fetch": 1,
+      "decode": 1,
+      "execute": 1,
+      "memory": 1,
+      "opcodes": {"CALL": 4, "RET": 4}
+    }
+
+"opcodes" sets the total cycles of single instructions, the rest are
+fetch + decode + execute (+ memory).
+
+Only needs the standard library so the assembler can use it.
+"""
+
+import json
+import pathlib
+
+from typing import Iterable, Union
+
+# Names in opcode index order, None where there is no instruction
+OPCODE_NAMES = [
+    "MOVE", "ADD", "SUB", "AND", "LOAD", "STORE", "ADDM", "SUBM",
+    "JUMPU", "JUMPZ", "JUMPNZ", "JUMPC", "CALL", "OR", "XOP1", None,
+    "RET", "MOVER", "LOADR", "STORER", "ROL", "ROR", "ADDR", "SUBR",
+    "ANDR", "ORR", "XORR", "ASLR", "XOP2", "XOP3", "XOP4", "XOP5",
+]  # fmt: skip
+
+# Instructions that read or write data memory besides their own fetch
+MEMORY_READS = {"LOAD", "ADDM", "SUBM", "LOADR"}
+MEMORY_WRITES = {"STORE", "STORER"}
+# Instructions that push or pop the return stack
+STACK = {"CALL", "RET"}
+
+DEFAULT_CLOCK_HZ = 50_000_000
+
+
+def opcode_index(ir: int) -> int:
+    """
+    Index of the instruction word 'ir' in OPCODE_NAMES
+    """
+    op = ir >> 12
+
+    if op == 0b1111:
+        return 16 + (ir & 0x0F)
+
+    return op
+
+
+class CycleTable:
+    def __init__(
+        self,
+        fetch: int = 1,
+        decode: int = 1,
+        execute: int = 1,
+        memory: int = 1,
+        opcodes: Union[None, dict[str, int]] = None,
+        clock_hz: int = DEFAULT_CLOCK_HZ,
+    ):
+        self.clock_hz = clock_hz
+
+        opcodes = {k.upper(): v for k, v in (opcodes or {}).items()}
+
+        for name in opcodes:
+            if name not in OPCODE_NAMES:
+                raise ValueError(f"Unknown instruction '{name}' in cycle table")
+
+        self.cycles = []
+
+        for name in OPCODE_NAMES:
+            cycles = fetch + decode + execute
+
+            if name in MEMORY_READS or name in MEMORY_WRITES or name in STACK:
+                cycles += memory
+
+            self.cycles.append(opcodes.get(name, cycles))
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path]) -> "CycleTable":
+        with open(path, encoding="utf-8") as file:
+            return cls(**json.load(file))
+
+    def instruction(self, ir: int) -> int:
+        """
+        Cycles taken by the instruction word 'ir'
+        """
+        return self.cycles[opcode_index(ir)]
+
+    def total(self, opcode_counts: Iterable[int]) -> int:
+        """
+        Cycles taken by a run, given its per opcode execution counts
+        """
+        return sum(c * n for c, n in zip(self.cycles, opcode_counts))
+
+    def seconds(self, cycles: int, clock_hz: Union[None, int] = None) -> float:
+        """
+        How long 'cycles' take on the board at clock_hz (or the table's clock)
+        """
+        return cycles / (clock_hz or self.clock_hz)
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3f} {unit}"
+
+    return f"{seconds / 1e-9:.1f} ns"
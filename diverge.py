@@ -0,0 +1,474 @@
+# Finds where two runs of a program split.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Finds the first instruction at which two runs of a program stop behaving the
+same, e.g. a program assembled before and after an assembler change.
+
+Both runs are stepped side by side and every K instructions their state
+hashes are chained into a rolling hash, so a stream stays different once it
+has split. Only the window between the last matching hash and the first
+mismatching one is run again, one instruction at a time with tracing, to
+name the instruction the states split at.
+
+A run is a .asc file, a .scp file (assembled first) or a recording made by
+the emulator (see replay.py), which replays with its inputs.
+
+Usage:
+
+diverge.py <run a> <run b>            compare two runs
+           -k <instructions>          hash every k instructions (default: 10000)
+           -n <instructions>          give up after this many instructions (default: 10000000)
+           -m <ranges>                memory hashed, e.g. 0x000-0x0FF,0xFFF or none (default: all of it)
+           -R <project root>          project root for .scp runs (default: each file's folder)
+           -t <instructions>          trace lines shown before the split (default: 10)
+           -o <filename>              write both hash streams as JSON
+"""
+
+import getopt
+import hashlib
+import json
+import logging
+import pathlib
+import sys
+
+from typing import Iterator, Union
+
+import numpy as np
+
+import replay
+import tester
+
+from cycles import OPCODE_NAMES, opcode_index
+from machine import FAULT, HALTED, UNIMPLEMENTED, Machine
+
+DEFAULT_EVERY = 10_000
+DEFAULT_MAX_INSTRUCTIONS = 10_000_000
+DEFAULT_TRACE = 10
+
+
+class Run:
+    """
+    Everything needed to replay a run from its start, the state it starts
+    in, the inputs applied on the way and, for recordings, where it ends.
+    Runs without an end stop when the program halts.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        start: dict,
+        inputs: Union[None, list[tuple[int, str, tuple]]] = None,
+        end: Union[None, int] = None,
+        roots: Union[None, dict[str, int]] = None,
+    ):
+        self.name = name
+        self.start = start
+        self.inputs = inputs or []
+        self.end = end
+        self.roots = roots or {}
+
+    @classmethod
+    def load(cls, path: pathlib.Path, project_root: Union[None, pathlib.Path] = None) -> "Run":
+        machine = Machine()
+        roots = None
+
+        if path.suffix == ".json":
+            recording = replay.load(path)
+            return cls(path.name, recording["start"], recording["inputs"], recording["end"]["instructions"])
+
+        if path.suffix == ".scp":
+            assembled = tester.assemble(path, project_root or path.parent)
+
+            if not assembled["ok"]:
+                raise ValueError(assembled["error"])
+
+            machine.load(assembled["words"])
+            roots = assembled["roots"]
+
+        else:
+            with open(path, encoding="utf-8") as f:
+                machine.load_asc(f.read())
+
+        return cls(path.name, machine.snapshot(), roots=roots)
+
+    def where(self, pc: int) -> str:
+        """
+        pc as the nearest root before it, e.g. start.loop+2
+        """
+        best = None
+
+        for name, address in self.roots.items():
+            if address <= pc and (best is None or address > self.roots[best]):
+                best = name
+
+        if best is None:
+            return ""
+
+        offset = pc - self.roots[best]
+        return best if not offset else f"{best}+{offset}"
+
+
+class Cursor:
+    """
+    A Machine replaying a Run, inputs are applied once the instruction count
+    reaches the one they were recorded at
+    """
+
+    def __init__(self, run: Run):
+        self.run = run
+        self.machine = Machine()
+        self.machine.restore(run.start)
+        self.ended = False
+
+        self._next = 0
+        self._apply_inputs()
+
+    def _apply_inputs(self):
+        inputs = self.run.inputs
+        at = self.machine.total_instructions
+
+        while self._next < len(inputs) and inputs[self._next][0] <= at:
+            _, kind, args = inputs[self._next]
+            self.machine._apply_input(kind, args)
+            self._next += 1
+
+    def save(self) -> tuple:
+        return self.machine.snapshot(), self._next, self.ended
+
+    def load(self, saved: tuple):
+        snapshot, self._next, self.ended = saved
+        self.machine.restore(snapshot)
+
+    def advance(self, instruction: int):
+        """
+        Runs up to instruction count 'instruction', or until the run ends
+        """
+        machine = self.machine
+        inputs = self.run.inputs
+
+        if self.run.end is not None:
+            instruction = min(instruction, self.run.end)
+
+            if machine.total_instructions >= self.run.end:
+                self.ended = True
+
+        while not self.ended and machine.total_instructions < instruction:
+            stop = instruction
+            if self._next < len(inputs):
+                stop = min(stop, inputs[self._next][0])
+
+            result = machine.run(stop - machine.total_instructions)
+
+            if result.reason == UNIMPLEMENTED:
+                # like the emulator's CPU thread, which stops past it
+                machine.pc += 1
+                self.ended = True
+
+            elif result.reason == FAULT:
+                self.ended = True
+
+            # a recorded program carries on when it was started again
+            elif result.reason == HALTED and self.run.end is None:
+                self.ended = True
+
+            self._apply_inputs()
+
+            if self.run.end is not None and machine.total_instructions >= self.run.end:
+                self.ended = True
+
+
+def parse_ranges(text: str) -> Union[None, list[tuple[int, int]]]:
+    """
+    '0x000-0x0FF,0xFFF' as [(0, 256), (4095, 4096)], 'none' as [] and 'all'
+    as None
+    """
+    if text == "all":
+        return None
+
+    if text == "none":
+        return []
+
+    ranges = []
+
+    for part in text.split(","):
+        start, _, end = part.partition("-")
+        start = int(start, 0)
+        ranges.append((start, (int(end, 0) if end else start) + 1))
+
+    return ranges
+
+
+def state_hash(machine: Machine, ranges: Union[None, list[tuple[int, int]]]) -> bytes:
+    if ranges is None:
+        return bytes.fromhex(machine.state_hash())
+
+    digest = hashlib.sha256()
+    digest.update(np.array(machine.registers, dtype=np.uint16).tobytes())
+    digest.update(len(machine.stack).to_bytes(1, "little"))
+    digest.update(np.array(machine.stack, dtype=np.uint16).tobytes())
+    digest.update(bytes(map(int, machine.flags.values())))
+    digest.update(machine.pc.to_bytes(4, "little"))
+
+    for start, end in ranges:
+        digest.update(machine.memory[start:end].tobytes())
+
+    return digest.digest()
+
+
+def rolling(previous: bytes, machine: Machine, ranges) -> bytes:
+    """
+    The next hash in a stream, chained so streams stay different once they
+    have split
+    """
+    digest = hashlib.sha256(previous)
+    digest.update(state_hash(machine, ranges))
+    digest.update(machine.total_instructions.to_bytes(8, "little"))
+
+    return digest.digest()
+
+
+def differences(
+    a: Machine, b: Machine, ranges: Union[None, list[tuple[int, int]]], limit: int = 10
+) -> list[str]:
+    """
+    What differs between the (hashed) states of two machines
+    """
+    out = []
+
+    if a.total_instructions != b.total_instructions:
+        out.append(f"instructions: {a.total_instructions} / {b.total_instructions}")
+
+    if a.pc != b.pc:
+        out.append(f"pc: 0x{a.pc:03x} / 0x{b.pc:03x}")
+
+    for i, (x, y) in enumerate(zip(a.registers, b.registers)):
+        if x != y:
+            out.append(f"R{'ABCD'[i]}: 0x{x:04x} / 0x{y:04x}")
+
+    if a.stack != b.stack:
+        out.append(f"stack: {a.stack} / {b.stack}")
+
+    for flag in a.flags:
+        if a.flags[flag] != b.flags[flag]:
+            out.append(f"{flag}: {a.flags[flag]} / {b.flags[flag]}")
+
+    mask = np.zeros(len(a.memory), dtype=bool)
+    for start, end in [(0, len(mask))] if ranges is None else ranges:
+        mask[start:end] = True
+
+    addresses = np.nonzero(mask & (a.memory != b.memory))[0]
+
+    for address in addresses[:limit]:
+        out.append(f"memory[0x{address:03x}]: 0x{a.memory[address]:04x} / 0x{b.memory[address]:04x}")
+
+    if len(addresses) > limit:
+        out.append(f"... and {len(addresses) - limit} more memory words")
+
+    return out
+
+
+def describe(run: Run, machine: Machine) -> str:
+    """
+    The instruction the machine is about to execute
+    """
+    pc = machine.pc
+
+    if not 0 <= pc < len(machine.memory):
+        return f"pc 0x{pc:03x} (outside of memory)"
+
+    ir = int(machine.memory[pc])
+    where = run.where(pc)
+
+    return (
+        f"pc 0x{pc:03x}{f' ({where})' if where else ''}"
+        f" {ir:04x} {OPCODE_NAMES[opcode_index(ir)] or '?'}"
+    )
+
+
+def streams(
+    a: Cursor, b: Cursor, every: int, max_instructions: int, ranges
+) -> Iterator[tuple[int, bytes, bytes]]:
+    """
+    Steps both cursors 'every' instructions at a time, yielding
+    (instruction, rolling hash a, rolling hash b), starting with the states
+    before the first instruction
+    """
+    ha = rolling(b"", a.machine, ranges)
+    hb = rolling(b"", b.machine, ranges)
+    instruction = a.machine.total_instructions
+
+    yield instruction, ha, hb
+
+    while not (a.ended and b.ended) and instruction < max_instructions:
+        instruction += every
+        a.advance(instruction)
+        b.advance(instruction)
+
+        ha = rolling(ha, a.machine, ranges)
+        hb = rolling(hb, b.machine, ranges)
+
+        yield instruction, ha, hb
+
+
+def bisect_window(
+    a: Cursor, b: Cursor, saved: tuple[tuple, tuple], end: int, ranges, trace: int
+) -> tuple[Union[None, int], list[str]]:
+    """
+    Re-runs the window from the saved (matching) states one instruction at
+    a time. Returns the instruction count the states split at, None if they
+    did not, and the trace leading up to it.
+    """
+    a.load(saved[0])
+    b.load(saved[1])
+
+    lines = []
+
+    while a.machine.total_instructions < end:
+        at = a.machine.total_instructions
+        lines.append(f"{at:>12}  {describe(a.run, a.machine):<40} {describe(b.run, b.machine)}")
+        del lines[:-trace]
+
+        applied = a._next, b._next
+        a.advance(at + 1)
+        b.advance(at + 1)
+
+        for name, cursor, before in (("a", a, applied[0]), ("b", b, applied[1])):
+            for _, kind, args in cursor.run.inputs[before : cursor._next]:
+                lines.append(f"{'':>12}  input {kind} applied to {name}")
+
+        if (
+            a.machine.total_instructions != b.machine.total_instructions
+            or state_hash(a.machine, ranges) != state_hash(b.machine, ranges)
+        ):
+            return at, lines
+
+        if a.ended and b.ended:
+            break
+
+    return None, lines
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, paths = getopt.gnu_getopt(sys.argv[1:], "hk:n:m:R:t:o:", ["help"])
+
+    every = DEFAULT_EVERY
+    max_instructions = DEFAULT_MAX_INSTRUCTIONS
+    ranges = None
+    project_root = None
+    trace = DEFAULT_TRACE
+    output = None
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-k":
+            every = int(val, 0)
+
+        if arg == "-n":
+            max_instructions = int(val, 0)
+
+        if arg == "-m":
+            ranges = parse_ranges(val)
+
+        if arg == "-R":
+            project_root = pathlib.Path(val).resolve()
+
+        if arg == "-t":
+            trace = int(val)
+
+        if arg == "-o":
+            output = val
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(paths) != 2:
+        _log.critical("Two runs are required, see -h. Exiting.")
+        raise SystemExit(1)
+
+    runs = []
+    for path in map(pathlib.Path, paths):
+        try:
+            runs.append(Run.load(path, project_root))
+        except (OSError, ValueError) as e:
+            _log.critical(f"Could not load {path}, {e}. Exiting.")
+            raise SystemExit(1)
+
+    a, b = Cursor(runs[0]), Cursor(runs[1])
+
+    saved = None
+    stream = []
+    split = None
+
+    for instruction, ha, hb in streams(a, b, every, max_instructions, ranges):
+        stream.append((instruction, ha.hex(), hb.hex()))
+
+        if ha != hb:
+            split = instruction
+            break
+
+        saved = a.save(), b.save()
+
+    if output is not None:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "every": every,
+                    runs[0].name: [[i, x] for i, x, _ in stream],
+                    runs[1].name: [[i, y] for i, _, y in stream],
+                },
+                f,
+            )
+
+    if split is None:
+        print(
+            f"Runs match over {a.machine.total_instructions} instructions"
+            f" ({len(stream)} hashes)"
+        )
+        return
+
+    print(f"a: {runs[0].name}\nb: {runs[1].name}\n")
+
+    if saved is None:
+        print("Runs differ before the first instruction")
+
+        for line in differences(a.machine, b.machine, ranges):
+            print(f"    {line}")
+
+        raise SystemExit(1)
+
+    print(f"Hashes split between instructions {split - every} and {split}")
+
+    at, lines = bisect_window(a, b, saved, split, ranges, trace)
+
+    if at is None:
+        # only the instruction counts (one run ending) differ
+        print("Runs end differently")
+
+        for line in differences(a.machine, b.machine, ranges):
+            print(f"    {line}")
+
+        raise SystemExit(1)
+
+    print(f"Runs diverge at instruction {at}:\n")
+    print(f"{'instruction':>12}  {'a':<40} b")
+
+    for line in lines:
+        print(line)
+
+    print("\nAfter it:")
+    for line in differences(a.machine, b.machine, ranges):
+        print(f"    {line}")
+
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,16 @@ import threading
 import time
 import traceback
 
+from collections import deque
+from typing import Union
+
+import replay
+
+from cycles import MEMORY_READS, MEMORY_WRITES, CycleTable, format_seconds
+from heatmap import KINDS, AccessCounts
+from history import History
+from machine import CPUCore, parse_asc
+
 try:
     import numpy as np
 except ImportError:
@@ -39,490 +49,509 @@ except ImportError:
     sys.exit(1)
 
 
-class CPU(threading.Thread):
-    class memwrap:
-        def __init__(self, root):
-            self._memory = np.zeros(4096, dtype=np.uint16)
-            self.mem_change_hook = None
-            self.__root = root
-
-        def __getitem__(self, key):
-            if key == self.__root.debug_port:
-                print(
-                    f"Attempted to read from {self.__root.debug_port:x}, enabling debug mode"
-                )
-                self.__root.debug = True
-
-            return self._memory[key]
-
-        def __setitem__(self, key, value):
-            if key == self.__root.debug_port:
-                print(
-                    f"Attempted to write to {self.__root.debug_port:x}, enabling debug mode"
-                )
-                self.__root.debug = True
+def _reconfiguring_property(name):
+    # attribute that makes the running CPU loop hand back to CPU._run when
+    # changed, so the loop for the new configuration is picked up
+    def getter(self):
+        return getattr(self, name)
 
-            if self.mem_change_hook:
-                self.mem_change_hook(key, value)
+    def setter(self, value):
+        setattr(self, name, value)
+        self._reconfigure = True
+        self._wake.set()
 
-            self._memory[key] = value
+    return property(getter, setter)
 
-        def clear(self):
-            self._memory = np.zeros(4096, dtype=np.uint16)
 
+class CPU(CPUCore, threading.Thread):
     def __init__(self, speed):
-        super().__init__()
-
-        self._memory = self.memwrap(self)
-        self._registers = np.zeros(4, dtype=np.uint16)
-        self.__stack = np.zeros(4, dtype=np.uint16)
-        self.__stack_pointer = 0
-        self._pc = 0
-        self.__ir = 0
+        # Set whenever something the run loops depend on changes, the active
+        # loop returns at the end of the current instruction and _run picks
+        # the loop matching the new configuration.
+        self._reconfigure = False
+        # wakes _run while the CPU is disabled
+        self._wake = threading.Event()
 
-        self.__flags_zero = False
-        self.__flags_carry = False
-        self.__flags_overflow = False
-        self.__flags_positive = False
-        self.__flags_negative = False
+        CPUCore.__init__(self)
+        threading.Thread.__init__(self)
 
-        self._current_instruction_rel_func = None
         self._running_at = "~ KHz"
+        self._khz = 0.0
 
-        self._total_instructions = 0
-
-        self.enabled = False
-        self.running = True
-        self.debug = False
-        self.debug_port = -1
-        self.htz = 0 if speed == 0 else 1 / speed
+        self._enabled = False
+        self._running = True
+        self._htz = 0 if speed == 0 else 1 / speed
+        # opcode counts (and so cycles) are only kept by the instrumented loop
+        self._instrumented = False
+        # clock the instrumented loop paces real time to by cycles, 0 for off
+        self._pace_hz = 0
+
+        # external inputs waiting for the CPU to reach the end of an
+        # instruction, (kind, args, done event)
+        self._inputs = deque()
+        self._input_lock = threading.Lock()
+        # the session being recorded, see replay.py
+        self._recording = None
+        # checkpoints and undo log for stepping back, see history.py
+        self._history = None
+        # instructions, in total and by opcode, undone by stepping back, so
+        # the metrics server's counters never go down
+        self._rewound_instructions = 0
+        self._rewound_counts = [0] * 32
+        # per address access counts while counting, see heatmap.py, and
+        # the counts kept once it stops
+        self._heat = None
+        self._access_counts = None
 
         self.__rc = None
 
+    enabled = _reconfiguring_property("_enabled")
+    running = _reconfiguring_property("_running")
+    debug = _reconfiguring_property("_debug")
+    debug_port = _reconfiguring_property("_debug_port")
+    htz = _reconfiguring_property("_htz")
+    instrumented = _reconfiguring_property("_instrumented")
+    pace_hz = _reconfiguring_property("_pace_hz")
+    cycle_table = _reconfiguring_property("_cycle_table")
+    history = _reconfiguring_property("_history")
+    heat = _reconfiguring_property("_heat")
+
     def bind(self, remote_control):
         self.__rc = remote_control
 
-    def self_loop(self):
-        self.enabled = False
-
-        self.__rc._lines.append(
-            f"\033[31mWarn\033[0m Processor entered self loop, disabling."
-        )
-        self.__rc._lines.append(
-            f"     Total instructions executed: {self._total_instructions}"
-        )
-
-    def load_memory(self, at, memory):
-        for i, c in enumerate(memory):
-            self._memory[i + at] = int(c, 16)
+    def submit_input(self, kind: str, *args):
+        """
+        Applies an external input (see CPUCore._apply_input) between two
+        instructions, returning once it has been applied
+        """
+        if not self.is_alive():
+            self._take_input(kind, args)
+            return
 
-    def _get_mem(self, at):
-        return self._memory[at]
+        done = threading.Event()
+        self._inputs.append((kind, args, done))
+        self._reconfigure = True
+        self._wake.set()
 
-    def _set_mem(self, at, value):
-        self._memory[at] = value
+        # the CPU thread may stop before it gets to the queue
+        while not done.wait(0.1):
+            if not self.is_alive():
+                self._drain_inputs()
 
-    def _MOVE(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        value = ir07ir04 << 4 | ir03ir00
+    def _drain_inputs(self):
+        with self._input_lock:
+            while self._inputs:
+                kind, args, done = self._inputs.popleft()
 
-        self._registers[dest] = value
+                try:
+                    self._take_input(kind, args)
+                finally:
+                    done.set()
+
+    def _take_input(self, kind, args):
+        if kind == "call":
+            function, out = args
+            out.append(function())
+            return
 
-    def _ADD(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        value = ir07ir04 << 4 | ir03ir00
+        if kind == "record":
+            self._recording = {"start": self.snapshot(), "inputs": []}
+            return
 
-        self.__flags_carry = self._registers[dest] + value > 0xFFFF
+        if kind == "stoprecord":
+            recording, self._recording = self._recording, None
 
-        v = self._registers[dest] + value
+            if recording is None:
+                args[0].append(None)
+                return
 
-        self.__flags_zero = v == 0
-        self.__flags_overflow = v > 0xFFFF
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
+            recording["end"] = {
+                "instructions": self._total_instructions,
+                "hash": self.state_hash(),
+            }
+            args[0].append(recording)
+            return
 
-        self._registers[dest] = v
+        self._apply_input(kind, args)
 
-    def _SUB(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        value = ir07ir04 << 4 | ir03ir00
+        if self._history is not None:
+            self._history.log_input(self._total_instructions, kind, args)
 
-        v = self._registers[dest] - value
+        if self._recording is not None:
+            self._recording["inputs"].append(
+                (self._total_instructions, kind, args)
+            )
 
-        self.__flags_carry = False
-        self.__flags_zero = v == 0
-        self.__flags_overflow = v < 0
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
+    def start_recording(self):
+        """
+        Starts logging every external input with the instruction count it
+        was applied at, along with the state it started from
+        """
+        self.submit_input("record")
+
+    def stop_recording(self) -> dict:
+        """
+        Stops recording, returning the recorded session (see replay.save),
+        or None if nothing was being recorded
+        """
+        out = []
+        self.submit_input("stoprecord", out)
+
+        return out[0]
+
+    @property
+    def recording(self) -> bool:
+        return self._recording is not None
+
+    def run_safely(self, function):
+        """
+        Calls 'function' between two instructions, on the CPU thread while
+        it is running, and returns what it returned
+        """
+        out = []
+        self.submit_input("call", function, out)
+
+        return out[0]
+
+    def start_history(self, **limits):
+        """
+        Starts keeping history for step_back and reverse_continue, see
+        history.History for the limits
+        """
+        history = History(self, **limits)
+
+        def start():
+            if self._history is not None:
+                self._history.stop()
 
-        self._registers[dest] = v
+            history.start()
+            self.history = history
 
-    def _AND(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        value = ir07ir04 << 4 | ir03ir00
+        self.run_safely(start)
 
-        self.__flags_carry = False
+    def stop_history(self):
+        def stop():
+            if self._history is not None:
+                self._history.stop()
+                self.history = None
 
-        v = self._registers[dest] & value
+        self.run_safely(stop)
 
-        self.__flags_zero = v == 0
-        self.__flags_overflow = False
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
+    def step_back(self, instructions: int) -> bool:
+        """
+        Goes back 'instructions' instructions, False if that is further
+        back than the history goes
+        """
+        def travel():
+            if self._history is None:
+                return False
 
-        self._registers[dest] = v
+            return self._go_back(self._total_instructions - instructions)
 
-    def _LOAD(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
-        self._registers[0] = self._memory[value]
+        return self.run_safely(travel)
 
-    def _STORE(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+    def reverse_continue(self, addresses) -> Union[None, tuple[int, int]]:
+        """
+        Goes back to the last instruction that wrote to any of 'addresses',
+        stopping before it executes. Returns the (instruction, address)
+        found, None if no write is in the history.
+        """
+        def travel():
+            if self._history is None:
+                return None
 
-        self._memory[value] = self._registers[0]
+            found = self._history.last_write(addresses, self._total_instructions)
 
-    def _ADDM(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+            if found is not None:
+                self._go_back(found[0])
 
-        value = self._memory[value]
+            return found
 
-        self.__flags_carry = self._registers[0] + value > 0xFFFF
+        return self.run_safely(travel)
 
-        v = self._registers[0] + value
+    def _go_back(self, instruction: int) -> bool:
+        """
+        History.goto, adding what it undid to the rewound counts. Call it on
+        the CPU thread.
+        """
+        total, counts = self._total_instructions, list(self._opcode_counts)
 
-        self.__flags_zero = v == 0
-        self.__flags_overflow = v > 0xFFFF
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
+        moved = self._history.goto(instruction)
 
-        self._registers[0] = v
+        self._rewound_instructions += total - self._total_instructions
+        for i, (before, after) in enumerate(zip(counts, self._opcode_counts)):
+            self._rewound_counts[i] += before - after
 
-    def _SUBM(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+        return moved
+
+    def start_heatmap(self) -> AccessCounts:
+        """
+        Starts counting fetches, reads and writes per address, carrying on
+        with the current counts if there are any
+        """
+        heat = self._access_counts or AccessCounts()
 
-        value = self._memory[value]
+        def start():
+            self._memory.read_log = heat.read_log
+            self._memory.write_log = heat.write_log
+            self.heat = heat
 
+        self.run_safely(start)
+        self._access_counts = heat
 
-        v = self._registers[0] - value
+        return heat
 
-        self.__flags_carry = False
-        self.__flags_zero = v == 0
-        self.__flags_overflow = v < 0xFFFF
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
+    def stop_heatmap(self):
+        def stop():
+            if self._heat is not None:
+                self._heat.flush()
 
-        self._registers[0] = v
+            self._memory.read_log = None
+            self._memory.write_log = None
+            self.heat = None
 
-    def _JUMPU(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+        self.run_safely(stop)
 
-        if self._pc - 1 == value:
-            self.self_loop()
+    def access_counts(self) -> Union[None, AccessCounts]:
+        """
+        The (up to date) access counts, None if nothing was ever counted
+        """
+        heat = self._access_counts
 
-        self._pc = value
+        if heat is not None:
+            self.run_safely(heat.flush)
 
-    def _JUMPZ(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+        return heat
 
-        if self._pc - 1 == value:
-            self.self_loop()
+    def self_loop(self):
+        if self._history is not None and self._history.replaying:
+            return
 
-        if self.__flags_zero:
-            self._pc = value
+        self.enabled = False
 
-    def _JUMPNZ(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        self.__rc._lines.append(
+            f"\033[31mWarn\033[0m Processor entered self loop, disabling."
         )
-
-        if self._pc - 1 == value:
-            self.self_loop()
-
-        if not self.__flags_zero:
-            self._pc = value
-
-    def _JUMPC(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        self.__rc._lines.append(
+            f"     Total instructions executed: {self._total_instructions}"
         )
 
-        if self._pc - 1 == value:
-            self.self_loop()
+    def run(self):
+        try:
+            self._run()
+        except NotImplementedError as e:
+            print(f"[CPU] Unimplemented instruction")
+            self.running = False
 
-        if self.__flags_carry:
-            self._pc = value
+            self.__rc._lines.append(
+                f"\033[31mError\033[0m Unimplemented instruction, {e}, program failed to run"
+            )
 
-    def _CALL(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        self.__stack[self.__stack_pointer] = self._pc
-        self.__stack_pointer += 1
+    def _select_loop(self):
+        if self._debug:
+            return self._run_debug
 
-        value = (
-                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
-        )
+        if (
+            self._instrumented
+            or self._pace_hz
+            or self._history is not None
+            or self._heat is not None
+        ):
+            return self._run_instrumented
 
-        self._pc = value
+        if self._htz:
+            return self._run_throttled
 
-    def _OR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("OR")
+        return self._run_fast
 
-    def _XOP1(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("XOP1")
+    def _run(self):
+        while self._running:
+            self._reconfigure = False
 
-    def _RET(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        self.__stack_pointer -= 1
-        self._pc = self.__stack[self.__stack_pointer]
+            self._drain_inputs()
 
-    def _MOVER(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        src = ir09 << 1 | ir08
+            if not self._enabled:
+                self._running_at = "~ KHz"
+                self._khz = 0.0
+                # state is re-read after clearing, so no change is missed
+                self._wake.wait()
+                self._wake.clear()
+                continue
 
-        self._registers[dest] = self._registers[src]
+            self._select_loop()()
 
-    def _LOADR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        src = ir09 << 1 | ir08
+        print(f"[CPU] Stopped")
 
-        self._registers[dest] = self._memory[self._registers[src]]
+    def _run_fast(self):
+        # everything the loop touches is hoisted into locals, the loop only
+        # re-reads self for the program counter and the reconfigure flag
+        base, extended = self._decode_tables()
+        memory = self._memory
+        # reads through the wrapper only when they can hit the debug port
+        fetch_from = memory._memory if self._debug_port < 0 else memory
+        perf_counter = time.perf_counter
+
+        i, t = 0, perf_counter()
+
+        while not self._reconfigure:
+            pc = self._pc
+            ir = int(fetch_from[pc])
+            self._pc = pc + 1
+
+            op = ir >> 12
+            func = extended[ir & 0x0F] if op == 0b1111 else base[op]
+            func(
+                (ir >> 11) & 1,
+                (ir >> 10) & 1,
+                (ir >> 9) & 1,
+                (ir >> 8) & 1,
+                (ir >> 4) & 0xF,
+                ir & 0xF,
+            )
 
-    def _STORER(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        src = ir11 << 1 | ir10
-        dest = ir09 << 1 | ir08
+            self._total_instructions += 1
 
-        self._memory[self._registers[dest]] = self._registers[src]
+            i += 1
+            if i == 10000:
+                c = perf_counter()
+                self._khz = 10000 / (c - t) / 1000
+                self._running_at = f"{self._khz:.2f} kHz"
+                i, t = 0, c
 
-    def _ROL(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        src = ir09 << 1 | ir08
+    def _run_throttled(self):
+        base, extended = self._decode_tables()
+        memory = self._memory
+        fetch_from = memory._memory if self._debug_port < 0 else memory
+        perf_counter = time.perf_counter
+        sleep = time.sleep
+        htz = self._htz
+
+        i, t = 0, perf_counter()
+
+        while not self._reconfigure:
+            pc = self._pc
+            ir = int(fetch_from[pc])
+            self._pc = pc + 1
+
+            op = ir >> 12
+            func = extended[ir & 0x0F] if op == 0b1111 else base[op]
+            func(
+                (ir >> 11) & 1,
+                (ir >> 10) & 1,
+                (ir >> 9) & 1,
+                (ir >> 8) & 1,
+                (ir >> 4) & 0xF,
+                ir & 0xF,
+            )
 
-        self.__flags_overflow = self._registers[dest] & 0x8000
+            self._total_instructions += 1
 
-        self._registers[dest] = (self._registers[dest] << 1) | (
-                self._registers[dest] >> 15
-        )
+            sleep(htz)
 
-        self.__flags_zero = self._registers[dest] == 0
-        self.__flags_carry = False
-        self.__flags_negative = self._registers[dest] & 0x8000
-        self.__flags_positive = not self.__flags_negative
-
-    def _ROR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("ROR")
-        # dest = ir11 << 1 | ir10
-        # src = ir09 << 1 | ir08
-        #
-        # self.__flags_overflow = self._registers[dest] & 0x0001
-        #
-        # self._registers[dest] = (self._registers[dest] >> 1) | (
-        #     self._registers[dest] << 15
-        #         self._registers[src] << 15
-        # )
-        #
-        # self.__flags_zero = self._registers[dest] == 0
-        # self.__flags_carry = False
-        # self.__flags_negative = self._registers[dest] & 0x8000
-        # self.__flags_positive = not self.__flags_negative
-
-    def _ADDR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("ADDR")
-        # dest = ir11 << 1 | ir10
-        # src = ir09 << 1 | ir08
-        #
-        # self.__flags_carry = self._registers[dest] + self._registers[src] > 0xFFFF
-        #
-        # v = int(self._registers[dest]) + int(self._registers[src])
-        #
-        # self.__flags_zero = v == 0
-        # self.__flags_overflow = v > 0xFFFF
-        # self.__flags_negative = v & 0x8000
-        # self.__flags_positive = not self.__flags_negative
-        #
-        # self._registers[dest] = v & 0xFFFF
-
-    def _SUBR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("SUBR")
-        # dest = ir11 << 1 | ir10
-        # src = ir09 << 1 | ir08
-        #
-        # self.__flags_carry = self._registers[dest] < self._registers[src]
-        #
-        # v = int(self._registers[dest]) - int(self._registers[src])
-        #
-        # self.__flags_zero = v == 0
-        # self.__flags_overflow = v > 0xFFFF
-        # self.__flags_negative = v & 0x8000
-        # self.__flags_positive = not self.__flags_negative
-        #
-        # self._registers[dest] = v & 0xFFFF
-
-    def _ANDR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("ANDR")
-
-    def _ORR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("ORR")
-
-    def _XORR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        dest = ir11 << 1 | ir10
-        src = ir09 << 1 | ir08
-
-        v = int(self._registers[dest]) ^ int(self._registers[src])
-
-        self.__flags_carry = False
-        self.__flags_zero = v == 0
-        self.__flags_overflow = v > 0xFFFF
-        self.__flags_negative = v & 0x8000
-        self.__flags_positive = not self.__flags_negative
-
-        self._registers[dest] = v & 0xFFFF
-
-    def _ASLR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
-        raise NotImplementedError("ASLR")
-
-    def _XOP2(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
-        raise NotImplementedError("XOP2")
-
-    def _XOP3(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
-        raise NotImplementedError("XOP3")
-
-    def _XOP4(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
-        raise NotImplementedError("XOP4")
-
-    def _XOP5(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
-        raise NotImplementedError("XOP5")
-
-    def _decode_instruction_rel_func(self, ir):
-        ir15ir12 = ir >> 12
-        ir04ir00 = ir & 0x0F
-
-        if ir15ir12 == 0b1111:
-            return {
-                0b0000: self._RET,
-                0b0001: self._MOVER,
-                0b0010: self._LOADR,
-                0b0011: self._STORER,
-                0b0100: self._ROL,
-                0b0101: self._ROR,
-                0b0110: self._ADDR,
-                0b0111: self._SUBR,
-                0b1000: self._ANDR,
-                0b1001: self._ORR,
-                0b1010: self._XORR,
-                0b1011: self._ASLR,
-                0b1100: self._XOP2,
-                0b1101: self._XOP3,
-                0b1110: self._XOP4,
-                0b1111: self._XOP5,
-            }[ir04ir00]
-
-        return {
-            0b0000: self._MOVE,
-            0b0001: self._ADD,
-            0b0010: self._SUB,
-            0b0011: self._AND,
-            0b0100: self._LOAD,
-            0b0101: self._STORE,
-            0b0110: self._ADDM,
-            0b0111: self._SUBM,
-            0b1000: self._JUMPU,
-            0b1001: self._JUMPZ,
-            0b1010: self._JUMPNZ,
-            0b1011: self._JUMPC,
-            0b1100: self._CALL,
-            0b1101: self._OR,
-            0b1110: self._XOP1,
-        }[ir15ir12]
-
-    def _fetch(self):
-        self.__ir = self._get_mem(self._pc)
-        self._pc += 1
-
-        if self.debug:
-            print(f"Fetched: {self.__ir} at {self._pc - 1}")
-
-    def _decode(self):
-        self._current_instruction_rel_func = self._decode_instruction_rel_func(
-            self.__ir
-        )
+            i += 1
+            if i == 10000:
+                c = perf_counter()
+                self._khz = 10000 / (c - t) / 1000
+                self._running_at = f"{self._khz:.2f} kHz"
+                i, t = 0, c
 
-        if self.debug:
-            print(f"Decoded: {self._current_instruction_rel_func.__name__}")
+    def _run_instrumented(self):
+        # the throttled loop plus per opcode counts, used when something
+        # (e.g. the metrics server) wants to know what the program is doing,
+        # for pacing real time by clock cycles, keeping history and counting
+        # memory accesses
+        base, extended = self._decode_tables()
+        memory = self._memory
+        fetch_from = memory._memory if self._debug_port < 0 else memory
+        perf_counter = time.perf_counter
+        sleep = time.sleep
+        htz = self._htz
+        counts = self._opcode_counts
+        history = self._history
+        heat = self._heat
+        fetch_log = None if heat is None else heat.fetch_log
+
+        pace_hz = self._pace_hz
+        costs = self._cycle_table.cycles
+        # cycles since the loop started, checked against the wall clock
+        # every millisecond of board time
+        cycles, pace_step = 0, max(1, pace_hz // 1000)
+        pace_at, pace_start = pace_step, perf_counter()
+
+        i, t = 0, perf_counter()
+
+        while not self._reconfigure:
+            if history is not None and self._total_instructions >= history.next_checkpoint:
+                history.checkpoint()
+
+            pc = self._pc
+            ir = int(fetch_from[pc])
+            self._pc = pc + 1
+
+            if fetch_log is not None:
+                fetch_log.append(pc)
+
+            op = ir >> 12
+            if op == 0b1111:
+                op = 16 + (ir & 0x0F)
+                func = extended[ir & 0x0F]
+            else:
+                func = base[op]
+
+            func(
+                (ir >> 11) & 1,
+                (ir >> 10) & 1,
+                (ir >> 9) & 1,
+                (ir >> 8) & 1,
+                (ir >> 4) & 0xF,
+                ir & 0xF,
+            )
 
-    def _execute(self):
-        ir11 = (self.__ir >> 11) & 1
-        ir10 = (self.__ir >> 10) & 1
-        ir09 = (self.__ir >> 9) & 1
-        ir08 = (self.__ir >> 8) & 1
-        ir07ir04 = (self.__ir >> 4) & 0xF
-        ir03ir00 = self.__ir & 0xF
+            counts[op] += 1
+            self._total_instructions += 1
 
-        self._current_instruction_rel_func(ir11, ir10, ir09, ir08, ir07ir04, ir03ir00)
+            if htz:
+                sleep(htz)
 
-        if self.debug:
-            print(f"Executed: {self._current_instruction_rel_func.__name__}")
+            if pace_hz:
+                cycles += costs[op]
 
-    def run(self):
-        try:
-            self._run()
-        except NotImplementedError as e:
-            print(f"[CPU] Unimplemented instruction")
-            self.running = False
+                if cycles >= pace_at:
+                    ahead = pace_start + cycles / pace_hz - perf_counter()
+                    if ahead > 0:
+                        sleep(ahead)
 
-            self.__rc._lines.append(
-                f"\033[31mError\033[0m Unimplemented instruction, {e}, program failed to run"
-            )
+                    pace_at = cycles + pace_step
 
-    def _run(self):
-        i, t = 0, time.time()
+            i += 1
+            if i == 10000:
+                c = perf_counter()
+                self._khz = 10000 / (c - t) / 1000
+                self._running_at = f"{self._khz:.2f} kHz"
+                i, t = 0, c
 
-        while self.running:
-            if not self.enabled:
-                time.sleep(1)
-                self.running_at = "~ KHz"
-                continue
+                if heat is not None:
+                    heat.flush()
 
+        if heat is not None:
+            heat.flush()
+
+    def _run_debug(self):
+        while not self._reconfigure:
             self._fetch()
             self._decode()
             self._execute()
 
             self._total_instructions += 1
 
-            if self.debug:
-                print(f"Registers: {self._registers}")
-                print(f"Stack: {self.__stack}")
-                print(f"Stack Pointer: {self.__stack_pointer}")
-                print(f"PC: {self._pc}")
-                print(f"IR: {self.__ir}")
-                print(f"Carry: {self.__flags_carry}")
-                print(f"Zero: {self.__flags_zero}")
-                print(f"Overflow: {self.__flags_overflow}")
-                print(f"Negative: {self.__flags_negative}")
-                print(f"Positive: {self.__flags_positive}")
-                print()
-                time.sleep(1)
-
-            if self.htz:
-                time.sleep(self.htz)
+            self._print_state()
+            time.sleep(1)
 
-            i += 1
-            if i == 10000:
-                c = time.time()
-                r = c - t
-                s = r / 10000
-                self._running_at = f"{1 / s / 1000:.2f} kHz"
-                i, t = 0, c
+            if self._htz:
+                time.sleep(self._htz)
 
-        print(f"[CPU] Stopped")
+        self._running_at = "~ KHz"
+        self._khz = 0.0
 
 
 class PygameScreen:
@@ -537,6 +566,18 @@ class PygameScreen:
 
         self._cpu = cpu_ref
         self._watching = []
+        # (memory generation, surface) of every watched image, redrawn once
+        # the memory under it is written
+        self._images = {}
+
+        self._frames_rendered = 0
+        self._render_seconds = 0.0
+
+        # access kind shown as a heatmap next to the watched images
+        self._heat_kind = None
+
+    def show_heatmap(self, kind: Union[None, str]):
+        self._heat_kind = kind
 
     def watch(self, address, size: tuple[int, int]):
         self._watching.append((address, size))
@@ -544,6 +585,7 @@ class PygameScreen:
 
     def unwatch(self, address):
         self._watching = [w for w in self._watching if w[0] != address]
+        self._images = {k: v for k, v in self._images.items() if k[0] != address}
         print(f"[PS] Stopped watching image at {address}")
 
     def load_image(
@@ -565,12 +607,34 @@ class PygameScreen:
 
         return surf
 
+    def cached_image(
+            self, address, size: tuple[int, int], fsize: tuple[int, int]
+    ) -> pygame.surface:
+        memory = self._cpu._memory
+        key = (address, size, fsize)
+        cached = self._images.get(key)
+
+        if cached is None or memory.changed(address, address + size[0] * size[1], cached[0]):
+            # taken before reading, a write during the redraw shows next frame
+            generation = memory.generation
+            cached = self._images[key] = (generation, self.load_image(address, size, fsize))
+
+        return cached[1]
+
+    def heat_image(self, heat: AccessCounts, kind: str, fsize: tuple[int, int]) -> pygame.surface:
+        # surfarray is indexed x first
+        surf = pygame.surfarray.make_surface(heat.image(kind).swapaxes(0, 1))
+
+        return pygame.transform.scale(surf, fsize)
+
     def run(self):
         while self._running:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self._running = False
 
+            start = time.perf_counter()
+
             self._display.fill((0, 0, 0))
 
             for i, (address, size) in enumerate(self._watching):
@@ -582,7 +646,7 @@ class PygameScreen:
                     1,
                 )
                 self._display.blit(
-                    self.load_image(address, size, (128, 128)),
+                    self.cached_image(address, size, (128, 128)),
                     ((i * (128 + 8)) + 16, 16),
                 )
                 sur = self._font.render(f"0x{address:03x}", True, (255, 255, 255))
@@ -591,13 +655,47 @@ class PygameScreen:
                     ((i * (128 + 8)) + 16 + 64 - (sur.get_width() // 2), 128 + 20),
                 )
 
+            heat = self._cpu._access_counts
+            if self._heat_kind is not None and heat is not None:
+                i = len(self._watching)
+
+                pygame.draw.rect(
+                    self._display,
+                    (255, 255, 255),
+                    ((i * (128 + 8)) + 13, 13, 134, 134),
+                    1,
+                )
+                self._display.blit(
+                    self.heat_image(heat, self._heat_kind, (128, 128)),
+                    ((i * (128 + 8)) + 16, 16),
+                )
+                sur = self._font.render(self._heat_kind, True, (255, 255, 255))
+                self._display.blit(
+                    sur,
+                    ((i * (128 + 8)) + 16 + 64 - (sur.get_width() // 2), 128 + 20),
+                )
+
             pygame.display.flip()
+
+            self._frames_rendered += 1
+            self._render_seconds += time.perf_counter() - start
+
             self._clock.tick(30)
 
         print(f"[PS] Stopped")
 
 
 class RemoteControl(threading.Thread):
+    class _Lines(list):
+        # output log that asks for a redraw whenever a line is added
+        def __init__(self, on_append):
+            super().__init__()
+            self._on_append = on_append
+
+        def append(self, line):
+            super().append(line)
+            self._on_append()
+
     class _NonBlocked(threading.Thread):
         def __init__(self, client, rc):
             super().__init__()
@@ -616,6 +714,8 @@ class RemoteControl(threading.Thread):
 
         def _check_changes(self, key, value):
             if key in self._rc._watching:
+                self._rc._watch_hits += 1
+
                 w = ""
                 if value in range(32, 127):
                     w = f" '{chr(value)}'"
@@ -628,28 +728,33 @@ class RemoteControl(threading.Thread):
         def run(self):
             print(f"[RC.NB] Started")
 
+            frame_time = 1 / 30
+            last_frame = 0.0
+
             while self._running:
+                # only the kHz counter changes without a render request
+                self._rc._render_requested.wait(
+                    1.0 if self._rc._cpu.enabled else None
+                )
+                self._rc._render_requested.clear()
+
+                if not self._running:
+                    break
+
+                # coalesce bursts of requests (e.g. watch hits) into frames
+                delay = last_frame + frame_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                last_frame = time.perf_counter()
+
                 try:
                     self._client.send(self._rc.render())
-                except ConnectionAbortedError:
-                    print(f"[RC.NB] Connection closed")
-                    self._rc._cpu.enabled = False
-                    self._rc._cpu.running = False
-                    self._rc._screen._running = False
-                    self._running = False
-                    self._rc._running = False
-                    break
-                except ConnectionResetError:
+                except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
                     print(f"[RC.NB] Connection closed")
-                    self._rc._cpu.enabled = False
-                    self._rc._cpu.running = False
-                    self._rc._screen._running = False
-                    self._running = False
-                    self._rc._running = False
+                    self._rc.stop()
                     break
 
-                time.sleep(0.1)
-
             print(f"[RC.NB] Stopped")
 
     def __init__(self, cpu_ref: CPU, screen_ref: PygameScreen):
@@ -658,17 +763,31 @@ class RemoteControl(threading.Thread):
         self._screen_size = (80, 24)
         self._cpu: CPU = cpu_ref
         self._screen: PygameScreen = screen_ref
-        self._stop_blocking = True
+        self._connected = threading.Event()
+        self._render_requested = threading.Event()
 
         self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server.bind(("localhost", 4003))
         self._server.listen(1)
 
-        self._lines = []
+        self._lines = self._Lines(self.request_render)
         self._cur_command = ""
         self._watching = []
         self._last_command = ""
 
+        # port or unix socket of an assembler_server.py for loadscp, None
+        # starts assembler.py for every load
+        self.assembler_server: Union[None, int, str] = None
+        # seconds to wait for the server before starting assembler.py
+        self.assembler_server_timeout = 30.0
+        # the metrics server keeps the opcode counts on, cycles off leaves them
+        self.metrics_server: Union[None, MetricsServer] = None
+
+        self._commands_processed = 0
+        # where the session being recorded is saved
+        self._record_path = None
+        self._watch_hits = 0
+
         self._running = True
 
         self.start()
@@ -676,8 +795,36 @@ class RemoteControl(threading.Thread):
         self._nonblocked = self._NonBlocked(self._server, self)
 
         print(f"[RC] Waiting for connection")
-        while self._stop_blocking:
-            time.sleep(0.1)
+        self._connected.wait()
+
+    def request_render(self):
+        self._render_requested.set()
+
+    def start_recording(self, path):
+        self._record_path = pathlib.Path(path).resolve()
+        self._cpu.start_recording()
+
+    def save_recording(self):
+        if self._record_path is None:
+            return
+
+        recording = self._cpu.stop_recording()
+        path, self._record_path = self._record_path, None
+
+        if recording is not None:
+            replay.save(path, recording)
+            print(f"[RC] Saved recording to {path}")
+
+    def stop(self):
+        self.save_recording()
+
+        self._cpu.enabled = False
+        self._cpu.running = False
+        self._screen._running = False
+        self._running = False
+        self._nonblocked._running = False
+        # wake the render thread so it sees it should stop
+        self.request_render()
 
     def render(self):
         # Clear screen, reset cursor, reset colors, underline
@@ -709,6 +856,8 @@ class RemoteControl(threading.Thread):
         return out.encode("utf-8")
 
     def run_command_ext(self, command):
+        self._commands_processed += 1
+
         try:
             self._cur_command = command
             self._lines.append(f"\033[34mCommand\033[0m {self._cur_command}")
@@ -720,6 +869,46 @@ class RemoteControl(threading.Thread):
 
             self._lines.append(f"\033[31mError\033[0m {e}")
 
+    def _assemble_with_server(self, asm_path: pathlib.Path) -> bool:
+        """
+        Assembles into tmp/output.asc and debug.debug with the assembler
+        server, False if there is no server to use
+        """
+        if self.assembler_server is None:
+            return False
+
+        # imported here as it brings the whole assembler with it
+        import assembler_server
+
+        try:
+            response = assembler_server.request(
+                {"file": str(asm_path), "outputs": ["asc", "deb"]},
+                assembler_server.parse_address(self.assembler_server),
+                timeout=self.assembler_server_timeout,
+            )
+        except socket.timeout:
+            self._lines.append(
+                f"Assembler server did not answer in {self.assembler_server_timeout:.0f}s, starting assembler.py"
+            )
+            return False
+        except OSError as e:
+            self._lines.append(f"Assembler server not reachable ({e}), starting assembler.py")
+            return False
+
+        if not response["ok"]:
+            self._lines.append(f"\033[31mError\033[0m {response['error']}")
+            # nothing to load, loadasc reports the missing file
+            return True
+
+        with open("tmp/output.asc", "w") as f:
+            f.write(response["outputs"]["asc"])
+
+        with open("debug.debug", "w") as f:
+            f.write(response["outputs"]["deb"])
+
+        self._lines.append(f"Assembled in {response['seconds'] * 1000:.0f} ms")
+        return True
+
     def handle_command(self):
         if self._cur_command == "!exit":
             raise SystemExit
@@ -747,6 +936,242 @@ class RemoteControl(threading.Thread):
             self._cur_command = ""
             return
 
+        if self._cur_command == "cycles off":
+            if self.metrics_server is not None:
+                self._lines.append("Still counting cycles for the metrics server")
+            else:
+                # back to the fast (or throttled) loop, unless pacing, history
+                # or a heatmap still need the instrumented one
+                self._cpu.instrumented = False
+                self._lines.append("Stopped counting cycles")
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command == "cycles":
+            if not self._cpu.instrumented:
+                # cycles come from the opcode counts
+                self._cpu.instrumented = True
+                self._lines.append(
+                    "Counting cycles from now on, this slows the CPU down (cycles off stops)"
+                )
+
+            table = self._cpu.cycle_table
+            cycles = self._cpu.cycles
+            instructions = sum(self._cpu._opcode_counts)
+
+            # (not max(), handle_command has a local of that name)
+            self._lines.append(
+                f"Cycles: {cycles} over {instructions} instructions"
+                f" ({cycles / (instructions or 1):.2f} per instruction)"
+            )
+            self._lines.append(
+                f"        {format_seconds(table.seconds(cycles))} at {table.clock_hz / 1e6:g} MHz"
+            )
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("setclock"):
+            hz = int(float(self._cur_command[8:].strip()) * 1e6)
+            self._cpu.cycle_table.clock_hz = hz
+            self._lines.append(f"Estimating runtimes at {hz / 1e6:g} MHz")
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("pace"):
+            value = self._cur_command[4:].strip()
+
+            if value == "off":
+                self._cpu.pace_hz = 0
+                self._lines.append("Stopped pacing by cycles")
+            else:
+                hz = int(float(value) * 1e6) if value else self._cpu.cycle_table.clock_hz
+                self._cpu.pace_hz = hz
+                self._lines.append(f"Pacing to a {hz / 1e6:g} MHz clock")
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("record"):
+            path = self._cur_command[6:].strip()
+
+            if path == "stop":
+                if self._record_path is None:
+                    self._lines.append("Not recording")
+                else:
+                    self._lines.append(f"Saved recording to {self._record_path}")
+                    self.save_recording()
+
+            elif path:
+                self.save_recording()
+                self.start_recording(path)
+                self._lines.append(
+                    f"Recording from instruction {self._cpu._total_instructions} to {self._record_path}"
+                )
+
+            else:
+                self._lines.append("Usage: record {file} / record stop")
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("history"):
+            value = self._cur_command[7:].strip().split()
+
+            if value[:1] == ["off"]:
+                self._cpu.stop_history()
+                self._lines.append("Stopped keeping history")
+
+            elif value[:1] == ["on"]:
+                limits = dict(zip(("interval", "max_writes"), map(eval, value[1:])))
+                self._cpu.start_history(**limits)
+                self._lines.append(
+                    f"Keeping history from instruction {self._cpu._total_instructions}"
+                )
+
+            elif value:
+                self._lines.append("Usage: history / history on [{interval} [{max writes}]] / history off")
+
+            elif self._cpu.history is None:
+                self._lines.append("Not keeping history, see history on")
+
+            else:
+                history = self._cpu.history
+                self._lines.append(
+                    f"History from instruction {history.oldest} to {self._cpu._total_instructions},"
+                    f" {history.checkpoints} checkpoints, {history.writes} writes"
+                    f" ({history.writes * 12 / 1024:.0f} KiB)"
+                )
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("heatmap"):
+            action, *rest = self._cur_command[7:].strip().split(" ", 1)
+            rest = rest[0].strip() if rest else ""
+
+            if action == "on":
+                self._cpu.start_heatmap()
+                self._lines.append("Counting memory accesses")
+
+            elif action == "off":
+                self._cpu.stop_heatmap()
+                self._lines.append("Stopped counting memory accesses")
+
+            elif action == "clear":
+                heat = self._cpu.access_counts()
+                if heat is not None:
+                    self._cpu.run_safely(heat.clear)
+                self._lines.append("Cleared memory access counts")
+
+            elif action in ("show", "hide"):
+                kind = (rest or "all") if action == "show" else None
+
+                if kind not in (None, "all", *KINDS):
+                    self._lines.append(f"Unknown access kind {kind}, expected all or {', '.join(KINDS)}")
+                else:
+                    self._screen.show_heatmap(kind)
+                    self._lines.append(f"Showing {kind} heatmap" if kind else "Hid heatmap")
+
+            elif self._cpu.access_counts() is None:
+                self._lines.append("No memory accesses counted, see heatmap on")
+
+            elif action == "csv" and rest:
+                path = pathlib.Path(rest).resolve()
+                self._cpu.access_counts().save_csv(path)
+                self._lines.append(f"Saved access counts to {path}")
+
+            elif action == "png" and rest:
+                path, _, kind = rest.partition(" ")
+                path, kind = pathlib.Path(path).resolve(), kind.strip() or "all"
+
+                if kind not in ("all", *KINDS):
+                    self._lines.append(f"Unknown access kind {kind}, expected all or {', '.join(KINDS)}")
+                else:
+                    self._cpu.access_counts().save_png(path, kind)
+                    self._lines.append(f"Saved {kind} heatmap to {path}")
+
+            elif not action:
+                heat = self._cpu.access_counts()
+                self._lines.append(
+                    f"Fetches: {int(heat.fetches.sum())}, reads: {int(heat.reads.sum())},"
+                    f" writes: {int(heat.writes.sum())}"
+                )
+
+                for kind in KINDS:
+                    busiest = ", ".join(f"{a:03x} ({n})" for a, n in heat.busiest(3, kind))
+                    self._lines.append(f"    most {kind}: {busiest or '-'}")
+
+            else:
+                self._lines.append(
+                    "Usage: heatmap [on|off|clear|show {kind}|hide|csv {file}|png {file} {kind}]"
+                )
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("stepback") or self._cur_command.startswith("reverse-continue"):
+            if self._cpu.history is None:
+                self._lines.append("Not keeping history, see history on")
+
+            elif self._cpu.recording:
+                self._lines.append("Stop recording before going back")
+
+            elif self._cur_command.startswith("stepback"):
+                self._cpu.enabled = False
+                value = self._cur_command[8:].strip()
+                instructions = eval(value) if value else 1
+
+                if self._cpu.step_back(instructions):
+                    self._lines.append(
+                        f"Back at instruction {self._cpu._total_instructions}, PC: {self._cpu._pc}"
+                    )
+                else:
+                    self._lines.append(
+                        f"History only goes back to instruction {self._cpu.history.oldest}"
+                    )
+
+            else:
+                self._cpu.enabled = False
+                value = self._cur_command[16:].strip()
+                addresses = [eval(_) for _ in value.split()] if value else self._watching
+
+                found = self._cpu.reverse_continue(addresses)
+
+                if found is None:
+                    self._lines.append("No write to the watched memory in the history")
+                else:
+                    instruction, address = found
+                    pc = self._cpu._pc
+                    self._lines.append(
+                        f"Memory at {address:03x} written by instruction {instruction}"
+                        f" at PC {pc} ({self._cpu._memory._memory[pc]:04x})"
+                    )
+
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
+        if self._cur_command.startswith("loadcycles"):
+            table_path = pathlib.Path(self._cur_command[10:].strip()).resolve()
+
+            if table_path.exists() is False:
+                self._lines.append(f"File at {table_path} does not exist")
+                return
+
+            self._cpu.cycle_table = CycleTable.load(table_path)
+            self._lines.append(f"Loaded cycle table {table_path}")
+            self._last_command = self._cur_command
+            self._cur_command = ""
+            return
+
         if self._cur_command == "start":
             self._cpu.enabled = True
             self._lines.append("CPU started")
@@ -791,14 +1216,15 @@ class RemoteControl(threading.Thread):
             og_size = size
             size = int(size[0]) * int(size[1])
 
+            values = []
             for _ in range(size):
                 r = int(code.pop(0)[0])
                 g = int(code.pop(0)[0])
                 b = int(code.pop(0)[0])
 
-                value = (r >> 3) << 11 | (g >> 2) << 5 | (b >> 3)
+                values.append((r >> 3) << 11 | (g >> 2) << 5 | (b >> 3))
 
-                self._cpu._set_mem(address + _, value)
+            self._cpu.submit_input("writemem", address, values)
 
             self._lines.append(
                 f"Loaded image at {address}, ({og_size[0]}x{og_size[1]})"
@@ -858,18 +1284,9 @@ class RemoteControl(threading.Thread):
                 return
 
             with open(asc_path, "r") as f:
-                code = f.read().strip()
-
-            code = code.split("\n")
-
-            memory_start = int(code[0].split(" ")[0], 16)
-
-            for i, line in enumerate(code):
-                code[i] = line.strip().split(" ")[1:]
-
-            code = [item for sublist in code for item in sublist]
+                memory_start, code = parse_asc(f.read())
 
-            self._cpu.load_memory(memory_start, code)
+            self._cpu.submit_input("loadmem", memory_start, code)
 
             self._lines.append(f"Loaded ASC at {memory_start:03x}, total instructions: {len(code)}")
             self._last_command = self._cur_command
@@ -892,9 +1309,10 @@ class RemoteControl(threading.Thread):
             if os.path.exists("tmp/output.asc"):
                 os.remove("tmp/output.asc")
 
-            os.system(
-                rf"{python_executable_path} assembler.py -i {asm_path} -P debug -a {output_path} -V"
-            )
+            if not self._assemble_with_server(asm_path):
+                os.system(
+                    rf"{python_executable_path} assembler.py -i {asm_path} -P debug -a {output_path} -V"
+                )
 
             # load the assembled code
             self._cur_command = f"loadasc tmp/output.asc"
@@ -950,8 +1368,10 @@ class RemoteControl(threading.Thread):
 
         if self._cur_command.startswith("getmem"):
             address = eval(self._cur_command[6:])
+            # read past the memory wrapper, the heatmap's logs only take the
+            # CPU thread's accesses
             self._lines.append(
-                f"Memory at {address:03x}: {self._cpu._get_mem(address):03x}"
+                f"Memory at {address:03x}: {self._cpu._memory._memory[address]:03x}"
             )
             self._last_command = self._cur_command
             self._cur_command = ""
@@ -962,22 +1382,18 @@ class RemoteControl(threading.Thread):
             address = eval(address)
             value = eval(value)
 
-            self._cpu._set_mem(address, value)
+            self._cpu.submit_input("setmem", address, value)
             self._lines.append(f"Memory at {address:03x} set to {value:03x}")
             self._last_command = self._cur_command
             self._cur_command = ""
             return
 
         if self._cur_command.startswith("exit"):
-            self._cpu.enabled = False
-            self._cpu.running = False
-            self._screen._running = False
-            self._running = False
-            self._nonblocked._running = False
+            self.stop()
             return
 
         if self._cur_command.startswith("clearmem"):
-            self._cpu._memory.clear()
+            self._cpu.submit_input("clearmem")
             self._lines.append(f"Cleared memory")
             self._last_command = self._cur_command
             self._cur_command = ""
@@ -988,7 +1404,7 @@ class RemoteControl(threading.Thread):
             reg = eval(reg)
             value = eval(value)
 
-            self._cpu._registers[reg] = value
+            self._cpu.submit_input("setreg", reg, value)
 
             self._lines.append(f"Register {reg} set to {value}")
             self._last_command = self._cur_command
@@ -1006,7 +1422,7 @@ class RemoteControl(threading.Thread):
         if self._cur_command.startswith("setpc"):
             pc = eval(self._cur_command[5:])
 
-            self._cpu._pc = pc
+            self._cpu.submit_input("setpc", pc)
 
             self._lines.append(f"PC set to {pc}")
             self._last_command = self._cur_command
@@ -1086,6 +1502,10 @@ class RemoteControl(threading.Thread):
             b"disabledebug - Disable debug mode\r\n"
             b"setdebugtrigger {X} - Set the debug trigger to X\r\n"
             b"gettotalinst - Get the total number of instructions executed\r\n"
+            b"history [on|off] - Keep history for going back, or show it\r\n"
+            b"stepback {X} - Go back X instructions\r\n"
+            b"reverse-continue [{X}...] - Go back to the last write to watched memory\r\n"
+            b"heatmap [on|off|show|csv {X}|png {X}] - Count memory accesses per address\r\n"
             b"\r\n"
             b"Press any key to continue\r\n"
         )
@@ -1093,23 +1513,23 @@ class RemoteControl(threading.Thread):
         _ = client.recv(1)
         self._nonblocked.bind(client)
         self._nonblocked.start()
-        self._stop_blocking = False
+        self._connected.set()
 
         while self._running:
             try:
                 data = client.recv(1)
-            except ConnectionAbortedError:
-                print(f"[RC] Connection closed")
-                break
-            except ConnectionResetError:
-                print(f"[RC] Connection closed")
-                break
+            except (ConnectionAbortedError, ConnectionResetError):
+                data = b""
 
+            # an empty read means the client went away
             if not data:
-                continue
+                print(f"[RC] Connection closed")
+                self.stop()
+                break
 
             if data == b"\x1b":
                 self.handle_x1b(client.recv(2))
+                self.request_render()
                 continue
 
             if data[0] in range(32, 127):
@@ -1119,6 +1539,7 @@ class RemoteControl(threading.Thread):
                 self._cur_command = self._cur_command[:-1]
 
             if data == b"\r":
+                self._commands_processed += 1
                 self._lines.append(f"\033[32mCommand\033[0m {self._cur_command}")
 
                 try:
@@ -1129,9 +1550,175 @@ class RemoteControl(threading.Thread):
 
                     self._lines.append(f"\033[31mError\033[0m {e}")
 
+            self.request_render()
+
         print("[RC] Stopped")
 
 
+class MetricsServer(threading.Thread):
+    """
+    Serves the emulator's counters over HTTP in the Prometheus text
+    exposition format, any GET request returns the full set of metrics.
+    """
+
+    def __init__(self, cpu_ref: CPU, screen_ref: PygameScreen, port):
+        super().__init__(daemon=True)
+
+        self._cpu: CPU = cpu_ref
+        self._screen: PygameScreen = screen_ref
+        self._rc: Union[None, RemoteControl] = None
+
+        # opcode counts are only kept by the instrumented loop
+        self._cpu.instrumented = True
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("localhost", port))
+        self._server.listen(4)
+
+        print(f"[MS] Serving metrics on http://localhost:{port}/metrics")
+
+    def bind(self, remote_control):
+        self._rc = remote_control
+
+    def render(self):
+        out = []
+
+        def metric(name, kind, doc, samples):
+            out.append(f"# HELP scpuas_{name} {doc}")
+            out.append(f"# TYPE scpuas_{name} {kind}")
+
+            for labels, value in samples:
+                out.append(f"scpuas_{name}{labels} {value}")
+
+        names = self._cpu.opcode_names()
+        # counters include what stepping back undid, they never go down
+        counts = [
+            c + r for c, r in zip(self._cpu._opcode_counts, self._cpu._rewound_counts)
+        ]
+        executed = sum(counts)
+
+        reads = executed + sum(c for n, c in zip(names, counts) if n in MEMORY_READS)
+        writes = sum(c for n, c in zip(names, counts) if n in MEMORY_WRITES)
+        cycles = self._cpu.cycle_table.total(counts)
+
+        metric(
+            "instructions_retired_total",
+            "counter",
+            "Instructions executed by the CPU.",
+            [("", self._cpu._total_instructions + self._cpu._rewound_instructions)],
+        )
+        metric(
+            "instruction_position",
+            "gauge",
+            "Instructions from the start of the program to where the CPU is, lower after stepping back.",
+            [("", self._cpu._total_instructions)],
+        )
+        metric(
+            "effective_khz",
+            "gauge",
+            "Instructions per millisecond over the last 10000 instructions.",
+            [("", f"{self._cpu._khz:.3f}")],
+        )
+        metric(
+            "cpu_enabled",
+            "gauge",
+            "1 while the CPU is running a program.",
+            [("", int(self._cpu.enabled))],
+        )
+        metric(
+            "opcode_executed_total",
+            "counter",
+            "Instructions executed by opcode.",
+            [
+                (f'{{opcode="{name}"}}', count)
+                for name, count in zip(names, counts)
+                if name is not None
+            ],
+        )
+        metric(
+            "cycles_total",
+            "counter",
+            "Clock cycles the executed instructions take on the board.",
+            [("", cycles)],
+        )
+        metric(
+            "board_seconds_total",
+            "counter",
+            "Time the executed instructions take on the board at the cycle table's clock.",
+            [("", f"{self._cpu.cycle_table.seconds(cycles):.9f}")],
+        )
+        metric(
+            "memory_reads_total",
+            "counter",
+            "Memory reads made by executed instructions, including fetches.",
+            [("", reads)],
+        )
+        metric(
+            "memory_writes_total",
+            "counter",
+            "Memory writes made by executed instructions.",
+            [("", writes)],
+        )
+        metric(
+            "render_frames_total",
+            "counter",
+            "Frames drawn by the screen.",
+            [("", self._screen._frames_rendered)],
+        )
+        metric(
+            "render_seconds_total",
+            "counter",
+            "Time spent drawing screen frames.",
+            [("", f"{self._screen._render_seconds:.6f}")],
+        )
+
+        if self._rc is not None:
+            metric(
+                "watch_hits_total",
+                "counter",
+                "Writes to watched memory addresses.",
+                [("", self._rc._watch_hits)],
+            )
+            metric(
+                "remote_commands_total",
+                "counter",
+                "Commands processed by the remote control.",
+                [("", self._rc._commands_processed)],
+            )
+
+        return ("\n".join(out) + "\n").encode("utf-8")
+
+    def run(self):
+        while True:
+            client, _ = self._server.accept()
+            # a client that never sends its request would block everyone else
+            client.settimeout(2.0)
+
+            try:
+                request = b""
+                while b"\r\n\r\n" not in request:
+                    data = client.recv(1024)
+                    if not data:
+                        break
+                    request += data
+
+                body = self.render()
+                client.sendall(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(body)}\r\n".encode("utf-8")
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+            except socket.timeout:
+                print("[MS] Client did not send a request in time, closing it")
+            except OSError as e:
+                print(f"[MS] Error while serving metrics: {e}")
+            finally:
+                client.close()
+
+
 if __name__ == "__main__":
     # Ensure that the user passes in a file first, before starting anything else
     if not sys.argv[1:]:
@@ -1156,19 +1743,60 @@ if __name__ == "__main__":
         else:
             raise SystemExit("JSON file needs a 'tickspeed' key, see examples/example_settings.json")
 
+        metrics_port = json_data.get("metrics_port")
+        cycle_table = json_data.get("cycle_table")
+        pace_hz = json_data.get("pace_hz", 0)
+        record = json_data.get("record")
+        history = json_data.get("history")
+        heatmap = json_data.get("heatmap")
+        server_address = json_data.get("assembler_server")
+
     # Start everything else
     cpu = CPU(tickspeed)
+
+    if cycle_table is not None:
+        cpu.cycle_table = CycleTable.load(cycle_table)
+
+    cpu.pace_hz = pace_hz
+
+    if history:
+        cpu.start_history(**(history if isinstance(history, dict) else {}))
+
+    if heatmap:
+        cpu.start_heatmap()
+
     screen = PygameScreen(cpu)
 
+    # a kind (e.g. "writes") also shows it on the screen
+    if isinstance(heatmap, str):
+        screen.show_heatmap(heatmap)
+
+    metrics = None
+    if metrics_port is not None:
+        metrics = MetricsServer(cpu, screen, metrics_port)
+        metrics.start()
+
     os.system(r"start putty -load rawtoscpu")
     rc = RemoteControl(cpu, screen)
     # starts itself
 
+    if server_address is not None:
+        rc.assembler_server = server_address
+
+    rc.metrics_server = metrics
+
+    # recording starts before the defaults so their loads are replayed too
+    if record is not None:
+        rc.start_recording(record)
+
     # Executes commands from the .json file
     for command in commands:
         rc.run_command_ext(command)
 
     cpu.bind(rc)
 
+    if metrics is not None:
+        metrics.bind(rc)
+
     cpu.start()
     screen.run()
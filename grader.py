@@ -0,0 +1,383 @@
+# A batch grader for SCP submissions.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+import csv
+import getopt
+import hashlib
+import json
+import logging
+import pathlib
+import sys
+import time
+
+from typing import *
+
+import build_cache
+import tester
+
+__doc__ = """
+Usage:
+
+grader.py -s <spec>                   grading spec (json)
+          <submissions>               folder of submissions, each a .scp file or a folder
+          -j <processes>              number of worker processes (default: one per core)
+          -R <project root>           project root used when assembling (default: each submission's folder)
+          -c <cache folder>           where results are cached (default: <submissions>/.grade_cache)
+          -o <filename>               write scores as CSV
+          -J <filename>               write full results as JSON
+          -N <no cache>               ignore cached results
+
+Spec:
+
+{
+  "entry": "main.scp",                file to assemble in folder submissions
+  "max_instructions": 100000,         budget for every case
+  "timeout": 5,                       seconds for every case
+  "submission_timeout": 60,           seconds before a submission's worker is killed
+  "cases": [
+    {
+      "name": "adds",
+      "points": 1,
+      "setup": {"memory": {"var.a": 3}},
+      "expect": {"ports": {"0xFFF": [3, 5]}}
+    }
+  ]
+}
+
+setup and expect take the same keys as tester.py test specs.
+"""
+
+# Bump when the cached results change format
+CACHE_VERSION = 2
+
+# grading's own files, a change to any of them (or to the assembler, see
+# build_cache.TOOL_FILES) makes every cached result stale
+TOOL_FILES = ("grader.py", "machine.py", "source_coverage.py", "tester.py")
+
+DEFAULT_SUBMISSION_TIMEOUT = 60.0
+
+
+def find_submissions(
+    folder: pathlib.Path, entry: str
+) -> list[tuple[str, pathlib.Path, bool]]:
+    """
+    Every .scp file in 'folder' is a submission, as is every sub folder
+    containing 'entry'. Returns (name, file to assemble, is a folder).
+    """
+    submissions = []
+
+    for path in sorted(folder.iterdir()):
+        if path.name.startswith("."):
+            continue
+
+        if path.is_file() and path.suffix == ".scp":
+            submissions.append((path.stem, path, False))
+
+        elif path.is_dir() and (path / entry).is_file():
+            submissions.append((path.name, path / entry, True))
+
+    return submissions
+
+
+_tool_version: Union[None, str] = None
+
+
+def tool_version() -> str:
+    global _tool_version
+
+    if _tool_version is None:
+        digest = hashlib.sha256(build_cache.tool_version().encode())
+
+        for name in TOOL_FILES:
+            digest.update((pathlib.Path(__file__).parent / name).read_bytes())
+
+        _tool_version = digest.hexdigest()
+
+    return _tool_version
+
+
+def submission_hash(path: pathlib.Path, spec: dict, folder: bool = False) -> str:
+    """
+    Hash of everything known to decide a submission's result before
+    assembling it, its files, the spec and the grader and assembler
+    themselves. Folder submissions hash every file in the folder. Files
+    included from elsewhere are only known after assembling, cached results
+    keep their hashes (see Grader._cached).
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_VERSION}\0{tool_version()}\0".encode())
+    digest.update(json.dumps(spec, sort_keys=True).encode())
+
+    files = [path]
+    if folder:
+        files = sorted(_ for _ in path.parent.rglob("*") if _.is_file())
+
+    for file in files:
+        digest.update(b"\0" + str(file.relative_to(path.parent)).encode() + b"\0")
+        digest.update(file.read_bytes())
+
+    return digest.hexdigest()
+
+
+def grade(path: str, project_root: str, spec: dict) -> dict:
+    """
+    Assembles one submission and runs every case on a fresh machine.
+    Runs in the worker processes. "files" holds the hash of every file the
+    submission read (see build_cache.dependencies), None if it did not
+    assemble.
+    """
+    assembled = tester.assemble(pathlib.Path(path), pathlib.Path(project_root))
+
+    result = {
+        "assembly": {k: v for k, v in assembled.items() if k not in {"words", "roots", "lines", "analysis"}},
+        "cases": [],
+        "score": 0,
+        "files": None,
+    }
+
+    if not assembled["ok"]:
+        return result
+
+    result["files"] = build_cache.dependencies(
+        pathlib.Path(path), map(pathlib.Path, assembled["imports"])
+    )
+
+    defaults = {
+        "max_instructions": spec.get("max_instructions", tester.DEFAULT_MAX_INSTRUCTIONS),
+        "timeout": spec.get("timeout", tester.DEFAULT_TIMEOUT),
+    }
+
+    for i, case in enumerate(spec["cases"]):
+        outcome = tester.run_test(
+            assembled, case.get("name", f"case {i}"), None, case, defaults
+        )
+        outcome["points"] = case.get("points", 1) if outcome["status"] == "passed" else 0
+
+        result["cases"].append(outcome)
+        result["score"] += outcome["points"]
+
+    return result
+
+
+class Grader:
+    """
+    Grades submissions across a tester.WorkerPool, reusing cached results
+    for submissions that have been graded against the same spec before.
+    Identical submissions in one batch are only run once.
+    """
+
+    def __init__(
+        self,
+        spec: dict,
+        cache: Union[None, pathlib.Path] = None,
+        project_root: Union[None, pathlib.Path] = None,
+        processes: Union[None, int] = None,
+    ):
+        self.spec = spec
+        self.cache = cache
+        self.project_root = project_root
+        self.processes = processes
+
+        self.max_score = sum(case.get("points", 1) for case in spec["cases"])
+
+    def _cached(self, key: str) -> Union[None, dict]:
+        """
+        The cached result for 'key', if every file it read is unchanged
+        """
+        if self.cache is None:
+            return None
+
+        try:
+            with open(self.cache / f"{key}.json", encoding="utf-8") as f:
+                cached = json.load(f)
+
+        except (OSError, ValueError):
+            return None
+
+        if any(
+            build_cache.file_hash(pathlib.Path(path)) != digest
+            for path, digest in cached["files"].items()
+        ):
+            return None
+
+        return cached["result"]
+
+    def _store(self, key: str, result: dict, files: dict[str, str]):
+        if self.cache is None:
+            return
+
+        self.cache.mkdir(parents=True, exist_ok=True)
+
+        # write then rename so a killed grader never leaves half a file
+        temp = self.cache / f"{key}.json.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump({"files": files, "result": result}, f)
+
+        temp.replace(self.cache / f"{key}.json")
+
+    def grade(
+        self, submissions: list[tuple[str, pathlib.Path, bool]]
+    ) -> Iterator[tuple[str, dict]]:
+        """
+        Yields (name, result) for every submission as it is graded, cached
+        results first.
+        """
+        waiting = {}
+
+        for name, path, folder in submissions:
+            key = submission_hash(path, self.spec, folder)
+            cached = self._cached(key)
+
+            if cached is not None:
+                yield name, cached | {"cached": True}
+                continue
+
+            waiting.setdefault(key, []).append((name, path))
+
+        tasks = []
+        for key, [(_, path), *_] in waiting.items():
+            root = self.project_root if self.project_root is not None else path.parent
+
+            tasks.append(
+                (
+                    key,
+                    (str(path), str(root), self.spec),
+                    self.spec.get("submission_timeout", DEFAULT_SUBMISSION_TIMEOUT),
+                )
+            )
+
+        pool = tester.WorkerPool(grade, self.processes)
+
+        for key, status, value in pool.imap_unordered(tasks):
+            if status == "done":
+                result = value
+                files = result.pop("files")
+
+                # which files a submission that did not assemble read is
+                # unknown, it is assembled again next time
+                if files is not None:
+                    self._store(key, result, files)
+
+            else:
+                # not cached, a timeout may be down to a busy machine
+                result = {
+                    "assembly": {"ok": False, "seconds": 0.0, "log": []},
+                    "cases": [],
+                    "score": 0,
+                    "error": "Timed out" if status == "timeout" else value,
+                }
+
+            for name, _ in waiting[key]:
+                yield name, result | {"cached": False}
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, paths = getopt.gnu_getopt(sys.argv[1:], "hs:j:R:c:o:J:N", ["help"])
+
+    spec_path = None
+    processes = None
+    project_root = None
+    cache = None
+    use_cache = True
+    csv_path = None
+    json_path = None
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-s":
+            spec_path = pathlib.Path(val)
+
+        if arg == "-j":
+            processes = int(val)
+
+        if arg == "-R":
+            project_root = pathlib.Path(val).resolve()
+
+        if arg == "-c":
+            cache = pathlib.Path(val)
+
+        if arg == "-N":
+            use_cache = False
+
+        if arg == "-o":
+            csv_path = val
+
+        if arg == "-J":
+            json_path = val
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if spec_path is None or len(paths) != 1:
+        _log.critical("A spec and one submissions folder are required, see -h. Exiting.")
+        raise SystemExit(1)
+
+    folder = pathlib.Path(paths[0]).resolve()
+
+    if not folder.is_dir():
+        _log.critical(f"'{folder}' is not a folder. Exiting.")
+        raise SystemExit(1)
+
+    with open(spec_path, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    if cache is None:
+        cache = folder / ".grade_cache"
+
+    submissions = find_submissions(folder, spec.get("entry", "main.scp"))
+
+    if not submissions:
+        _log.critical(f"No submissions found in '{folder}'. Exiting.")
+        raise SystemExit(1)
+
+    grader = Grader(spec, cache if use_cache else None, project_root, processes)
+
+    start = time.perf_counter()
+    results = {}
+
+    for name, result in grader.grade(submissions):
+        results[name] = result
+
+        note = " (cached)" if result["cached"] else ""
+        print(f"{name}: {result['score']}/{grader.max_score}{note}")
+
+        if not result["assembly"]["ok"]:
+            print(f"    {result.get('error') or result['assembly'].get('error')}")
+
+        for case in result["cases"]:
+            if case["status"] != "passed":
+                print(f"    {case['name']}: {case['status']} {case['message']}")
+
+    ran = sum(not _["cached"] for _ in results.values())
+    print(
+        f"\nGraded {len(results)} submissions ({ran} run, {len(results) - ran} cached) "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+    if csv_path is not None:
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["submission", "score", "max"] + [c.get("name", f"case {i}") for i, c in enumerate(spec["cases"])]
+            )
+
+            for name in sorted(results):
+                result = results[name]
+                writer.writerow(
+                    [name, result["score"], grader.max_score]
+                    + [case["points"] for case in result["cases"]]
+                )
+
+    if json_path is not None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(dict(sorted(results.items())), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
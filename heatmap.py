@@ -0,0 +1,140 @@
+# Per address memory access counts for the simplecpu.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Counts instruction fetches, reads and writes per memory address.
+
+The run loop and the memory wrapper only append addresses to flat logs
+(array('H'), so an append is all an access costs), which are folded into
+the numpy counters with np.bincount every few thousand instructions by
+flush(). Counts can be saved as CSV, or as a PNG heatmap of the 4096 words
+laid out 64 to a row.
+"""
+
+import csv
+import struct
+import zlib
+
+from array import array
+
+import numpy as np
+
+KINDS = ("fetches", "reads", "writes")
+
+# words per row of the heatmap
+ROW = 64
+
+
+class AccessCounts:
+    def __init__(self, size: int = 4096):
+        self.size = size
+
+        self.fetches = np.zeros(size, dtype=np.uint64)
+        self.reads = np.zeros(size, dtype=np.uint64)
+        self.writes = np.zeros(size, dtype=np.uint64)
+
+        # addresses accessed since the last flush
+        self.fetch_log = array("H")
+        self.read_log = array("H")
+        self.write_log = array("H")
+
+    def flush(self):
+        """
+        Folds the logs into the counters, only call this from the thread
+        appending to them. Only the CPU's own accesses are logged, other
+        threads (the remote control, the screen) read memory past the logs.
+        """
+        for log, counts in (
+            (self.fetch_log, self.fetches),
+            (self.read_log, self.reads),
+            (self.write_log, self.writes),
+        ):
+            if log:
+                counts += np.bincount(
+                    np.frombuffer(log, dtype=np.uint16), minlength=self.size
+                )[: self.size].astype(np.uint64)
+                del log[:]
+
+    def clear(self):
+        for kind in KINDS:
+            getattr(self, kind)[:] = 0
+
+        del self.fetch_log[:], self.read_log[:], self.write_log[:]
+
+    def counts(self, kind: str = "all") -> np.ndarray:
+        if kind == "all":
+            return self.fetches + self.reads + self.writes
+
+        if kind not in KINDS:
+            raise ValueError(f"Unknown access kind '{kind}', expected all or {', '.join(KINDS)}")
+
+        return getattr(self, kind)
+
+    def busiest(self, n: int = 5, kind: str = "all") -> list[tuple[int, int]]:
+        """
+        (address, count) of the n most accessed addresses
+        """
+        counts = self.counts(kind)
+        addresses = np.argsort(counts, kind="stable")[::-1][:n]
+
+        return [(int(a), int(counts[a])) for a in addresses if counts[a]]
+
+    def save_csv(self, path):
+        total = self.counts()
+
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["address", *KINDS, "total"])
+
+            for address in np.nonzero(total)[0]:
+                writer.writerow(
+                    [f"0x{address:03x}"]
+                    + [int(getattr(self, kind)[address]) for kind in KINDS]
+                    + [int(total[address])]
+                )
+
+    def image(self, kind: str = "all") -> np.ndarray:
+        """
+        (rows, ROW, 3) uint8 heatmap, log scaled from black (never accessed)
+        through red and yellow to white (the most accessed address)
+        """
+        counts = self.counts(kind).astype(np.float64)
+        top = counts.max()
+
+        heat = np.log1p(counts) / np.log1p(top) if top else counts
+        heat = heat.reshape(-1, ROW)
+
+        return (
+            np.stack(
+                [np.clip(heat * 3 - i, 0, 1) for i in range(3)], axis=-1
+            ) * 255
+        ).astype(np.uint8)
+
+    def save_png(self, path, kind: str = "all", scale: int = 8):
+        write_png(path, self.image(kind).repeat(scale, axis=0).repeat(scale, axis=1))
+
+
+def write_png(path, rgb: np.ndarray):
+    """
+    Writes a (height, width, 3) uint8 array as an RGB PNG
+    """
+    height, width, _ = rgb.shape
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + tag
+            + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+        )
+
+    # every row starts with filter type 0 (none)
+    raw = b"".join(b"\x00" + row.tobytes() for row in rgb)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
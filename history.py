@@ -0,0 +1,248 @@
+# Execution history for stepping the simplecpu backwards.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Keeps enough history to put a CPUCore back at any recent instruction.
+
+Every 'interval' instructions a checkpoint of the registers, stack, pc,
+flags and opcode counts is taken, and between checkpoints every memory write
+is logged with the value it overwrote. Going back to instruction N undoes
+the logged writes down to the nearest checkpoint before N, restores it and
+re-executes forward to N, re-applying any external inputs (see
+CPUCore._apply_input) and counting opcodes on the way. Re-executed accesses
+are not counted by the heatmap again.
+
+The oldest checkpoints (and their writes) are dropped once more than
+'max_writes' writes or 'max_checkpoints' checkpoints are held, each write
+takes 12 bytes.
+"""
+
+import bisect
+
+from array import array
+from typing import Iterable, NamedTuple, Union
+
+import numpy as np
+
+
+class Checkpoint(NamedTuple):
+    instruction: int
+    # CPUCore.snapshot without the memory
+    state: dict
+    # CPUCore._opcode_counts, the cycles and metrics come from them
+    opcode_counts: list[int]
+    # (instruction - checkpoint instruction, address, old value) for every
+    # memory write after the checkpoint, flattened
+    writes: array
+
+
+class History:
+    def __init__(
+        self,
+        core,
+        interval: int = 10_000,
+        max_writes: int = 4_000_000,
+        max_checkpoints: int = 10_000,
+    ):
+        self._core = core
+        self.interval = interval
+        self.max_writes = max_writes
+        self.max_checkpoints = max_checkpoints
+
+        self._checkpoints: list[Checkpoint] = []
+        self._inputs: list[tuple[int, str, tuple]] = []
+        self._writes = 0
+
+        self.next_checkpoint = 0
+        # set while re-executing, so the CPU can skip side effects (e.g.
+        # messages about the program halting)
+        self.replaying = False
+
+    def start(self):
+        self.checkpoint()
+
+    def stop(self):
+        self._core._memory.undo_log = None
+        self._checkpoints.clear()
+        self._inputs.clear()
+        self._writes = 0
+
+    @property
+    def oldest(self) -> int:
+        """
+        The earliest instruction that can be gone back to
+        """
+        return self._checkpoints[0].instruction
+
+    @property
+    def writes(self) -> int:
+        return self._writes + len(self._core._memory.undo_log or ()) // 3
+
+    @property
+    def checkpoints(self) -> int:
+        return len(self._checkpoints)
+
+    def checkpoint(self):
+        """
+        Takes a checkpoint at the current instruction, called by the run
+        loop when it reaches next_checkpoint
+        """
+        memory = self._core._memory
+        instruction = self._core._total_instructions
+
+        if self._checkpoints:
+            self._writes += len(self._checkpoints[-1].writes) // 3
+
+        writes = array("I")
+        self._checkpoints.append(
+            Checkpoint(
+                instruction,
+                self._core.snapshot(memory=False),
+                list(self._core._opcode_counts),
+                writes,
+            )
+        )
+
+        memory.undo_log = writes
+        memory.undo_base = instruction
+
+        self.next_checkpoint = instruction + self.interval
+
+        while len(self._checkpoints) > 1 and (
+            self._writes > self.max_writes
+            or len(self._checkpoints) > self.max_checkpoints
+        ):
+            dropped = self._checkpoints.pop(0)
+            self._writes -= len(dropped.writes) // 3
+
+        oldest = self._checkpoints[0].instruction
+        while self._inputs and self._inputs[0][0] < oldest:
+            self._inputs.pop(0)
+
+    def log_input(self, instruction: int, kind: str, args: tuple):
+        self._inputs.append((instruction, kind, args))
+
+    def _segments(self):
+        return [
+            np.frombuffer(cp.writes, dtype=np.uint32).reshape(-1, 3)
+            for cp in self._checkpoints
+        ]
+
+    def last_write(
+        self, addresses: Iterable[int], before: int
+    ) -> Union[None, tuple[int, int]]:
+        """
+        (instruction, address) of the last write to any of 'addresses'
+        before instruction 'before', None if there isn't one in the history
+        """
+        addresses = list(addresses)
+
+        for cp, writes in zip(reversed(self._checkpoints), reversed(self._segments())):
+            instructions = writes[:, 0].astype(np.int64) + cp.instruction
+            hits = np.nonzero(np.isin(writes[:, 1], addresses) & (instructions < before))[0]
+
+            if len(hits):
+                return int(instructions[hits[-1]]), int(writes[hits[-1], 1])
+
+        return None
+
+    def goto(self, instruction: int) -> bool:
+        """
+        Puts the core back at 'instruction' (before it executes), returns
+        False if it is outside of the history
+        """
+        core = self._core
+
+        if not self._checkpoints or not self.oldest <= instruction <= core._total_instructions:
+            return False
+
+        i = bisect.bisect_right([cp.instruction for cp in self._checkpoints], instruction) - 1
+        checkpoint = self._checkpoints[i]
+
+        # undo newest first, so each address ends on its oldest logged value
+        memory = core._memory._memory
+        for writes in reversed(self._segments()[i:]):
+            addresses, first = np.unique(writes[:, 1], return_index=True)
+            memory[addresses] = writes[first, 2]
+
+            if len(addresses):
+                core._memory.touch(int(addresses[0]), int(addresses[-1]) + 1)
+
+        core.restore(checkpoint.state)
+        # in place, the run loops hold on to the list
+        core._opcode_counts[:] = checkpoint.opcode_counts
+
+        # checkpoint() below counts the last remaining checkpoint's writes
+        del self._checkpoints[i:]
+        self._writes = sum(len(cp.writes) // 3 for cp in self._checkpoints[:-1])
+
+        # the future after 'instruction' is rewritten
+        inputs = [_ for _ in self._inputs if checkpoint.instruction <= _[0] <= instruction]
+        self._inputs = [_ for _ in self._inputs if _[0] <= instruction]
+
+        self.checkpoint()
+        self._execute_to(instruction, inputs)
+
+        return True
+
+    def _execute_to(self, instruction: int, inputs: list[tuple[int, str, tuple]]):
+        core = self._core
+        base, extended = core._decode_tables()
+        memory = core._memory
+        fetch_from = memory._memory
+        counts = core._opcode_counts
+
+        hook, memory.mem_change_hook = memory.mem_change_hook, None
+        # the heatmap already counted these accesses the first time
+        read_log, memory.read_log = memory.read_log, None
+        write_log, memory.write_log = memory.write_log, None
+        self.replaying = True
+
+        try:
+            while True:
+                at = core._total_instructions
+
+                while inputs and inputs[0][0] == at:
+                    _, kind, args = inputs.pop(0)
+                    core._apply_input(kind, args)
+
+                if at >= instruction:
+                    break
+
+                if at >= self.next_checkpoint:
+                    self.checkpoint()
+
+                pc = core._pc
+                ir = int(fetch_from[pc])
+                core._pc = pc + 1
+
+                op = ir >> 12
+                if op == 0b1111:
+                    op = 16 + (ir & 0x0F)
+                    func = extended[ir & 0x0F]
+                else:
+                    func = base[op]
+
+                func(
+                    (ir >> 11) & 1,
+                    (ir >> 10) & 1,
+                    (ir >> 9) & 1,
+                    (ir >> 8) & 1,
+                    (ir >> 4) & 0xF,
+                    ir & 0xF,
+                )
+
+                counts[op] += 1
+                core._total_instructions += 1
+
+        except NotImplementedError:
+            # the original run stopped here too
+            core._pc -= 1
+
+        finally:
+            memory.mem_change_hook = hook
+            memory.read_log = read_log
+            memory.write_log = write_log
+            self.replaying = False
@@ -0,0 +1,992 @@
+# A headless core for the simplecpu emulator.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+The simplecpu itself, without any threads or UI.
+
+CPUCore holds the registers, memory and instruction implementations and is
+shared by the emulator's CPU thread and by Machine, a synchronous machine for
+driving programs from plain python (e.g. a pytest suite):
+
+    machine = Machine()
+    machine.load(compiled_words, at=0)
+    result = machine.run_until(pc=0x20, max_instructions=10000)
+
+    assert result.reason == BREAKPOINT
+    assert machine.get_register("RA") == 5
+"""
+
+import hashlib
+import time
+
+from typing import Callable, Iterable, NamedTuple, Union
+
+import numpy as np
+
+from cycles import CycleTable
+
+# Reasons a Machine run stopped
+HALTED = "halted"  # the program jumped to itself
+BUDGET = "budget"  # max_instructions were executed
+BREAKPOINT = "pc"  # the pc reached one of the requested addresses
+PREDICATE = "predicate"  # the predicate returned True
+UNIMPLEMENTED = "unimplemented"  # the program hit an unimplemented instruction
+FAULT = "fault"  # the program went outside of memory or the stack
+RETURNED = "returned"  # the subroutine started by Machine.call returned
+TIMEOUT = "timeout"  # the run took longer than its timeout
+
+# instructions run between checks of the wall clock when a timeout is set
+_TIMEOUT_CHUNK = 10000
+
+# return address pushed by Machine.call, outside of the 4096 word memory so
+# the program can never reach it by itself
+_CALL_SENTINEL = 0xFFFF
+
+# memory is tracked for changes in pages of PAGE_WORDS words
+PAGE_SHIFT = 6
+PAGE_WORDS = 1 << PAGE_SHIFT
+
+
+def parse_asc(code: str) -> tuple[int, list[str]]:
+    """
+    Splits the contents of an .asc file into its start address and words
+    """
+    code = code.strip().split("\n")
+
+    memory_start = int(code[0].split(" ")[0], 16)
+
+    words = []
+    for line in code:
+        words.extend(line.strip().split(" ")[1:])
+
+    return memory_start, words
+
+
+class CPUCore:
+    class memwrap:
+        def __init__(self, root):
+            self._memory = np.zeros(4096, dtype=np.uint16)
+            self.mem_change_hook = None
+            self.__root = root
+
+            # (instruction - undo_base, address, old value) of every write
+            # while set, see history.History
+            self.undo_log = None
+            self.undo_base = 0
+            # addresses read and written while set, see heatmap.AccessCounts
+            self.read_log = None
+            self.write_log = None
+
+            # bumped by every write, each page remembers the generation it
+            # was last written in, see dirty_pages
+            self.generation = 0
+            self.page_generations = [0] * (len(self._memory) >> PAGE_SHIFT)
+
+        def __getitem__(self, key):
+            if key == self.__root.debug_port:
+                print(
+                    f"Attempted to read from {self.__root.debug_port:x}, enabling debug mode"
+                )
+                self.__root.debug = True
+
+            if self.read_log is not None:
+                self.read_log.append(key)
+
+            return self._memory[key]
+
+        def __setitem__(self, key, value):
+            if key == self.__root.debug_port:
+                print(
+                    f"Attempted to write to {self.__root.debug_port:x}, enabling debug mode"
+                )
+                self.__root.debug = True
+
+            if self.mem_change_hook:
+                self.mem_change_hook(key, value)
+
+            if self.write_log is not None:
+                self.write_log.append(key)
+
+            if self.undo_log is not None:
+                self.undo_log.extend(
+                    (self.__root._total_instructions - self.undo_base, key, self._memory[key])
+                )
+
+            self._memory[key] = value
+
+            # stamped before the generation moves on, so a reader that saw
+            # the old generation still finds this page next time
+            self.page_generations[key >> PAGE_SHIFT] = self.generation + 1
+            self.generation += 1
+
+        def touch(self, start: int = 0, end: Union[None, int] = None):
+            """
+            Marks the pages holding [start, end) as written, for changes
+            made to the array directly
+            """
+            end = len(self._memory) if end is None else end
+
+            if end <= start:
+                return
+
+            generation = self.generation + 1
+            for page in range(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+                self.page_generations[page] = generation
+            self.generation = generation
+
+        def dirty_pages(self, since: int) -> list[int]:
+            """
+            Pages written after generation 'since'. Read .generation before
+            looking at the memory and pass it next time.
+            """
+            return [page for page, g in enumerate(self.page_generations) if g > since]
+
+        def changed(self, start: int, end: int, since: int) -> bool:
+            """
+            If any page holding [start, end) was written after 'since'
+            """
+            pages = self.page_generations[start >> PAGE_SHIFT : ((end - 1) >> PAGE_SHIFT) + 1]
+            return max(pages, default=0) > since
+
+        def clear(self):
+            if self.undo_log is not None:
+                at = self.__root._total_instructions - self.undo_base
+                for key in np.nonzero(self._memory)[0]:
+                    self.undo_log.extend((at, key, self._memory[key]))
+
+            # cleared in place so run loops holding the array stay valid
+            self._memory[:] = 0
+            self.touch()
+
+        def load(self, at, values):
+            # bulk write that bypasses the debug port and change hook
+            self._memory[at : at + len(values)] = values
+            self.touch(at, at + len(values))
+
+    def __init__(self):
+        self._memory = self.memwrap(self)
+        self._registers = np.zeros(4, dtype=np.uint16)
+        self.__stack = np.zeros(4, dtype=np.uint16)
+        self.__stack_pointer = 0
+        self._pc = 0
+        self.__ir = 0
+
+        self.__flags_zero = False
+        self.__flags_carry = False
+        self.__flags_overflow = False
+        self.__flags_positive = False
+        self.__flags_negative = False
+
+        self._current_instruction_rel_func = None
+
+        self._total_instructions = 0
+        # per opcode execution counts, extended opcodes at 16 + ir03ir00,
+        # see cycles.OPCODE_NAMES
+        self._opcode_counts = [0] * 32
+        self._cycle_table = CycleTable()
+
+        self._debug = False
+        self._debug_port = -1
+
+    @property
+    def debug(self):
+        return self._debug
+
+    @debug.setter
+    def debug(self, value):
+        self._debug = value
+
+    @property
+    def debug_port(self):
+        return self._debug_port
+
+    @debug_port.setter
+    def debug_port(self, value):
+        self._debug_port = value
+
+    def self_loop(self):
+        # called by the jump instructions when they jump to themselves
+        pass
+
+    def _reset_state(self):
+        self._memory.clear()
+        self._registers[:] = 0
+        self.__stack[:] = 0
+        self.__stack_pointer = 0
+        self._pc = 0
+        self.__ir = 0
+
+        self.__flags_zero = False
+        self.__flags_carry = False
+        self.__flags_overflow = False
+        self.__flags_positive = False
+        self.__flags_negative = False
+
+        self._total_instructions = 0
+        self._opcode_counts[:] = [0] * 32
+
+    @property
+    def cycle_table(self) -> CycleTable:
+        return self._cycle_table
+
+    @cycle_table.setter
+    def cycle_table(self, value: CycleTable):
+        self._cycle_table = value
+
+    @property
+    def cycles(self) -> int:
+        """
+        Clock cycles the counted instructions would have taken on the board
+        """
+        return self._cycle_table.total(self._opcode_counts)
+
+    def _flags(self):
+        return {
+            "zero": bool(self.__flags_zero),
+            "carry": bool(self.__flags_carry),
+            "overflow": bool(self.__flags_overflow),
+            "negative": bool(self.__flags_negative),
+            "positive": bool(self.__flags_positive),
+        }
+
+    def _stack(self):
+        return [int(_) for _ in self.__stack[: self.__stack_pointer]]
+
+    def _push(self, value):
+        self.__stack[self.__stack_pointer] = value
+        self.__stack_pointer += 1
+
+    def snapshot(self, memory: bool = True) -> dict:
+        """
+        Copy of the architectural state, see restore. Without the memory
+        (None) when 'memory' is False.
+        """
+        return {
+            "memory": self._memory._memory.copy() if memory else None,
+            "registers": self._registers.copy(),
+            "stack": self.__stack.copy(),
+            "stack_pointer": self.__stack_pointer,
+            "pc": int(self._pc),
+            "flags": self._flags(),
+            "total_instructions": self._total_instructions,
+        }
+
+    def memory_changes(self, since: int) -> tuple[int, list[tuple[int, np.ndarray]]]:
+        """
+        (generation, [(address, words)]) for every run of pages written
+        after generation 'since', pass the generation back next time. The
+        changes can be put in a snapshot's memory, see restore.
+        """
+        memory = self._memory
+        generation = memory.generation
+
+        changes = []
+        for page in memory.dirty_pages(since):
+            start = page << PAGE_SHIFT
+
+            if changes and changes[-1][0] + len(changes[-1][1]) == start:
+                changes[-1][1] = np.concatenate([changes[-1][1], memory._memory[start : start + PAGE_WORDS]])
+            else:
+                changes.append([start, memory._memory[start : start + PAGE_WORDS].copy()])
+
+        return generation, [(start, words) for start, words in changes]
+
+    def restore(self, snapshot: dict):
+        """
+        Puts the state of a snapshot back. Its memory can also be a list of
+        (address, words) changes (see memory_changes) to apply.
+        """
+        # in place, run loops hold on to the memory array
+        if isinstance(snapshot["memory"], list):
+            for start, words in snapshot["memory"]:
+                self._memory._memory[start : start + len(words)] = words
+                self._memory.touch(start, start + len(words))
+
+        elif snapshot["memory"] is not None:
+            self._memory._memory[:] = snapshot["memory"]
+            self._memory.touch()
+
+        self._registers[:] = snapshot["registers"]
+        self.__stack[:] = snapshot["stack"]
+        self.__stack_pointer = snapshot["stack_pointer"]
+        self._pc = snapshot["pc"]
+
+        flags = snapshot["flags"]
+        self.__flags_zero = flags["zero"]
+        self.__flags_carry = flags["carry"]
+        self.__flags_overflow = flags["overflow"]
+        self.__flags_negative = flags["negative"]
+        self.__flags_positive = flags["positive"]
+
+        self._total_instructions = snapshot["total_instructions"]
+
+    def state_hash(self) -> str:
+        """
+        Hash of the architectural state (memory, registers, stack, pc and
+        flags), equal for two machines that will behave the same
+        """
+        digest = hashlib.sha256()
+        digest.update(self._memory._memory.tobytes())
+        digest.update(self._registers.tobytes())
+        digest.update(self.__stack.tobytes())
+        digest.update(bytes([self.__stack_pointer, *map(int, self._flags().values())]))
+        digest.update(int(self._pc).to_bytes(4, "little"))
+
+        return digest.hexdigest()
+
+    def _apply_input(self, kind: str, args: tuple):
+        """
+        Applies an external input (a remote control command or a device),
+        these are what a recorded session logs and replays
+        """
+        if kind == "setmem":
+            address, value = args
+            self._set_mem(address, value)
+
+        elif kind == "writemem":
+            address, values = args
+            for i, value in enumerate(values):
+                self._set_mem(address + i, value)
+
+        elif kind == "loadmem":
+            address, words = args
+            self.load_memory(address, words)
+
+        elif kind == "clearmem":
+            self._memory.clear()
+
+        elif kind == "setreg":
+            register, value = args
+            self._registers[register] = value
+
+        elif kind == "setpc":
+            self._pc = args[0]
+
+        else:
+            raise ValueError(f"Unknown input '{kind}'")
+
+    def _print_state(self):
+        print(f"Registers: {self._registers}")
+        print(f"Stack: {self.__stack}")
+        print(f"Stack Pointer: {self.__stack_pointer}")
+        print(f"PC: {self._pc}")
+        print(f"IR: {self.__ir}")
+        print(f"Carry: {self.__flags_carry}")
+        print(f"Zero: {self.__flags_zero}")
+        print(f"Overflow: {self.__flags_overflow}")
+        print(f"Negative: {self.__flags_negative}")
+        print(f"Positive: {self.__flags_positive}")
+        print()
+
+    def load_memory(self, at, memory):
+        for i, c in enumerate(memory):
+            self._memory[i + at] = int(c, 16)
+
+    def _get_mem(self, at):
+        return self._memory[at]
+
+    def _set_mem(self, at, value):
+        self._memory[at] = value
+
+    def _MOVE(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        value = ir07ir04 << 4 | ir03ir00
+
+        self._registers[dest] = value
+
+    def _ADD(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        value = ir07ir04 << 4 | ir03ir00
+
+        self.__flags_carry = self._registers[dest] + value > 0xFFFF
+
+        v = self._registers[dest] + value
+
+        self.__flags_zero = v == 0
+        self.__flags_overflow = v > 0xFFFF
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[dest] = v
+
+    def _SUB(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        value = ir07ir04 << 4 | ir03ir00
+
+        v = self._registers[dest] - value
+
+        self.__flags_carry = False
+        self.__flags_zero = v == 0
+        self.__flags_overflow = v < 0
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[dest] = v
+
+    def _AND(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        value = ir07ir04 << 4 | ir03ir00
+
+        self.__flags_carry = False
+
+        v = self._registers[dest] & value
+
+        self.__flags_zero = v == 0
+        self.__flags_overflow = False
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[dest] = v
+
+    def _LOAD(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+        self._registers[0] = self._memory[value]
+
+    def _STORE(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        self._memory[value] = self._registers[0]
+
+    def _ADDM(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        value = self._memory[value]
+
+        self.__flags_carry = self._registers[0] + value > 0xFFFF
+
+        v = self._registers[0] + value
+
+        self.__flags_zero = v == 0
+        self.__flags_overflow = v > 0xFFFF
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[0] = v
+
+    def _SUBM(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        value = self._memory[value]
+
+
+        v = self._registers[0] - value
+
+        self.__flags_carry = False
+        self.__flags_zero = v == 0
+        self.__flags_overflow = v < 0xFFFF
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[0] = v
+
+    def _JUMPU(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        if self._pc - 1 == value:
+            self.self_loop()
+
+        self._pc = value
+
+    def _JUMPZ(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        if self._pc - 1 == value:
+            self.self_loop()
+
+        if self.__flags_zero:
+            self._pc = value
+
+    def _JUMPNZ(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        if self._pc - 1 == value:
+            self.self_loop()
+
+        if not self.__flags_zero:
+            self._pc = value
+
+    def _JUMPC(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        if self._pc - 1 == value:
+            self.self_loop()
+
+        if self.__flags_carry:
+            self._pc = value
+
+    def _CALL(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        self.__stack[self.__stack_pointer] = self._pc
+        self.__stack_pointer += 1
+
+        value = (
+                ir11 << 11 | ir10 << 10 | ir09 << 9 | ir08 << 8 | ir07ir04 << 4 | ir03ir00
+        )
+
+        self._pc = value
+
+    def _OR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("OR")
+
+    def _XOP1(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("XOP1")
+
+    def _RET(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        self.__stack_pointer -= 1
+        self._pc = self.__stack[self.__stack_pointer]
+
+    def _MOVER(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        src = ir09 << 1 | ir08
+
+        self._registers[dest] = self._registers[src]
+
+    def _LOADR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        src = ir09 << 1 | ir08
+
+        self._registers[dest] = self._memory[self._registers[src]]
+
+    def _STORER(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        src = ir11 << 1 | ir10
+        dest = ir09 << 1 | ir08
+
+        self._memory[self._registers[dest]] = self._registers[src]
+
+    def _ROL(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        src = ir09 << 1 | ir08
+
+        self.__flags_overflow = self._registers[dest] & 0x8000
+
+        self._registers[dest] = (self._registers[dest] << 1) | (
+                self._registers[dest] >> 15
+        )
+
+        self.__flags_zero = self._registers[dest] == 0
+        self.__flags_carry = False
+        self.__flags_negative = self._registers[dest] & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+    def _ROR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("ROR")
+        # dest = ir11 << 1 | ir10
+        # src = ir09 << 1 | ir08
+        #
+        # self.__flags_overflow = self._registers[dest] & 0x0001
+        #
+        # self._registers[dest] = (self._registers[dest] >> 1) | (
+        #     self._registers[dest] << 15
+        #         self._registers[src] << 15
+        # )
+        #
+        # self.__flags_zero = self._registers[dest] == 0
+        # self.__flags_carry = False
+        # self.__flags_negative = self._registers[dest] & 0x8000
+        # self.__flags_positive = not self.__flags_negative
+
+    def _ADDR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("ADDR")
+        # dest = ir11 << 1 | ir10
+        # src = ir09 << 1 | ir08
+        #
+        # self.__flags_carry = self._registers[dest] + self._registers[src] > 0xFFFF
+        #
+        # v = int(self._registers[dest]) + int(self._registers[src])
+        #
+        # self.__flags_zero = v == 0
+        # self.__flags_overflow = v > 0xFFFF
+        # self.__flags_negative = v & 0x8000
+        # self.__flags_positive = not self.__flags_negative
+        #
+        # self._registers[dest] = v & 0xFFFF
+
+    def _SUBR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("SUBR")
+        # dest = ir11 << 1 | ir10
+        # src = ir09 << 1 | ir08
+        #
+        # self.__flags_carry = self._registers[dest] < self._registers[src]
+        #
+        # v = int(self._registers[dest]) - int(self._registers[src])
+        #
+        # self.__flags_zero = v == 0
+        # self.__flags_overflow = v > 0xFFFF
+        # self.__flags_negative = v & 0x8000
+        # self.__flags_positive = not self.__flags_negative
+        #
+        # self._registers[dest] = v & 0xFFFF
+
+    def _ANDR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("ANDR")
+
+    def _ORR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("ORR")
+
+    def _XORR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        dest = ir11 << 1 | ir10
+        src = ir09 << 1 | ir08
+
+        v = int(self._registers[dest]) ^ int(self._registers[src])
+
+        self.__flags_carry = False
+        self.__flags_zero = v == 0
+        self.__flags_overflow = v > 0xFFFF
+        self.__flags_negative = v & 0x8000
+        self.__flags_positive = not self.__flags_negative
+
+        self._registers[dest] = v & 0xFFFF
+
+    def _ASLR(self, ir11, ir10, ir09, ir08, ir07ir04, ir03ir00):
+        raise NotImplementedError("ASLR")
+
+    def _XOP2(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
+        raise NotImplementedError("XOP2")
+
+    def _XOP3(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
+        raise NotImplementedError("XOP3")
+
+    def _XOP4(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
+        raise NotImplementedError("XOP4")
+
+    def _XOP5(self, ir11, ir10, ir09, ir08, ir08ir04, ir03ir00):
+        raise NotImplementedError("XOP5")
+
+    def _decode_tables(self):
+        """
+        Returns the (opcode, extended opcode) lookup tables used by the
+        run loops, extended instructions are the ones with an opcode of 0b1111
+        """
+        return (
+            [
+                self._MOVE,
+                self._ADD,
+                self._SUB,
+                self._AND,
+                self._LOAD,
+                self._STORE,
+                self._ADDM,
+                self._SUBM,
+                self._JUMPU,
+                self._JUMPZ,
+                self._JUMPNZ,
+                self._JUMPC,
+                self._CALL,
+                self._OR,
+                self._XOP1,
+                None,
+            ],
+            [
+                self._RET,
+                self._MOVER,
+                self._LOADR,
+                self._STORER,
+                self._ROL,
+                self._ROR,
+                self._ADDR,
+                self._SUBR,
+                self._ANDR,
+                self._ORR,
+                self._XORR,
+                self._ASLR,
+                self._XOP2,
+                self._XOP3,
+                self._XOP4,
+                self._XOP5,
+            ],
+        )
+
+    def opcode_names(self):
+        """
+        Names of the instructions in the order of _opcode_counts
+        """
+        base, extended = self._decode_tables()
+
+        return [
+            func.__name__[1:] if func is not None else None
+            for func in base + extended
+        ]
+
+    def _decode_instruction_rel_func(self, ir):
+        base, extended = self._decode_tables()
+
+        if ir >> 12 == 0b1111:
+            return extended[ir & 0x0F]
+
+        return base[ir >> 12]
+
+    def _fetch(self):
+        self.__ir = self._get_mem(self._pc)
+        self._pc += 1
+
+        if self.debug:
+            print(f"Fetched: {self.__ir} at {self._pc - 1}")
+
+    def _decode(self):
+        self._current_instruction_rel_func = self._decode_instruction_rel_func(
+            self.__ir
+        )
+
+        if self.debug:
+            print(f"Decoded: {self._current_instruction_rel_func.__name__}")
+
+    def _execute(self):
+        ir11 = (self.__ir >> 11) & 1
+        ir10 = (self.__ir >> 10) & 1
+        ir09 = (self.__ir >> 9) & 1
+        ir08 = (self.__ir >> 8) & 1
+        ir07ir04 = (self.__ir >> 4) & 0xF
+        ir03ir00 = self.__ir & 0xF
+
+        self._current_instruction_rel_func(ir11, ir10, ir09, ir08, ir07ir04, ir03ir00)
+
+        if self.debug:
+            print(f"Executed: {self._current_instruction_rel_func.__name__}")
+
+
+class RunResult(NamedTuple):
+    reason: str
+    instructions: int
+    pc: int
+    error: Union[None, str] = None
+
+
+class Machine(CPUCore):
+    """
+    A synchronous simplecpu, nothing runs unless one of the run methods is
+    called and they return once the program stops.
+    """
+
+    _register_names = {"RA": 0, "RB": 1, "RC": 2, "RD": 3}
+
+    def __init__(self):
+        super().__init__()
+
+        self._tables = self._decode_tables()
+        self._halted = False
+
+        # set to a list of 4096 zeros to count how many times the
+        # instruction at each address is executed
+        self.coverage: Union[None, list[int]] = None
+
+    def self_loop(self):
+        self._halted = True
+
+    def reset(self):
+        self._reset_state()
+        self._halted = False
+
+    def load(self, words: Iterable[Union[int, str]], at: int = 0):
+        """
+        Loads words (ints, or hex strings like the assembler outputs) into
+        memory starting at 'at'
+        """
+        self._memory.load(
+            at, [int(w, 16) if isinstance(w, str) else int(w) for w in words]
+        )
+
+    def load_asc(self, code: str):
+        at, words = parse_asc(code)
+        self.load(words, at)
+
+    @property
+    def pc(self) -> int:
+        return int(self._pc)
+
+    @pc.setter
+    def pc(self, value: int):
+        self._pc = value
+
+    @property
+    def total_instructions(self) -> int:
+        return self._total_instructions
+
+    @property
+    def memory(self) -> np.ndarray:
+        return self._memory._memory
+
+    @property
+    def registers(self) -> tuple[int, int, int, int]:
+        return tuple(int(_) for _ in self._registers)
+
+    @property
+    def flags(self) -> dict[str, bool]:
+        return self._flags()
+
+    @property
+    def stack(self) -> list[int]:
+        return self._stack()
+
+    def _register_index(self, register: Union[int, str]) -> int:
+        if isinstance(register, str):
+            return self._register_names[register.upper()]
+
+        return register
+
+    def get_register(self, register: Union[int, str]) -> int:
+        return int(self._registers[self._register_index(register)])
+
+    def set_register(self, register: Union[int, str], value: int):
+        self._registers[self._register_index(register)] = value
+
+    def read(self, address: int, length: Union[None, int] = None):
+        """
+        Reads one word, or a list of 'length' words, without triggering the
+        debug port
+        """
+        if length is None:
+            return int(self._memory._memory[address])
+
+        return [int(_) for _ in self._memory._memory[address : address + length]]
+
+    def write(self, address: int, value: int):
+        self._memory[address] = value
+
+    def run(
+        self,
+        max_instructions: Union[None, int] = None,
+        timeout: Union[None, float] = None,
+    ) -> RunResult:
+        return self.run_until(max_instructions=max_instructions, timeout=timeout)
+
+    def call(
+        self,
+        address: int,
+        predicate: Union[None, Callable[["Machine"], bool]] = None,
+        max_instructions: Union[None, int] = None,
+        timeout: Union[None, float] = None,
+    ) -> RunResult:
+        """
+        Runs the subroutine at 'address' like a call instruction would,
+        stopping with RETURNED when it returns.
+        """
+        self._push(_CALL_SENTINEL)
+        self._pc = address
+
+        result = self.run_until(_CALL_SENTINEL, predicate, max_instructions, timeout)
+
+        if result.reason == BREAKPOINT:
+            return result._replace(reason=RETURNED)
+
+        return result
+
+    def run_until(
+        self,
+        pc: Union[None, int, Iterable[int]] = None,
+        predicate: Union[None, Callable[["Machine"], bool]] = None,
+        max_instructions: Union[None, int] = None,
+        timeout: Union[None, float] = None,
+    ) -> RunResult:
+        """
+        Runs until the program halts (jumps to itself), the pc reaches one of
+        'pc' after an instruction, predicate(machine) returns True after an
+        instruction, max_instructions have been executed or timeout seconds
+        have passed.
+        """
+        if pc is None:
+            stops = ()
+        elif isinstance(pc, int):
+            stops = {pc}
+        else:
+            stops = set(pc)
+
+        base, extended = self._tables
+        memory = self._memory
+        fetch_from = memory._memory if self._debug_port < 0 else memory
+        counts = self._opcode_counts
+        covered = self.coverage
+
+        budget = -1 if max_instructions is None else max_instructions
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        executed = 0
+        reason = None
+        error = None
+        at = self._pc
+
+        self._halted = False
+
+        try:
+            while reason is None:
+                # with a timeout the loop runs in chunks, checking the clock
+                # between them
+                stop_at = budget
+                if deadline is not None:
+                    stop_at = executed + _TIMEOUT_CHUNK
+                    if budget != -1:
+                        stop_at = min(stop_at, budget)
+
+                while executed != stop_at:
+                    at = self._pc
+                    ir = int(fetch_from[at])
+                    self._pc = at + 1
+
+                    op = ir >> 12
+                    if op == 0b1111:
+                        op = 16 + (ir & 0x0F)
+                        func = extended[ir & 0x0F]
+                    else:
+                        func = base[op]
+
+                    func(
+                        (ir >> 11) & 1,
+                        (ir >> 10) & 1,
+                        (ir >> 9) & 1,
+                        (ir >> 8) & 1,
+                        (ir >> 4) & 0xF,
+                        ir & 0xF,
+                    )
+
+                    counts[op] += 1
+                    executed += 1
+
+                    if covered is not None:
+                        covered[at] += 1
+
+                    if self._halted:
+                        reason = HALTED
+                        break
+
+                    if stops and self._pc in stops:
+                        reason = BREAKPOINT
+                        break
+
+                    if predicate is not None and predicate(self):
+                        reason = PREDICATE
+                        break
+
+                else:
+                    if executed == budget:
+                        reason = BUDGET
+
+                    elif time.perf_counter() > deadline:
+                        reason = TIMEOUT
+
+        except NotImplementedError as e:
+            # leave the pc on the instruction that could not be executed
+            self._pc = at
+            reason, error = UNIMPLEMENTED, str(e)
+
+        except IndexError as e:
+            reason, error = FAULT, str(e)
+
+        finally:
+            self._total_instructions += executed
+
+        return RunResult(reason, executed, int(self._pc), error)
@@ -0,0 +1,218 @@
+# Replays recorded emulator sessions.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+A recording holds the state the emulator was in when recording started and
+every external input (remote control commands like setmem, loadasc or setpc)
+with the instruction count it was applied at. Replaying it on a Machine at
+full speed, with no UI, ends in exactly the same state, which is checked
+against the hash taken when recording stopped.
+
+Usage:
+
+replay.py <recording>                 replay and check the final state
+          -u <instruction>            stop at this instruction count and show the state
+          -v <verbose>                show every input as it is applied
+"""
+
+import base64
+import getopt
+import json
+import logging
+import sys
+import time
+
+from typing import Union
+
+import numpy as np
+
+from machine import FAULT, HALTED, UNIMPLEMENTED, Machine
+
+VERSION = 1
+
+
+def encode_snapshot(snapshot: dict) -> dict:
+    return {
+        "memory": base64.b64encode(snapshot["memory"].astype("<u2").tobytes()).decode(),
+        "registers": [int(_) for _ in snapshot["registers"]],
+        "stack": [int(_) for _ in snapshot["stack"]],
+        "stack_pointer": int(snapshot["stack_pointer"]),
+        "pc": int(snapshot["pc"]),
+        "flags": {k: bool(v) for k, v in snapshot["flags"].items()},
+        "total_instructions": int(snapshot["total_instructions"]),
+    }
+
+
+def decode_snapshot(data: dict) -> dict:
+    return data | {
+        "memory": np.frombuffer(base64.b64decode(data["memory"]), dtype="<u2").astype(np.uint16),
+        "registers": np.array(data["registers"], dtype=np.uint16),
+        "stack": np.array(data["stack"], dtype=np.uint16),
+    }
+
+
+def _plain(value):
+    # numpy numbers (and tuples of them) from the inputs' arguments
+    if isinstance(value, (list, tuple)):
+        return [_plain(_) for _ in value]
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def save(path, recording: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": VERSION,
+                "start": encode_snapshot(recording["start"]),
+                "inputs": [[at, kind, _plain(args)] for at, kind, args in recording["inputs"]],
+                "end": recording["end"],
+            },
+            f,
+        )
+
+
+def load(path) -> dict:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    if data.get("version") != VERSION:
+        raise ValueError(f"Unsupported recording version {data.get('version')}")
+
+    data["start"] = decode_snapshot(data["start"])
+    data["inputs"] = [(at, kind, tuple(args)) for at, kind, args in data["inputs"]]
+
+    return data
+
+
+def run_to(machine: Machine, instruction: int) -> bool:
+    """
+    Runs until the machine's instruction count reaches 'instruction', like
+    the emulator would. Returns False if the emulator's CPU could not have
+    got there.
+    """
+    while machine.total_instructions < instruction:
+        result = machine.run(instruction - machine.total_instructions)
+
+        # the emulator's CPU thread stops for good on these, with the pc
+        # already past the instruction
+        if result.reason == UNIMPLEMENTED:
+            machine.pc += 1
+            return False
+
+        if result.reason == FAULT:
+            return False
+
+        # a halted program only carries on if it was started again, which
+        # re-runs the jump to itself
+        if result.reason == HALTED:
+            continue
+
+    return True
+
+
+def replay(
+    recording: dict,
+    until: Union[None, int] = None,
+    on_input=None,
+) -> tuple[Machine, bool]:
+    """
+    Replays 'recording' on a fresh Machine, up to 'until' instructions or the
+    end of the recording. Returns the machine and, when replayed to the end,
+    whether it finished in the recorded state.
+    """
+    machine = Machine()
+    machine.restore(recording["start"])
+
+    end = recording["end"]["instructions"]
+    stop = end if until is None else min(until, end)
+
+    for at, kind, args in recording["inputs"]:
+        if at > stop:
+            break
+
+        run_to(machine, at)
+
+        if on_input is not None:
+            on_input(at, kind, args)
+
+        machine._apply_input(kind, args)
+
+    run_to(machine, stop)
+
+    if stop != end:
+        return machine, False
+
+    return machine, machine.state_hash() == recording["end"]["hash"]
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, paths = getopt.gnu_getopt(sys.argv[1:], "hu:v", ["help"])
+
+    until = None
+    verbose = False
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-u":
+            until = int(val, 0)
+
+        if arg == "-v":
+            verbose = True
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(paths) != 1:
+        _log.critical("One recording is required, see -h. Exiting.")
+        raise SystemExit(1)
+
+    try:
+        recording = load(paths[0])
+    except (OSError, ValueError) as e:
+        _log.critical(f"Could not load recording {paths[0]}, {e}. Exiting.")
+        raise SystemExit(1)
+
+    def show(at, kind, args):
+        shown = ", ".join(
+            f"{len(a)} values" if isinstance(a, (list, tuple)) else str(a) for a in args
+        )
+        print(f"{at:>12} {kind} {shown}")
+
+    start = time.perf_counter()
+    machine, matched = replay(recording, until, show if verbose else None)
+    seconds = time.perf_counter() - start
+
+    executed = machine.total_instructions - recording["start"]["total_instructions"]
+    applied = sum(at <= machine.total_instructions for at, _, _ in recording["inputs"])
+    print(
+        f"Replayed {applied} inputs and {executed} instructions"
+        f" in {seconds:.2f}s"
+    )
+
+    if until is not None:
+        print(f"PC: {machine.pc:04x}")
+        print(f"Registers: {' '.join(f'{_:04x}' for _ in machine.registers)}")
+        print(f"Stack: {' '.join(f'{_:04x}' for _ in machine.stack)}")
+        print(f"Flags: {' '.join(k for k, v in machine.flags.items() if v)}")
+        return
+
+    if not matched:
+        print("Final state does not match the recording")
+        raise SystemExit(1)
+
+    print("Final state matches the recording")
+
+
+if __name__ == "__main__":
+    main()
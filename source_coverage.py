@@ -0,0 +1,177 @@
+# Source line coverage for assembled simplecpu programs.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Maps per address execution counts (see Machine.coverage) back to the .scp
+lines and roots the words were assembled from.
+
+The map is worked out the same way the compiler lays roots out, one pointer
+walking every root's instructions in order. Lines only holding directives
+(instructions starting with '.', e.g. .data) are not counted as code.
+Counts from several runs, or several programs built from the same sources,
+are merged by file and line, and can be written as an lcov tracefile or a
+listing of the sources with the count beside every line (like gcov).
+"""
+
+import pathlib
+
+from typing import NamedTuple
+
+
+class Span(NamedTuple):
+    address: int
+    length: int
+    file: str
+    line: int
+    # the root's pressed name (without the ~s)
+    root: str
+    data: bool
+
+
+def line_map(roots, memory_offset: int = 0) -> list[Span]:
+    """
+    Where every instruction with a known source line ended up
+    """
+    spans = []
+    pointer = memory_offset
+
+    for root in roots:
+        for instruction in roots[root]:
+            length = len(instruction["compiled"])
+
+            if length and "line" in instruction and "originates_from" in instruction:
+                spans.append(
+                    Span(
+                        pointer,
+                        length,
+                        str(instruction["originates_from"]),
+                        instruction["line"],
+                        root.replace("~", ""),
+                        instruction["name"].startswith("."),
+                    )
+                )
+
+            pointer += length
+
+    return spans
+
+
+def _is_function(root: str) -> bool:
+    # labels inside a root (start.loop) and data roots (var.a) are not
+    return "." not in root
+
+
+def collect(spans: list[Span], counts: list[int]) -> dict:
+    """
+    Line, root and function counts from one program's execution counts.
+
+    {file: {"lines": {line: count},
+            "roots": {root: [instructions executed, instructions]},
+            "functions": {root: [line, count]}}}
+    """
+    files = {}
+
+    for span in spans:
+        if span.data:
+            continue
+
+        file = files.setdefault(span.file, {"lines": {}, "roots": {}, "functions": {}})
+        count = counts[span.address]
+
+        file["lines"][span.line] = max(file["lines"].get(span.line, 0), count)
+
+        executed, total = file["roots"].get(span.root, (0, 0))
+        file["roots"][span.root] = [executed + bool(count), total + 1]
+
+        if _is_function(span.root) and span.root not in file["functions"]:
+            file["functions"][span.root] = [span.line, count]
+
+    return files
+
+
+def merge(into: dict, other: dict) -> dict:
+    """
+    Adds the counts in 'other' (from collect) to 'into'
+    """
+    for name, file in other.items():
+        target = into.setdefault(name, {"lines": {}, "roots": {}, "functions": {}})
+
+        for line, count in file["lines"].items():
+            target["lines"][line] = target["lines"].get(line, 0) + count
+
+        for root, (executed, total) in file["roots"].items():
+            # a root compiled into several programs, keep the best run
+            target["roots"][root] = max(target["roots"].get(root, [0, total]), [executed, total])
+
+        for root, (line, count) in file["functions"].items():
+            target["functions"].setdefault(root, [line, 0])[1] += count
+
+    return into
+
+
+def summary(files: dict) -> tuple[int, int]:
+    """
+    (lines executed, lines of code)
+    """
+    lines = [c for file in files.values() for c in file["lines"].values()]
+
+    return sum(bool(_) for _ in lines), len(lines)
+
+
+def write_lcov(files: dict, path, test_name: str = ""):
+    with open(path, "w", encoding="utf-8") as f:
+        for name in sorted(files):
+            file = files[name]
+            functions = sorted(file["functions"].items(), key=lambda _: _[1][0])
+
+            f.write(f"TN:{test_name}\n")
+            f.write(f"SF:{name}\n")
+
+            for root, (line, _) in functions:
+                f.write(f"FN:{line},{root}\n")
+
+            for root, (_, count) in functions:
+                f.write(f"FNDA:{count},{root}\n")
+
+            f.write(f"FNF:{len(functions)}\n")
+            f.write(f"FNH:{sum(bool(count) for _, (_, count) in functions)}\n")
+
+            for line, count in sorted(file["lines"].items()):
+                f.write(f"DA:{line},{count}\n")
+
+            f.write(f"LF:{len(file['lines'])}\n")
+            f.write(f"LH:{sum(bool(_) for _ in file['lines'].values())}\n")
+            f.write("end_of_record\n")
+
+
+def write_listing(files: dict, path):
+    """
+    Every source file with the times each line ran beside it, ##### for
+    code that never ran and - for lines that are not code
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for name in sorted(files):
+            file = files[name]
+            executed, total = summary({name: file})
+
+            f.write(f"==> {name} ({executed} of {total} lines executed)\n")
+
+            for root, (ran, instructions) in file["roots"].items():
+                f.write(f"    {root:<30} {ran:>5} of {instructions} instructions\n")
+
+            f.write("\n")
+
+            try:
+                source = pathlib.Path(name).read_text(encoding="utf-8").split("\n")
+            except OSError:
+                source = []
+
+            for number, text in enumerate(source, 1):
+                count = file["lines"].get(number)
+                mark = "-" if count is None else str(count) if count else "#####"
+
+                f.write(f"{mark:>9}:{number:>5}:{text}\n")
+
+            f.write("\n")
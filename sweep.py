@@ -0,0 +1,345 @@
+# Runs many variants of a program from one starting state.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+import getopt
+import itertools
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+
+from multiprocessing import shared_memory
+from typing import *
+
+import numpy as np
+
+import diverge
+import machine
+import tester
+
+__doc__ = """
+Runs variants of one program, each with different values poked into memory
+or registers, from a shared starting state across worker processes, and
+groups the variants that end with the same outputs.
+
+The starting state is the loaded program (or the end of a recording, see
+replay.py), run on to 'start' first if given. Its memory is put in shared
+memory once, every variant starts from a copy of it.
+
+Usage:
+
+sweep.py -s <spec>                    sweep spec (json)
+         <program>                    .asc, .scp or a recording
+         -j <processes>               number of worker processes (default: one per core)
+         -R <project root>            project root used when assembling (default: the program's folder)
+         -J <filename>                write every variant's result as JSON
+         -v <verbose>                 list every variant in each group
+
+Spec:
+
+{
+  "start": 1000,                      instructions (or a root to run to) before poking
+  "max_instructions": 1000000,        budget for every variant
+  "timeout": 5,                       seconds for every variant
+  "sweep": {"var.step": [1, 2, 3], "RA": "0-15"},
+  "variants": [{"memory": {"var.step": 9}}],
+  "outputs": {"memory": ["var.acc", ["var.buf", 4]], "registers": ["RA"], "ports": ["0xFFF"]}
+}
+
+Every combination of the "sweep" values (lists, or inclusive "a-b" ranges) is
+a variant, as is every "variants" setup, which takes the same keys as a
+tester.py setup. Without "outputs" variants are grouped by their whole final
+state.
+"""
+
+DEFAULT_MAX_INSTRUCTIONS = 1_000_000
+DEFAULT_TIMEOUT = 10.0
+
+# attached shared memory by name, kept open for a worker's lifetime
+_attached = {}
+
+
+def _values(value: Union[int, str, list]) -> list[int]:
+    if isinstance(value, int):
+        return [value]
+
+    if isinstance(value, str):
+        start, _, end = value.partition("-")
+        return list(range(int(start, 0), int(end or start, 0) + 1))
+
+    return [int(_, 0) if isinstance(_, str) else _ for _ in value]
+
+
+def variants(spec: dict) -> list[tuple[str, dict]]:
+    """
+    (label, setup) for every variant in the spec
+    """
+    out = []
+
+    sweep = spec.get("sweep", {})
+    targets = list(sweep)
+
+    for values in itertools.product(*(_values(sweep[_]) for _ in targets)) if targets else ():
+        setup = {"memory": {}, "registers": {}}
+
+        for target, value in zip(targets, values):
+            kind = "registers" if target.upper() in machine.Machine._register_names else "memory"
+            setup[kind][target] = value
+
+        out.append((" ".join(f"{t}={v}" for t, v in zip(targets, values)), setup))
+
+    for i, setup in enumerate(spec.get("variants", [])):
+        out.append((setup.get("name", f"variant {i}"), setup))
+
+    return out
+
+
+def _base_memory(name: str) -> np.ndarray:
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+
+        memory = np.ndarray((4096,), dtype=np.uint16, buffer=shm.buf)
+        memory.flags.writeable = False
+        _attached[name] = shm, memory
+
+    return _attached[name][1]
+
+
+def run_variants(
+    shared: str, state: dict, chunk: list[tuple[str, dict]], spec: dict, symbols: dict[str, int]
+) -> list[dict]:
+    """
+    Runs every variant in 'chunk' on a fresh machine started from the shared
+    state. Runs in the worker processes.
+    """
+    base = _base_memory(shared)
+    outputs = spec.get("outputs")
+
+    results = []
+
+    for label, setup in chunk:
+        vm = machine.Machine()
+        vm.restore(state | {"memory": base})
+
+        result = {"name": label, "setup": setup}
+
+        try:
+            tester._apply_setup(vm, setup, symbols)
+
+            ports = {}
+            if outputs is not None:
+                ports = {tester._address(_, symbols): [] for _ in outputs.get("ports", [])}
+
+            if ports:
+
+                def hook(key, value):
+                    if key in ports:
+                        ports[key].append(int(value))
+
+                vm._memory.mem_change_hook = hook
+
+            run = vm.run(
+                spec.get("max_instructions", DEFAULT_MAX_INSTRUCTIONS),
+                spec.get("timeout", DEFAULT_TIMEOUT),
+            )
+
+        except KeyError as e:
+            results.append(result | {"reason": "error", "instructions": 0, "outputs": {"error": str(e.args[0])}})
+            continue
+
+        if outputs is None:
+            found = {"state": vm.state_hash()}
+
+        else:
+            found = {}
+
+            for address in outputs.get("memory", []):
+                address, length = address if isinstance(address, list) else (address, 1)
+                words = vm.read(tester._address(address, symbols), length)
+                found[f"memory {address}"] = words if length != 1 else words[0]
+
+            for register in outputs.get("registers", []):
+                found[f"register {register}"] = vm.get_register(register)
+
+            for address, written in zip(outputs.get("ports", []), ports.values()):
+                found[f"port {address}"] = written
+
+        results.append(
+            result | {"reason": run.reason, "instructions": run.instructions, "outputs": found}
+        )
+
+    return results
+
+
+def starting_state(
+    path: pathlib.Path, spec: dict, project_root: Union[None, pathlib.Path]
+) -> tuple[dict, dict[str, int]]:
+    """
+    The state every variant starts from and the program's roots
+    """
+    run = diverge.Run.load(path, project_root)
+    cursor = diverge.Cursor(run)
+
+    # a recording's state is where it ended
+    if run.end is not None:
+        cursor.advance(run.end)
+
+    vm = cursor.machine
+    start = spec.get("start")
+
+    if isinstance(start, int):
+        vm.run(start)
+
+    elif start is not None:
+        result = vm.run_until(
+            tester._address(start, run.roots), max_instructions=spec.get("max_instructions", DEFAULT_MAX_INSTRUCTIONS)
+        )
+
+        if result.reason != machine.BREAKPOINT:
+            raise ValueError(f"Never reached '{start}', stopped with '{result.reason}'")
+
+    return vm.snapshot(), run.roots
+
+
+def sweep(
+    state: dict,
+    spec: dict,
+    symbols: dict[str, int],
+    processes: Union[None, int] = None,
+) -> Iterator[dict]:
+    """
+    Runs every variant of the spec from 'state' across a tester.WorkerPool,
+    yielding results as they finish
+    """
+    processes = processes or os.cpu_count() or 1
+    todo = variants(spec)
+
+    # enough chunks to keep every worker busy, few enough to not be
+    # dominated by passing results back
+    size = max(1, min(64, len(todo) // (processes * 4)))
+    chunks = [todo[i : i + size] for i in range(0, len(todo), size)]
+
+    shm = shared_memory.SharedMemory(create=True, size=state["memory"].nbytes)
+
+    try:
+        np.ndarray(state["memory"].shape, dtype=np.uint16, buffer=shm.buf)[:] = state["memory"]
+        small = state | {"memory": None}
+
+        timeout = spec.get("timeout", DEFAULT_TIMEOUT)
+        tasks = [
+            (i, (shm.name, small, chunk, spec, symbols), timeout * len(chunk) + 10)
+            for i, chunk in enumerate(chunks)
+        ]
+
+        for i, status, value in tester.WorkerPool(run_variants, processes).imap_unordered(tasks):
+            if status == "done":
+                yield from value
+                continue
+
+            for label, setup in chunks[i]:
+                yield {
+                    "name": label,
+                    "setup": setup,
+                    "reason": status,
+                    "instructions": 0,
+                    "outputs": {"error": "Timed out" if status == "timeout" else value},
+                }
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def group(results: Iterable[dict]) -> list[tuple[dict, list[dict]]]:
+    """
+    Groups results that stopped the same way with the same outputs, largest
+    group first
+    """
+    groups = {}
+
+    for result in results:
+        key = json.dumps([result["reason"], result["outputs"]], sort_keys=True)
+        groups.setdefault(key, []).append(result)
+
+    return sorted(
+        ((members[0], members) for members in groups.values()), key=lambda _: -len(_[1])
+    )
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, paths = getopt.gnu_getopt(sys.argv[1:], "hs:j:R:J:v", ["help"])
+
+    spec_path = None
+    processes = None
+    project_root = None
+    json_path = None
+    verbose = False
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-s":
+            spec_path = pathlib.Path(val)
+
+        if arg == "-j":
+            processes = int(val)
+
+        if arg == "-R":
+            project_root = pathlib.Path(val).resolve()
+
+        if arg == "-J":
+            json_path = val
+
+        if arg == "-v":
+            verbose = True
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if spec_path is None or len(paths) != 1:
+        _log.critical("A spec and one program are required, see -h. Exiting.")
+        raise SystemExit(1)
+
+    with open(spec_path, encoding="utf-8") as f:
+        spec = json.load(f)
+
+    try:
+        state, symbols = starting_state(pathlib.Path(paths[0]), spec, project_root)
+    except (OSError, ValueError, KeyError) as e:
+        _log.critical(f"Could not get the starting state, {e}. Exiting.")
+        raise SystemExit(1)
+
+    start = time.perf_counter()
+    results = list(sweep(state, spec, symbols, processes))
+    groups = group(results)
+
+    print(
+        f"Ran {len(results)} variants from instruction {state['total_instructions']}"
+        f" in {time.perf_counter() - start:.2f}s, {len(groups)} distinct outputs"
+    )
+
+    for first, members in groups:
+        outputs = ", ".join(f"{k}={v}" for k, v in first["outputs"].items())
+        print(f"\n{len(members)} variants stopped with '{first['reason']}': {outputs}")
+
+        shown = members if verbose else members[:3]
+        for result in shown:
+            print(f"    {result['name']} ({result['instructions']} instructions)")
+
+        if len(members) > len(shown):
+            print(f"    ... and {len(members) - len(shown)} more")
+
+    if json_path is not None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(sorted(results, key=lambda _: _["name"]), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,713 @@
+# A test runner for SCP programs.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+import getopt
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
+import sys
+import time
+import traceback
+import xml.etree.ElementTree as ElementTree
+
+from typing import *
+
+import assembler
+import machine
+import source_coverage
+import timing
+
+__doc__ = """
+Usage:
+
+tester.py <paths>                     test files or folders to search for test_*.scp files
+          -j <processes>              number of worker processes (default: one per core)
+          -R <project root>           project root used when assembling (default: each test's folder)
+          -x <filename>               write a JUnit XML report
+          -J <filename>               write a JSON report
+          -c <filename>               write the test files' line coverage as an lcov tracefile
+          -a <filename>               write the test files' sources annotated with how often each line ran
+          -v <verbose>                show passing tests and assembler warnings
+"""
+
+# Defaults for the settings a test's .json file can override
+DEFAULT_MAX_INSTRUCTIONS = 1_000_000
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_FILE_TIMEOUT = 60.0
+
+
+class WorkerPool:
+    """
+    A process pool that can kill a worker stuck on a task.
+
+    Workers are kept between tasks, a worker that runs past its task's
+    timeout is killed and replaced, so one runaway task never holds up
+    the rest.
+    """
+
+    def __init__(self, function: Callable, processes: Union[None, int] = None):
+        self._function = function
+        self._processes = processes or os.cpu_count() or 1
+        self._context = multiprocessing.get_context()
+
+    def _spawn(self):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(self._function, child), daemon=True
+        )
+        process.start()
+        child.close()
+
+        return process, parent
+
+    def imap_unordered(
+        self, tasks: Iterable[tuple[Any, tuple, Union[None, float]]]
+    ) -> Iterator[tuple[Any, str, Any]]:
+        """
+        Runs function(*args) for every (key, args, timeout) task, yielding
+        (key, status, value) as they finish. status is 'done' (value is the
+        return value), 'error' (value is the traceback) or 'timeout'.
+        """
+        pending = list(tasks)
+        pending.reverse()
+
+        idle = []
+        running = {}
+
+        try:
+            while pending or running:
+                while pending and len(running) < self._processes:
+                    process, conn = idle.pop() if idle else self._spawn()
+                    key, args, timeout = pending.pop()
+
+                    conn.send(args)
+
+                    deadline = None
+                    if timeout is not None:
+                        deadline = time.perf_counter() + timeout
+
+                    running[conn] = (process, key, deadline)
+
+                deadlines = [d for _, _, d in running.values() if d is not None]
+                wait_for = None
+                if deadlines:
+                    wait_for = max(0.0, min(deadlines) - time.perf_counter())
+
+                for conn in multiprocessing.connection.wait(list(running), wait_for):
+                    process, key, _ = running.pop(conn)
+
+                    try:
+                        status, value = conn.recv()
+                    except EOFError:
+                        process.join()
+                        conn.close()
+
+                        yield key, "error", f"Worker exited with code {process.exitcode}"
+                        continue
+
+                    idle.append((process, conn))
+                    yield key, status, value
+
+                now = time.perf_counter()
+
+                for conn, (process, key, deadline) in list(running.items()):
+                    if deadline is None or now < deadline:
+                        continue
+
+                    process.kill()
+                    process.join()
+                    conn.close()
+                    del running[conn]
+
+                    yield key, "timeout", None
+
+        finally:
+            for process, conn in idle:
+                conn.send(None)
+                conn.close()
+                process.join()
+
+            for conn, (process, _, _) in running.items():
+                process.kill()
+                process.join()
+                conn.close()
+
+
+def _worker_main(function, conn):
+    # the reports carry the assembler's log, don't print it as well
+    logging.getLogger().handlers.clear()
+
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            break
+
+        if args is None:
+            break
+
+        try:
+            conn.send(("done", function(*args)))
+        except BaseException:
+            conn.send(("error", traceback.format_exc()))
+
+
+class _LogCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(f"{record.levelname}:{record.name}:{record.getMessage()}")
+
+
+def assemble(path: pathlib.Path, project_root: pathlib.Path) -> dict:
+    """
+    Assembles 'path' in this process, returning the compiled words, the
+    address of every root, the source line of every instruction, the static
+    cycle estimates (see timing.Analysis) and the assembler's warnings.
+    """
+    collector = _LogCollector()
+    logging.getLogger().addHandler(collector)
+
+    start = time.perf_counter()
+
+    try:
+        compiled, roots, imports = assembler.full_stack_load_compile(
+            project_root, path
+        )
+
+    except SystemExit:
+        return {
+            "ok": False,
+            "seconds": time.perf_counter() - start,
+            "log": collector.records,
+            "error": next(
+                (r for r in reversed(collector.records) if r.startswith("CRITICAL")),
+                "Assembler exited",
+            ),
+        }
+
+    finally:
+        logging.getLogger().removeHandler(collector)
+
+    return {
+        "ok": True,
+        "seconds": time.perf_counter() - start,
+        "log": collector.records,
+        "words": compiled,
+        "roots": assembler.root_addresses(roots),
+        "lines": source_coverage.line_map(roots),
+        "analysis": timing.Analysis(
+            compiled, None, timing.data_addresses(roots), timing.source_annotations(roots)
+        ),
+        "imports": sorted(str(_) for _ in imports),
+    }
+
+
+def _address(value: Union[int, str], symbols: dict[str, int]) -> int:
+    if isinstance(value, int):
+        return value
+
+    if value in symbols:
+        return symbols[value]
+
+    try:
+        return int(value, 0)
+    except ValueError:
+        raise KeyError(f"Unknown root '{value}'")
+
+
+def _words(value: Union[int, str, list]) -> list[int]:
+    # expected values are a word, a list of words or a string of chars
+    if isinstance(value, int):
+        return [value]
+
+    if isinstance(value, str):
+        return [ord(_) for _ in value]
+
+    words = []
+    for v in value:
+        words.extend(_words(v))
+
+    return words
+
+
+def _apply_setup(vm: machine.Machine, setup: dict, symbols: dict[str, int]):
+    for address, value in setup.get("memory", {}).items():
+        for i, word in enumerate(_words(value)):
+            vm.write(_address(address, symbols) + i, word)
+
+    for register, value in setup.get("registers", {}).items():
+        vm.set_register(register, value)
+
+
+def check(
+    vm: machine.Machine,
+    result: machine.RunResult,
+    expect: dict,
+    symbols: dict[str, int],
+    port_writes: dict[int, list[int]],
+    reasons: list[str],
+    estimate: Union[None, timing.Estimate] = None,
+) -> list[str]:
+    """
+    Compares the machine after a run against the 'expect' section of a test,
+    returning a description of every mismatch. With "estimate" set in it the
+    cycles taken must be within the static 'estimate' for where it started.
+    """
+    failures = []
+
+    expected_reasons = expect.get("reason", reasons)
+    if isinstance(expected_reasons, str):
+        expected_reasons = [expected_reasons]
+
+    if result.reason not in expected_reasons:
+        message = f"stopped with '{result.reason}', expected {' or '.join(expected_reasons)}"
+
+        if result.error:
+            message += f" ({result.error})"
+
+        failures.append(message)
+
+    if "pc" in expect and vm.pc != _address(expect["pc"], symbols):
+        failures.append(f"pc is {vm.pc:#05x}, expected {_address(expect['pc'], symbols):#05x}")
+
+    for register, value in expect.get("registers", {}).items():
+        actual = vm.get_register(register)
+
+        if actual != value:
+            failures.append(f"register {register} is {actual:#06x}, expected {value:#06x}")
+
+    for flag, value in expect.get("flags", {}).items():
+        if vm.flags[flag] != value:
+            failures.append(f"flag {flag} is {vm.flags[flag]}, expected {value}")
+
+    for address, value in expect.get("memory", {}).items():
+        expected = _words(value)
+        actual = vm.read(_address(address, symbols), len(expected))
+
+        if actual != expected:
+            failures.append(f"memory at {address} is {actual}, expected {expected}")
+
+    for address, value in expect.get("ports", {}).items():
+        expected = _words(value)
+        actual = port_writes[_address(address, symbols)]
+
+        if actual != expected:
+            failures.append(f"port {address} was written {actual}, expected {expected}")
+
+    if expect.get("estimate") and not estimate.best <= vm.cycles <= estimate.worst:
+        failures.append(
+            f"took {vm.cycles} cycles, estimated {timing.format_cycles(estimate.best)}"
+            f" to {timing.format_cycles(estimate.worst)}"
+        )
+
+    return failures
+
+
+def run_test(
+    assembled: dict,
+    name: str,
+    root: Union[None, str],
+    spec: dict,
+    defaults: dict,
+    coverage: Union[None, list[int]] = None,
+) -> dict:
+    """
+    Runs one test on a fresh machine, from 'start' when root is None or as a
+    call to the root otherwise. Executed addresses are counted into
+    'coverage' if given (see Machine.coverage).
+    """
+    symbols = assembled["roots"]
+    max_instructions = spec.get("max_instructions", defaults["max_instructions"])
+    timeout = spec.get("timeout", defaults["timeout"])
+    expect = spec.get("expect", {})
+
+    result = {"name": name, "instructions": 0, "cycles": 0, "seconds": 0.0, "failures": []}
+
+    vm = machine.Machine()
+    vm.load(assembled["words"])
+    vm.coverage = coverage
+
+    try:
+        _apply_setup(vm, spec.get("setup", {}), symbols)
+
+        ports = {_address(_, symbols) for _ in expect.get("ports", {})}
+        port_writes = {port: [] for port in ports}
+
+        if ports:
+
+            def hook(key, value):
+                if key in port_writes:
+                    port_writes[key].append(int(value))
+
+            vm._memory.mem_change_hook = hook
+
+        start = time.perf_counter()
+
+        if root is None:
+            run = vm.run(max_instructions, timeout)
+            reasons = [machine.HALTED]
+        else:
+            run = vm.call(symbols[root], None, max_instructions, timeout)
+            reasons = [machine.RETURNED, machine.HALTED]
+
+        result["seconds"] = time.perf_counter() - start
+        result["instructions"] = run.instructions
+        result["cycles"] = vm.cycles
+        # estimated time on the board at the cycle table's clock
+        result["board_seconds"] = vm.cycle_table.seconds(vm.cycles)
+        result["reason"] = run.reason
+        estimate = assembled["analysis"].estimate(0 if root is None else symbols[root])
+        result["failures"] = check(vm, run, expect, symbols, port_writes, reasons, estimate)
+
+    except KeyError as e:
+        result["status"] = "error"
+        result["message"] = str(e.args[0])
+        return result
+
+    if run.reason == machine.TIMEOUT:
+        result["status"] = "timeout"
+    elif result["failures"]:
+        result["status"] = "failed"
+    else:
+        result["status"] = "passed"
+
+    result["message"] = "; ".join(result["failures"])
+
+    return result
+
+
+def run_file(path: str, project_root: str, spec: dict, coverage: bool = False) -> dict:
+    """
+    Assembles a test file and runs every test in it, the file itself when
+    its spec has an 'expect' section (or it has no test roots) and every
+    root named test_*. With coverage the report's 'coverage' holds the
+    source lines the tests ran (see source_coverage.collect).
+    """
+    path = pathlib.Path(path)
+    assembled = assemble(path, pathlib.Path(project_root))
+
+    report = {
+        "file": str(path),
+        "assembly": {k: v for k, v in assembled.items() if k not in {"words", "roots", "lines", "analysis"}},
+        "tests": [],
+    }
+
+    if not assembled["ok"]:
+        return report
+
+    defaults = {
+        "max_instructions": spec.get("max_instructions", DEFAULT_MAX_INSTRUCTIONS),
+        "timeout": spec.get("timeout", DEFAULT_TIMEOUT),
+    }
+
+    test_roots = [
+        root for root in assembled["roots"] if root.split(".")[-1].startswith("test_")
+    ]
+    root_specs = spec.get("roots", {})
+
+    for root in root_specs:
+        if root not in assembled["roots"]:
+            report["tests"].append(
+                {
+                    "name": root,
+                    "status": "error",
+                    "message": f"Root '{root}' from the spec does not exist",
+                    "instructions": 0,
+                    "cycles": 0,
+                    "seconds": 0.0,
+                    "failures": [],
+                }
+            )
+
+    counts = [0] * 4096 if coverage else None
+
+    if "expect" in spec or not test_roots:
+        report["tests"].append(run_test(assembled, path.stem, None, spec, defaults, counts))
+
+    for root in test_roots:
+        report["tests"].append(
+            run_test(assembled, root, root, root_specs.get(root, {}), defaults, counts)
+        )
+
+    if coverage:
+        report["coverage"] = source_coverage.collect(assembled["lines"], counts)
+
+    return report
+
+
+def find_tests(paths: Iterable[Union[str, pathlib.Path]]) -> list[pathlib.Path]:
+    found = []
+
+    for path in paths:
+        path = pathlib.Path(path).resolve()
+
+        if not path.exists():
+            logging.getLogger("Main").critical(f"'{path}' does not exist. Exiting.")
+            raise SystemExit(1)
+
+        if path.is_dir():
+            found.extend(sorted(path.rglob("test_*.scp")))
+            continue
+
+        found.append(path)
+
+    return found
+
+
+def load_spec(path: pathlib.Path) -> dict:
+    """
+    A test's settings and expectations live next to it, test_x.scp -> test_x.json
+    """
+    spec_path = path.with_suffix(".json")
+
+    if not spec_path.exists():
+        return {}
+
+    with open(spec_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_tests(
+    files: list[pathlib.Path],
+    project_root: Union[None, pathlib.Path] = None,
+    processes: Union[None, int] = None,
+    coverage: bool = False,
+) -> Iterator[dict]:
+    """
+    Runs the test files across a pool of worker processes, yielding each
+    file's report as it finishes
+    """
+    tasks = []
+
+    for path in files:
+        try:
+            spec = load_spec(path)
+        except (OSError, ValueError) as e:
+            yield {
+                "file": str(path),
+                "assembly": {"ok": False, "seconds": 0.0, "log": [], "error": f"Bad spec: {e}"},
+                "tests": [],
+            }
+            continue
+
+        root = project_root if project_root is not None else path.parent
+
+        tasks.append(
+            (
+                path,
+                (str(path), str(root), spec, coverage),
+                spec.get("file_timeout", DEFAULT_FILE_TIMEOUT),
+            )
+        )
+
+    pool = WorkerPool(run_file, processes)
+    file_timeouts = {path: timeout for path, _, timeout in tasks}
+
+    for path, status, value in pool.imap_unordered(tasks):
+        if status == "done":
+            yield value
+            continue
+
+        if status == "timeout":
+            # the worker was killed before it said how the assembly went
+            yield {
+                "file": str(path),
+                "assembly": {"ok": None, "seconds": 0.0, "log": []},
+                "tests": [
+                    {
+                        "name": path.stem,
+                        "status": "timeout",
+                        "message": f"Still running after file_timeout ({file_timeouts[path]:g}s), killed",
+                        "instructions": 0,
+                        "cycles": 0,
+                        "seconds": file_timeouts[path],
+                        "failures": [],
+                    }
+                ],
+            }
+            continue
+
+        yield {
+            "file": str(path),
+            "assembly": {"ok": False, "seconds": 0.0, "log": [], "error": value},
+            "tests": [],
+        }
+
+
+def _file_error(report: dict) -> Union[None, str]:
+    # None for ok is a file that timed out, reported as a test
+    if report["assembly"]["ok"] is False:
+        return report["assembly"]["error"]
+
+    return None
+
+
+def generate_junit(reports: list[dict]) -> str:
+    suites = ElementTree.Element("testsuites")
+
+    for report in reports:
+        tests = report["tests"]
+        error = _file_error(report)
+
+        suite = ElementTree.SubElement(
+            suites,
+            "testsuite",
+            name=report["file"],
+            tests=str(max(len(tests), 1 if error else 0)),
+            failures=str(sum(t["status"] == "failed" for t in tests)),
+            errors=str(sum(t["status"] in ("error", "timeout") for t in tests) + bool(error)),
+            time=f"{sum(t['seconds'] for t in tests):.6f}",
+        )
+        classname = pathlib.Path(report["file"]).stem
+
+        if error:
+            case = ElementTree.SubElement(suite, "testcase", classname=classname, name="assemble")
+            ElementTree.SubElement(case, "error", message=error.splitlines()[-1] if error else "").text = error
+
+        for test in tests:
+            case = ElementTree.SubElement(
+                suite,
+                "testcase",
+                classname=classname,
+                name=test["name"],
+                time=f"{test['seconds']:.6f}",
+            )
+
+            if test["status"] == "failed":
+                ElementTree.SubElement(case, "failure", message=test["message"]).text = "\n".join(
+                    test["failures"]
+                )
+
+            elif test["status"] in ("error", "timeout"):
+                ElementTree.SubElement(case, "error", message=test["message"] or test["status"])
+
+    ElementTree.indent(suites)
+
+    return ElementTree.tostring(suites, encoding="unicode", xml_declaration=True)
+
+
+def main():
+    _log = logging.getLogger("Main")
+
+    args, paths = getopt.gnu_getopt(sys.argv[1:], "hj:R:x:J:c:a:v", ["help"])
+
+    processes = None
+    project_root = None
+    junit = None
+    json_path = None
+    lcov_path = None
+    listing_path = None
+    verbose = False
+
+    for arg, val in args:
+        if arg in ("-h", "--help"):
+            print(__doc__)
+
+            raise SystemExit
+
+        if arg == "-j":
+            processes = int(val)
+
+        if arg == "-R":
+            project_root = pathlib.Path(val).resolve()
+
+        if arg == "-x":
+            junit = val
+
+        if arg == "-J":
+            json_path = val
+
+        if arg == "-c":
+            lcov_path = val
+
+        if arg == "-a":
+            listing_path = val
+
+        if arg == "-v":
+            verbose = True
+
+    logging.basicConfig(level=logging.WARNING)
+
+    files = find_tests(paths or ["."])
+
+    if not files:
+        _log.critical("No test files found. Exiting.")
+        raise SystemExit(1)
+
+    start = time.perf_counter()
+    reports = []
+    counts = {"passed": 0, "failed": 0, "error": 0, "timeout": 0}
+    coverage = {}
+    measure = lcov_path is not None or listing_path is not None
+
+    for report in run_tests(files, project_root, processes, measure):
+        reports.append(report)
+        source_coverage.merge(coverage, report.pop("coverage", {}))
+
+        error = _file_error(report)
+        if error:
+            counts["error"] += 1
+            print(f"\033[31mERROR\033[0m   {report['file']}\n        {error.strip()}")
+
+        if verbose:
+            for line in report["assembly"]["log"]:
+                print(f"        {line}")
+
+        for test in report["tests"]:
+            counts[test["status"]] += 1
+
+            if test["status"] == "passed" and not verbose:
+                continue
+
+            colour = "\033[32m" if test["status"] == "passed" else "\033[31m"
+            print(
+                f"{colour}{test['status'].upper():7}\033[0m {report['file']}::{test['name']}"
+                f"  ({test['instructions']} instructions, {test['cycles']} cycles,"
+                f" {test['seconds'] * 1000:.1f} ms)"
+            )
+
+            for failure in test["failures"]:
+                print(f"        {failure}")
+
+            if not test["failures"] and test["message"]:
+                print(f"        {test['message']}")
+
+    reports.sort(key=lambda r: r["file"])
+
+    print(
+        f"\n{counts['passed']} passed, {counts['failed']} failed, "
+        f"{counts['error']} errors, {counts['timeout']} timed out "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+    if measure:
+        executed, total = source_coverage.summary(coverage)
+        print(f"{executed} of {total} lines executed ({executed / (total or 1):.1%})")
+
+    if lcov_path is not None:
+        source_coverage.write_lcov(coverage, lcov_path)
+
+    if listing_path is not None:
+        source_coverage.write_listing(coverage, listing_path)
+
+    if junit is not None:
+        with open(junit, "w", encoding="utf-8") as f:
+            f.write(generate_junit(reports))
+
+    if json_path is not None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+    if counts["failed"] or counts["error"] or counts["timeout"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,710 @@
+# Static cycle estimates for assembled simplecpu programs.
+# This file is part of the SCPUAS project.
+# SCPUAS © 2024 by actorpus is licensed under CC BY-NC-SA 4.0
+
+
+"""
+Best and worst case cycle counts for every root and call target, worked out
+from the compiled program without running it.
+
+The compiled words are turned into a control flow graph. Loops are found
+from the graph (back edges to a block that dominates them) and collapsed
+innermost first, using a bound on how many times each loop's header can run.
+Bounds come from annotations in the source, on the line of the loop's first
+instruction or of the jump that closes it:
+
+    jumpnz start  #@ bound 10          at most (and at least) 10 times
+    jumpz loop    #@ bound 1 64        between 1 and 64 times
+
+or from simple counters, a loop closed by
+
+    load var.count / sub RA k / store var.count / jumpnz loop
+                                         (var.count set by move RA n / store
+                                         var.count on every way into the loop)
+    sub RX k / jumpnz loop               (RX set by a move before the loop)
+
+where nothing else in the program writes the counter. A root runs until it
+returns or halts, a loop without a bound makes its worst case unbounded.
+
+Words from directives (instructions starting with '.') are data, running
+into them (or past the end of the program) stops the analysis for that path
+and makes the worst case unbounded.
+"""
+
+import math
+import pathlib
+import re
+
+from typing import NamedTuple, Union
+
+from cycles import OPCODE_NAMES, CycleTable, opcode_index
+
+_annotation = re.compile(r"#@\s*bound\s+(\d+)(?:\s+(\d+))?")
+
+# instructions that set the flags the conditional jumps test
+_FLAG_SETTERS = {
+    "ADD", "SUB", "AND", "OR", "ADDM", "SUBM", "ROL", "ROR",
+    "ADDR", "SUBR", "ANDR", "ORR", "XORR", "ASLR",
+}  # fmt: skip
+# instructions that write the register in ir11ir10
+_WRITE_DEST = {
+    "MOVE", "ADD", "SUB", "AND", "OR", "MOVER", "LOADR", "ROL", "ROR",
+    "ADDR", "SUBR", "ANDR", "ORR", "XORR", "ASLR",
+}  # fmt: skip
+# instructions that write RA
+_WRITE_RA = {"LOAD", "ADDM", "SUBM"}
+# instructions that leave the registers alone
+_WRITE_NONE = {
+    "STORE", "STORER", "JUMPU", "JUMPZ", "JUMPNZ", "JUMPC", "CALL", "RET",
+}  # fmt: skip
+
+_BRANCHES = {"JUMPZ", "JUMPNZ", "JUMPC"}
+
+
+class Loop(NamedTuple):
+    header: int
+    # (min, max) times the header runs, None when unknown
+    bound: Union[None, tuple[int, int]]
+    # where the bound came from, 'annotation', 'counter' or None
+    source: Union[None, str]
+    # cycles of one trip round the loop
+    iteration: tuple[float, float]
+    # cycles of the whole loop
+    total: tuple[float, float]
+
+
+class Estimate(NamedTuple):
+    best: float
+    # math.inf when some path has no bound
+    worst: float
+    notes: tuple[str, ...]
+    # whether some path returns, and whether some path stops without
+    # returning (halts, or runs into data or an unimplemented instruction)
+    returns: bool = True
+    halts: bool = False
+
+
+def _name(ir: int) -> str:
+    return OPCODE_NAMES[opcode_index(ir)]
+
+
+def _address(ir: int) -> int:
+    return ir & 0x0FFF
+
+
+def _dest(ir: int) -> int:
+    return (ir >> 10) & 0b11
+
+
+def _immediate(ir: int) -> int:
+    return ir & 0xFF
+
+
+def _written_registers(ir: int) -> set[int]:
+    name = _name(ir)
+
+    if name in _WRITE_DEST:
+        return {_dest(ir)}
+
+    if name in _WRITE_RA:
+        return {0}
+
+    if name in _WRITE_NONE:
+        return set()
+
+    # unimplemented instructions could do anything
+    return {0, 1, 2, 3}
+
+
+def source_annotations(roots) -> dict[int, tuple[int, int]]:
+    """
+    Loop bounds from '#@ bound' comments, keyed by the address of the
+    instruction on the same line
+    """
+    lines = {}
+    pointer = 0
+
+    for root in roots:
+        for instruction in roots[root]:
+            if "line" in instruction and "originates_from" in instruction:
+                key = (pathlib.Path(instruction["originates_from"]), instruction["line"])
+                lines.setdefault(key, pointer)
+
+            pointer += len(instruction["compiled"])
+
+    bounds = {}
+    files = {}
+
+    for (file, line), address in lines.items():
+        if file not in files:
+            try:
+                with open(file) as f:
+                    files[file] = f.read().split("\n")
+            except OSError:
+                files[file] = []
+
+        if line - 1 >= len(files[file]):
+            continue
+
+        match = _annotation.search(files[file][line - 1])
+        if match is None:
+            continue
+
+        low, high = int(match[1]), int(match[2] or match[1])
+        bounds[address] = (min(low, high), max(low, high))
+
+    return bounds
+
+
+def data_addresses(roots) -> set[int]:
+    data = set()
+    pointer = 0
+
+    for root in roots:
+        for instruction in roots[root]:
+            length = len(instruction["compiled"])
+
+            if instruction["name"].startswith("."):
+                data.update(range(pointer, pointer + length))
+
+            pointer += length
+
+    return data
+
+
+class Analysis:
+    """
+    Estimates for one program, calls are analysed once and shared between
+    every root that makes them.
+    """
+
+    def __init__(
+        self,
+        words: list[Union[int, str]],
+        table: Union[None, CycleTable] = None,
+        data: Union[None, set[int]] = None,
+        annotations: Union[None, dict[int, tuple[int, int]]] = None,
+    ):
+        self.words = [int(w, 16) if isinstance(w, str) else int(w) for w in words]
+        self.table = table or CycleTable()
+        self.data = data or set()
+        self.annotations = annotations or {}
+
+        self.loops: dict[int, Loop] = {}
+        self.calls: dict[int, Estimate] = {}
+        self._estimates: dict[int, Estimate] = {}
+        self._in_progress = set()
+
+    def _is_code(self, address: int) -> bool:
+        return 0 <= address < len(self.words) and address not in self.data
+
+    def _successors(self, address: int) -> tuple[list[int], bool, Union[None, str]]:
+        """
+        (next addresses, whether the program can stop here, note)
+        """
+        if not self._is_code(address):
+            return [], True, f"runs into data or past the program at {address:04x}"
+
+        ir = self.words[address]
+        name = _name(ir)
+
+        if name == "RET":
+            return [], True, None
+
+        if name == "JUMPU":
+            if _address(ir) == address:
+                return [], True, None
+
+            return [_address(ir)], False, None
+
+        if name in _BRANCHES:
+            if _address(ir) == address:
+                return [address + 1], True, None
+
+            return [address + 1, _address(ir)], False, None
+
+        if name is None or name.startswith("XOP"):
+            return [], True, f"unimplemented instruction at {address:04x}"
+
+        return [address + 1], False, None
+
+    def estimate(self, entry: int) -> Estimate:
+        """
+        Cycles from 'entry' until the code returns or halts
+        """
+        if entry in self._estimates:
+            return self._estimates[entry]
+
+        if entry in self._in_progress:
+            return Estimate(0, math.inf, (f"recursive call to {entry:04x}",), True, True)
+
+        self._in_progress.add(entry)
+        try:
+            estimate = self._estimate(entry)
+        finally:
+            self._in_progress.discard(entry)
+
+        self._estimates[entry] = estimate
+        return estimate
+
+    def _estimate(self, entry: int) -> Estimate:
+        notes = []
+
+        # 1. every instruction reachable from entry, without following calls
+        succ, exits, nodes = {}, set(), []
+        stack = [entry]
+
+        while stack:
+            address = stack.pop()
+            if address in succ:
+                continue
+
+            nodes.append(address)
+            succ[address], stops, note = self._successors(address)
+
+            # what follows a call only runs if the callee returns
+            if self._is_code(address) and _name(self.words[address]) == "CALL":
+                callee = self.estimate(_address(self.words[address]))
+
+                if not callee.returns:
+                    succ[address] = []
+                stops = callee.halts
+
+            if stops:
+                exits.add(address)
+            if note:
+                notes.append(note)
+
+            stack.extend(succ[address])
+
+        # anything could happen in data, returning included
+        returns = any(not self._is_code(a) or _name(self.words[a]) == "RET" for a in exits)
+        halts = any(not self._is_code(a) or _name(self.words[a]) != "RET" for a in exits)
+
+        # 2. cost of each instruction, calls include the callee
+        best, worst = {}, {}
+
+        for address in nodes:
+            if not self._is_code(address):
+                # whatever runs there could take any time, or never stop
+                best[address], worst[address] = 0, math.inf
+                continue
+
+            best[address] = worst[address] = self.table.instruction(self.words[address])
+
+            if _name(self.words[address]) == "CALL":
+                target = _address(self.words[address])
+                callee = self.estimate(target)
+                self.calls[target] = callee
+
+                best[address] += callee.best
+                worst[address] += callee.worst
+                notes.extend(callee.notes)
+
+        # 3. collapse loops, innermost first
+        for header, body in sorted(self._loops(entry, succ).items(), key=lambda _: len(_[1])):
+            self._collapse(header, body, succ, exits, best, worst, notes)
+
+        # 4. what is left should be acyclic
+        order = self._topological(entry, succ)
+
+        if order is None:
+            notes.append(f"loop without a single entry reachable from {entry:04x}")
+            return Estimate(0, math.inf, tuple(dict.fromkeys(notes)), returns, halts)
+
+        longest, shortest = {}, {}
+
+        for address in reversed(order):
+            after_worst = [longest[s] for s in succ[address]]
+            after_best = [shortest[s] for s in succ[address]]
+
+            if address in exits:
+                after_worst.append(0)
+                after_best.append(0)
+
+            # a path that can never stop (e.g. an unbounded loop without exits)
+            longest[address] = worst[address] + max(after_worst, default=math.inf)
+            shortest[address] = best[address] + min(after_best, default=math.inf)
+
+        return Estimate(
+            shortest[entry], longest[entry], tuple(dict.fromkeys(notes)), returns, halts
+        )
+
+    @staticmethod
+    def _topological(entry: int, succ: dict[int, list[int]]) -> Union[None, list[int]]:
+        """
+        Addresses reachable from entry in topological order, None if there
+        is a cycle
+        """
+        order, state = [], {}
+        stack = [(entry, iter(succ[entry]))]
+        state[entry] = 1
+
+        while stack:
+            node, children = stack[-1]
+
+            for child in children:
+                if state.get(child) == 1:
+                    return None
+
+                if child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(succ[child])))
+                    break
+            else:
+                stack.pop()
+                state[node] = 2
+                order.append(node)
+
+        order.reverse()
+        return order
+
+    @staticmethod
+    def _dominators(entry: int, succ: dict[int, list[int]]) -> dict[int, set[int]]:
+        nodes = list(succ)
+        pred = {n: [] for n in nodes}
+        for n in nodes:
+            for s in succ[n]:
+                pred[s].append(n)
+
+        dom = {n: set(nodes) for n in nodes}
+        dom[entry] = {entry}
+
+        changed = True
+        while changed:
+            changed = False
+
+            for n in nodes:
+                if n == entry:
+                    continue
+
+                new = set.intersection(*(dom[p] for p in pred[n])) if pred[n] else set()
+                new = new | {n}
+
+                if new != dom[n]:
+                    dom[n] = new
+                    changed = True
+
+        return dom
+
+    def _loops(self, entry: int, succ: dict[int, list[int]]) -> dict[int, set[int]]:
+        """
+        Natural loops, header -> every address in the loop
+        """
+        dom = self._dominators(entry, succ)
+        pred = {n: [] for n in succ}
+        for n in succ:
+            for s in succ[n]:
+                pred[s].append(n)
+
+        loops = {}
+
+        for n in succ:
+            for header in succ[n]:
+                if header not in dom[n]:
+                    continue
+
+                body = loops.setdefault(header, {header})
+                stack = [n]
+
+                while stack:
+                    m = stack.pop()
+                    if m in body:
+                        continue
+
+                    body.add(m)
+                    stack.extend(pred[m])
+
+        return loops
+
+    def _collapse(self, header, body, succ, exits, best, worst, notes):
+        """
+        Replaces the loop with its header, costing the whole loop, leaving
+        through any of its exits.
+        """
+        # inner loops were collapsed into their headers already
+        body = {n for n in body if n in succ}
+
+        latches = [n for n in body if header in succ[n]]
+        leaving = {n for n in body if n in exits or any(s not in body for s in succ[n])}
+
+        inner = {n: [s for s in succ[n] if s in body and s != header] for n in body}
+        order = self._topological(header, inner)
+
+        if order is None:
+            notes.append(f"irreducible loop at {header:04x}")
+            iteration = exit_path = (0, math.inf)
+        else:
+            # cheapest and dearest path from the header to each address
+            low, high = {}, {}
+            for n in order:
+                preds = [p for p in order if n in inner[p]]
+
+                if n == header:
+                    low[n], high[n] = best[n], worst[n]
+                    continue
+
+                low[n] = best[n] + min(low[p] for p in preds)
+                high[n] = worst[n] + max(high[p] for p in preds)
+
+            iteration = (min(low[n] for n in latches), max(high[n] for n in latches))
+            exit_path = (
+                min((low[n] for n in leaving), default=math.inf),
+                max((high[n] for n in leaving), default=math.inf),
+            )
+
+        bound, source = self._bound(header, body, latches, succ)
+
+        if bound is None:
+            total = (exit_path[0], math.inf)
+            notes.append(f"no bound for the loop at {header:04x}")
+        else:
+            total = (
+                _times(bound[0] - 1, iteration[0]) + exit_path[0],
+                _times(bound[1] - 1, iteration[1]) + exit_path[1],
+            )
+
+        if not leaving:
+            notes.append(f"the loop at {header:04x} never exits")
+
+        # the first analysis to reach a loop sees it from the furthest out
+        self.loops.setdefault(header, Loop(header, bound, source, iteration, total))
+
+        # the header now stands for the whole loop
+        best[header], worst[header] = total
+        succ[header] = sorted({s for n in body for s in succ[n] if s not in body})
+
+        if any(n in exits for n in body):
+            exits.add(header)
+
+        for n in body - {header}:
+            del succ[n]
+            exits.discard(n)
+
+    def _bound(self, header, body, latches, succ):
+        for address in [header, *latches]:
+            if address in self.annotations:
+                return self.annotations[address], "annotation"
+
+        if len(latches) == 1:
+            pred = {n: set() for n in succ}
+            for n in succ:
+                for s in succ[n]:
+                    pred[s].add(n)
+
+            count = self._counter(latches[0], header, body, pred)
+
+            if count is not None:
+                return (count, count), "counter"
+
+        return None, None
+
+    def _writes(self, body: set[int]) -> tuple[set[int], set[int], bool]:
+        """
+        (registers written, addresses stored to, whether any store is
+        indirect) by the loop body and anything it calls
+        """
+        registers, stores, indirect = set(), set(), False
+        seen, stack = set(), list(body)
+
+        while stack:
+            address = stack.pop()
+            if address in seen or not self._is_code(address):
+                continue
+            seen.add(address)
+
+            ir = self.words[address]
+            name = _name(ir)
+
+            registers |= _written_registers(ir)
+
+            if name == "STORE":
+                stores.add(_address(ir))
+            elif name == "STORER":
+                indirect = True
+            elif name == "CALL":
+                # everything the callee can reach
+                target, callee = _address(ir), []
+                reach = [target]
+                while reach:
+                    a = reach.pop()
+                    if a in seen or a in callee:
+                        continue
+                    callee.append(a)
+                    reach.extend(self._successors(a)[0])
+                    if self._is_code(a) and _name(self.words[a]) == "CALL":
+                        reach.append(_address(self.words[a]))
+
+                stack.extend(callee)
+
+        return registers, stores, indirect
+
+    def _counter(self, latch, header, body, pred) -> Union[None, int]:
+        """
+        How many times the header runs for a loop closed by a counting down
+        'jumpnz', None when it doesn't look like one
+        """
+        ir = self.words[latch]
+        if _name(ir) != "JUMPNZ" or _address(ir) != header:
+            return None
+
+        # the last flag setting instruction before the jump, in straight
+        # line code that is only entered from the top
+        address = latch - 1
+        between = []
+        while address > header and address in body:
+            name = _name(self.words[address])
+
+            if name in _FLAG_SETTERS:
+                break
+
+            if name in _BRANCHES or name in {"JUMPU", "CALL", "RET"}:
+                return None
+
+            between.append(address)
+            address -= 1
+
+        if address not in body or _name(self.words[address]) != "SUB":
+            return None
+
+        if any(pred.get(a) != {a - 1} for a in [*between, latch]):
+            return None
+
+        sub = self.words[address]
+        register, step = _dest(sub), _immediate(sub)
+
+        if step == 0 or any(register in _written_registers(self.words[a]) for a in between):
+            return None
+
+        registers, stores, indirect = self._writes(body - {address})
+        stores_between = [a for a in between if _name(self.words[a]) == "STORE"]
+
+        # load var / sub RA k / store var / jumpnz
+        if register == 0 and stores_between and pred.get(address) == {address - 1}:
+            load = self.words[address - 1]
+            counter = _address(self.words[stores_between[-1]])
+
+            if _name(load) != "LOAD" or _address(load) != counter or indirect:
+                return None
+
+            if self._is_code(counter):
+                return None
+
+            # the counter is set on every way into the loop, the value in the
+            # image only holds the first time round
+            init = self._initialisation(counter, header, body, pred)
+            if init is None:
+                return None
+
+            # the only writes to the counter anywhere are those two
+            writers = [
+                a for a, w in enumerate(self.words)
+                if self._is_code(a) and _name(w) == "STORE" and _address(w) == counter
+            ]  # fmt: skip
+            if writers != sorted([init, stores_between[-1]]):
+                return None
+
+            start = _immediate(self.words[init - 1])
+
+        # move RX n before the loop / sub RX k / jumpnz
+        else:
+            if register in registers:
+                return None
+
+            # the loop is only entered by falling into the header after the move
+            before = header - 1
+            if pred.get(header, set()) - body != {before}:
+                return None
+            if not self._is_code(before) or _name(self.words[before]) != "MOVE":
+                return None
+            if _dest(self.words[before]) != register:
+                return None
+
+            start = _immediate(self.words[before])
+
+        if start == 0 or start % step:
+            return None
+
+        return start // step
+
+    def _initialisation(self, counter, header, body, pred) -> Union[None, int]:
+        """
+        Address of the 'store counter' after a 'move RA n' that every way
+        into the loop goes through, with nothing but straight line code
+        between it and the header. None if there is no such store.
+        """
+        outside = pred.get(header, set()) - body
+        if len(outside) != 1:
+            return None
+
+        address, seen = outside.pop(), set()
+
+        while address not in seen:
+            seen.add(address)
+
+            # collapsed loops and calls could write the counter (or RA)
+            if not self._is_code(address) or address in self.loops:
+                return None
+
+            ir = self.words[address]
+            name = _name(ir)
+
+            if name in {"CALL", "STORER"}:
+                return None
+
+            if name == "STORE" and _address(ir) == counter:
+                move = address - 1
+                if pred.get(address) != {move} or move in self.loops:
+                    return None
+                if _name(self.words[move]) != "MOVE" or _dest(self.words[move]) != 0:
+                    return None
+
+                return address
+
+            if len(pred.get(address, ())) != 1:
+                return None
+
+            address = next(iter(pred[address]))
+
+        return None
+
+
+def _times(count: int, cycles: float) -> float:
+    if count <= 0:
+        return 0
+
+    return count * cycles
+
+
+def analyse(
+    compiled: list[str],
+    roots,
+    table: Union[None, CycleTable] = None,
+) -> tuple[dict[str, Estimate], Analysis]:
+    """
+    Estimates for every root that starts with code, keyed by root name,
+    along with the analysis holding the loops and call targets found.
+    """
+    analysis = Analysis(
+        compiled, table, data_addresses(roots), source_annotations(roots)
+    )
+
+    estimates = {}
+    pointer = 0
+
+    for root in roots:
+        name = root.replace("~", "")
+
+        if name not in estimates and analysis._is_code(pointer):
+            estimates[name] = analysis.estimate(pointer)
+
+        pointer += sum(len(instruction["compiled"]) for instruction in roots[root])
+
+    return estimates, analysis
+
+
+def format_cycles(cycles: float) -> str:
+    if cycles == math.inf:
+        return "inf"
+
+    return str(int(cycles))